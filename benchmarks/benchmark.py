@@ -0,0 +1,323 @@
+'''
+Benchmarks of the scheduler hot paths against synthetic fleets.
+
+Schedule parsing and evaluation, instance discovery with
+describe_instances and with the Resource Groups Tagging API and a full
+handler.run are timed against stubbed EC2 clients with a configurable
+latency per API call. The cold start import of the handler is timed in
+fresh interpreters. Throughput, p50/p99 latency and peak memory are
+written as JSON so results can be compared between commits:
+
+    python benchmarks/benchmark.py --sizes 10,1000,100000
+    python benchmarks/benchmark.py --compare benchmarks/results/<commit>.json
+'''
+import sys
+import os
+import gc
+import json
+import time
+import random
+import logging
+import argparse
+import datetime
+import platform
+import subprocess
+import tracemalloc
+import unittest.mock
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(ROOT, 'source'))
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+
+import clients
+import handler
+import scheduler
+import repository.aws
+
+from stubs import StubClientFactory, ec2_instance
+
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+SOURCE_DIR = os.path.join(ROOT, 'source')
+
+REGIONS = [
+    'us-east-1', 'us-east-2', 'us-west-1', 'us-west-2', 'ca-central-1',
+    'eu-west-1', 'eu-west-2', 'eu-west-3', 'eu-central-1', 'ap-south-1',
+    'ap-northeast-1', 'ap-northeast-2', 'ap-southeast-1', 'ap-southeast-2', 'sa-east-1',
+]
+
+ZONES = ['UTC', 'America/New_York', 'America/Los_Angeles', 'Europe/London', 'Europe/Berlin', 'Asia/Tokyo', 'Australia/Sydney']
+
+WEEKDAYS = 'Mon,Tue,Wed,Thu,Fri'
+ALL_DAYS = 'Mon,Tue,Wed,Thu,Fri,Sat,Sun'
+
+# Regression threshold used by --compare, as a fraction of the previous throughput
+REGRESSION = 0.2
+
+# Seconds the cold start import of the handler may take, a run fails above it
+IMPORT_BUDGET = 0.12
+
+# Modules the handler must not import on a cold start, they are loaded by the first client
+DEFERRED_MODULES = ['boto3', 'botocore']
+
+# Imports a module in a fresh interpreter and reports the time taken and the modules loaded
+_IMPORT_SCRIPT = '''
+import sys, time, json, tracemalloc
+sys.path.insert(0, {source!r})
+if {trace!r}:
+    tracemalloc.start()
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+peak = tracemalloc.get_traced_memory()[1] if {trace!r} else 0
+print(json.dumps({{'seconds': seconds, 'peak': peak, 'modules': sorted(sys.modules)}}))
+'''
+
+def schedule_tag(rng):
+    '''
+    Return a schedule tag value, mostly office hours in a few time zones
+    with some start only, stop only and invalid tags.
+    '''
+    zone = rng.choice(ZONES)
+    kind = rng.random()
+    if kind < 0.6:
+        start = rng.choice([6, 7, 8, 9])
+        return '{:02d}:{:02d};{:02d}:00;{};{}'.format(start, rng.choice([0, 30]), start + rng.choice([9, 10, 12]), zone, WEEKDAYS)
+    if kind < 0.75:
+        return '{:02d}:00;{:02d}:00;{};{}'.format(rng.choice([0, 6]), rng.choice([20, 23]), zone, ALL_DAYS)
+    if kind < 0.85:
+        return 'NONE;{:02d}:00;{};{}'.format(rng.choice([18, 19, 20]), zone, ALL_DAYS)
+    if kind < 0.95:
+        return '{:02d}:00;NONE;{};{}'.format(rng.choice([7, 8]), zone, WEEKDAYS)
+    return rng.choice(['always', '25:00;NONE;UTC;Mon', '08:00;18:00;Mars/Olympus;Mon'])
+
+def synthetic_fleet(size, regions = REGIONS, seed = 0):
+    '''Return describe_instances style instances of a fleet, as a dict of region to instances'''
+    rng = random.Random(seed)
+    fleet = dict((region, []) for region in regions)
+    for i in range(size):
+        tags = {'aws:autoscaling:groupName': 'asg'} if rng.random() < 0.02 else None
+        instance = ec2_instance('i-{:017x}'.format(i), rng.choice(['running', 'stopped']), schedule_tag(rng), tags)
+        fleet[rng.choice(regions)].append(instance)
+    return fleet
+
+def percentile(samples, fraction):
+    '''Return the nearest rank percentile of a list of samples'''
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def measure(operation, repeat):
+    '''
+    Run operation repeat times and return its latency samples and peak
+    memory, memory is traced in an extra run so it does not slow the timed ones.
+    '''
+    samples = []
+    for i in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        operation()
+        samples.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    operation()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return samples, peak
+
+def result(samples, peak, items):
+    '''Summarise latency samples of an operation processing items'''
+    return {
+        'items': items,
+        'repeat': len(samples),
+        'throughput': items / (sum(samples) / len(samples)),
+        'p50': percentile(samples, 0.50),
+        'p99': percentile(samples, 0.99),
+        'peak_memory': peak,
+    }
+
+def parse(tag):
+    '''Return the Schedule of a tag value or None if it is invalid'''
+    try:
+        return scheduler.Schedule.from_string(tag)
+    except ValueError:
+        return None
+
+def bench_parse(size, latency):
+    '''Schedule.from_string, one call per tag, latency per call'''
+    rng = random.Random(size)
+    tags = [schedule_tag(rng) for i in range(size)]
+    samples = []
+    for tag in tags:
+        start = time.perf_counter()
+        parse(tag)
+        samples.append(time.perf_counter() - start)
+    peak = measure(lambda: [parse(tag) for tag in tags], 0)[1]
+    return result(samples, peak, 1)
+
+def bench_evaluate(size, latency):
+    '''Schedule.evaluate, one call per schedule, latency per call'''
+    rng = random.Random(size)
+    schedules = []
+    while len(schedules) < size:
+        schedule = parse(schedule_tag(rng))
+        if schedule:
+            schedules.append(schedule)
+    timestamp = datetime.datetime(2018, 4, 23, 12, 0)
+    samples = []
+    for schedule in schedules:
+        start = time.perf_counter()
+        schedule.evaluate(timestamp)
+        samples.append(time.perf_counter() - start)
+    peak = measure(lambda: scheduler.evaluate_schedules(schedules, timestamp), 0)[1]
+    return result(samples, peak, 1)
+
+def bench_discovery(size, latency):
+    '''EC2.get_scheduled_instances over the whole fleet, latency per run'''
+    fleet = synthetic_fleet(size)
+    factory = StubClientFactory(fleet, latency = dict((region, latency) for region in fleet))
+    samples, peak = measure(lambda: repository.aws.EC2(client_factory = factory).get_scheduled_instances(), repeat_for(size))
+    return result(samples, peak, size)
+
+def bench_tagged_discovery(size, latency):
+    '''TaggedEC2.get_scheduled_instances over the whole fleet, latency per run'''
+    fleet = synthetic_fleet(size)
+    factory = StubClientFactory(fleet, latency = dict((region, latency) for region in fleet))
+    samples, peak = measure(lambda: repository.aws.TaggedEC2(client_factory = factory).get_scheduled_instances(), repeat_for(size))
+    return result(samples, peak, size)
+
+def bench_handler(size, latency):
+    '''handler.run over the whole fleet, latency per run'''
+    fleet = synthetic_fleet(size)
+    factory = StubClientFactory(fleet, latency = dict((region, latency) for region in fleet))
+
+    def run():
+        with unittest.mock.patch.object(clients, 'get_client', factory), \
+                unittest.mock.patch.object(handler, 'SNAPSHOT_PATH', None), \
+                unittest.mock.patch.object(handler, 'SNAPSHOT_TABLE', None), \
+                unittest.mock.patch.object(handler, 'TRANSITION_RULE', None), \
+                unittest.mock.patch.object(handler, 'METRICS', False):
+            handler.run({}, None)
+    samples, peak = measure(run, repeat_for(size))
+    return result(samples, peak, size)
+
+def import_module(module = 'handler', trace = False):
+    '''
+    Import a module in a fresh interpreter and return the seconds taken,
+    the peak memory allocated when traced and the names of the loaded modules
+    '''
+    script = _IMPORT_SCRIPT.format(source = SOURCE_DIR, module = module, trace = trace)
+    output = subprocess.check_output([sys.executable, '-c', script], cwd = SOURCE_DIR)
+    report = json.loads(output.decode('utf-8'))
+    return report['seconds'], report['peak'], report['modules']
+
+def bench_import(repeat = 10):
+    '''Cold start import of handler, latency per import'''
+    samples = [import_module()[0] for i in range(repeat)]
+    return result(samples, import_module(trace = True)[1], 1)
+
+BENCHMARKS = [
+    ('schedule.from_string', bench_parse),
+    ('schedule.evaluate', bench_evaluate),
+    ('repository.get_scheduled_instances', bench_discovery),
+    ('repository.tagged.get_scheduled_instances', bench_tagged_discovery),
+    ('handler.run', bench_handler),
+]
+
+def repeat_for(size):
+    '''Number of timed runs of a whole fleet operation'''
+    return 20 if size <= 1000 else 5 if size <= 10000 else 2
+
+# Benchmarks that do not depend on the fleet size, keyed by name only
+STARTUP_BENCHMARKS = [
+    ('handler.import', bench_import),
+]
+
+def run_benchmarks(sizes, latency, names = None):
+    '''Run the benchmarks and return their results keyed by name and fleet size'''
+    results = {}
+    for name, benchmark in STARTUP_BENCHMARKS:
+        if not names or name in names:
+            results[name] = benchmark()
+    for name, benchmark in BENCHMARKS:
+        if names and name not in names:
+            continue
+        for size in sizes:
+            # Parsed schedules are cached, every measurement starts cold
+            scheduler.schedule_cache = scheduler.ScheduleCache()
+            results['{}[{}]'.format(name, size)] = benchmark(size, latency)
+    return results
+
+def commit():
+    '''Return the current git commit or None'''
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd = ROOT).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(previous, current):
+    '''Print the throughput change of each benchmark, return the names that regressed'''
+    regressed = []
+    for name, values in sorted(current.items()):
+        before = previous.get(name)
+        if before is None:
+            continue
+        change = values['throughput'] / before['throughput'] - 1
+        flag = ''
+        if change < -REGRESSION:
+            flag = '  REGRESSION'
+            regressed.append(name)
+        print('{:<45} {:>14.1f} -> {:>14.1f} /s {:+7.1%}{}'.format(name, before['throughput'], values['throughput'], change, flag))
+    return regressed
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmark the scheduler hot paths')
+    parser.add_argument('--sizes', default = '10,1000,100000', help = 'comma separated fleet sizes')
+    parser.add_argument('--latency', type = float, default = 0.0, help = 'seconds of latency per stubbed API call')
+    parser.add_argument('--only', action = 'append', help = 'benchmark name to run, can be repeated')
+    parser.add_argument('--output', help = 'result file, benchmarks/results/<commit>.json by default')
+    parser.add_argument('--compare', help = 'previous result file to compare with')
+    parser.add_argument('--no-budget', action = 'store_true', help = 'do not fail when handler.import is over its budget')
+    args = parser.parse_args(argv)
+
+    # Per instance log lines and invalid schedule errors would dominate the timings
+    logger = logging.getLogger()
+    level = logger.level
+    logger.setLevel(logging.CRITICAL)
+    try:
+        sizes = [int(size) for size in args.sizes.split(',')]
+        results = run_benchmarks(sizes, args.latency, args.only)
+    finally:
+        logger.setLevel(level)
+
+    report = {
+        'commit': commit(),
+        'timestamp': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'python': platform.python_version(),
+        'latency': args.latency,
+        'results': results,
+    }
+
+    for name, values in sorted(report['results'].items()):
+        print('{:<45} {:>14.1f} /s  p50 {:.6f}s  p99 {:.6f}s  peak {:>8.1f} KiB'.format(
+            name, values['throughput'], values['p50'], values['p99'], values['peak_memory'] / 1024.0))
+
+    output = args.output or os.path.join(RESULTS_DIR, '{}.json'.format(report['commit'] or 'latest'))
+    if not os.path.isdir(os.path.dirname(os.path.abspath(output))):
+        os.makedirs(os.path.dirname(os.path.abspath(output)))
+    with open(output, 'w') as f:
+        json.dump(report, f, indent = 2, sort_keys = True)
+    print('Results written to {}'.format(output))
+
+    status = 0
+    startup = report['results'].get('handler.import')
+    if startup and startup['p50'] > IMPORT_BUDGET and not args.no_budget:
+        print('handler.import p50 {:.3f}s over the {:.3f}s budget  REGRESSION'.format(startup['p50'], IMPORT_BUDGET))
+        status = 1
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(json.load(f)['results'], report['results']):
+                status = 1
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
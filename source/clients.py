@@ -0,0 +1,157 @@
+import logging
+import time
+import threading
+
+logging.getLogger('boto3').setLevel(logging.ERROR)
+logging.getLogger('botocore').setLevel(logging.ERROR)
+
+logger = logging.getLogger()
+
+def new_session(**kwargs):
+    '''
+    Return a new boto3.session.Session. boto3 is only imported with the
+    first session, a cold start does not pay for it until a client is needed.
+    '''
+    import boto3.session
+    return boto3.session.Session(**kwargs)
+
+class ClientPool:
+    '''
+    Pool of boto3 clients keyed by service, region and account.
+
+    Clients are created once from a single shared session and reused, a
+    module level pool survives across warm Lambda invocations. boto3 and
+    the service models are loaded by the first client, not on import. boto3
+    sessions are not thread safe so client creation is serialised, the
+    clients themselves can be shared between threads.
+
+    Clients of other accounts come from a session per account with the
+    credentials of the role registered with set_roles. Credentials are
+    assumed once and cached, they are assumed again with new clients
+    REFRESH_MARGIN seconds before they expire.
+
+    :param max_pool_connections: HTTP connections kept open per client
+    :param session_factory: callable returning a boto3.session.Session, new_session by default,
+        given the credentials of a role for other accounts
+    :param clock: callable returning the current time in seconds since the epoch
+    '''
+    MAX_POOL_CONNECTIONS = 10
+
+    # Seconds to wait for a response, synchronous Lambda invocations last as long as the invoked function
+    READ_TIMEOUT = 60
+    READ_TIMEOUTS = {'lambda': 900}
+
+    # Assumed role credentials are replaced this many seconds before they expire
+    REFRESH_MARGIN = 300
+    SESSION_NAME = 'instance-scheduler'
+    SESSION_DURATION = 3600
+
+    def __init__(self, max_pool_connections = MAX_POOL_CONNECTIONS, session_factory = None, clock = time.time):
+        self.max_pool_connections = max_pool_connections
+        self.session_factory = session_factory or new_session
+        self.clock = clock
+        self.roles = {}
+        self._session = None
+        self._account_sessions = {}
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def configure(self, max_pool_connections):
+        '''
+        Size the HTTP connection pool of each client to the number of threads
+        that will share it, existing clients are discarded if the size changes.
+        '''
+        with self._lock:
+            if max_pool_connections != self.max_pool_connections:
+                self.max_pool_connections = max_pool_connections
+                self._clients = {}
+
+    def set_roles(self, role_arns):
+        '''
+        Register the IAM roles assumed to reach other accounts and return
+        their account ids. Clients of accounts whose role changed are discarded.
+        '''
+        roles = dict((role_arn.split(':')[4], role_arn) for role_arn in role_arns)
+        with self._lock:
+            if roles != self.roles:
+                self.roles = roles
+                self._account_sessions = {}
+                self._clients = dict((key, entry) for key, entry in self._clients.items() if key[2] is None)
+        return sorted(roles)
+
+    def client(self, service, region_name = None, account = None):
+        '''
+        Return the pooled client for a service and region, boto3.client
+        signature, of another account when its id is given
+        '''
+        key = (service, region_name, account)
+        entry = self._clients.get(key)
+        if entry is None or self._expired(entry[1]):
+            with self._lock:
+                entry = self._clients.get(key)
+                if entry is None or self._expired(entry[1]):
+                    session, expires = self._get_session(account)
+                    entry = self._clients[key] = (self._create(session, service, region_name), expires)
+        return entry[0]
+
+    def clear(self):
+        '''Discard all clients and sessions'''
+        with self._lock:
+            self._session = None
+            self._account_sessions = {}
+            self._clients = {}
+
+    def _expired(self, expires):
+        return expires is not None and self.clock() >= expires
+
+    def _get_session(self, account):
+        '''Return the session of an account and the time its clients must be replaced, None if never'''
+        if self._session is None:
+            self._session = self.session_factory()
+        if account is None:
+            return self._session, None
+
+        cached = self._account_sessions.get(account)
+        if cached is None or self._expired(cached[1]):
+            role_arn = self.roles.get(account)
+            if role_arn is None:
+                raise ValueError('no role registered for account {}'.format(account))
+            sts = self._create(self._session, 'sts', None)
+            credentials = sts.assume_role(RoleArn = role_arn, RoleSessionName = ClientPool.SESSION_NAME,
+                                          DurationSeconds = ClientPool.SESSION_DURATION)['Credentials']
+            logger.debug('Account [{}]: assumed {} until {}'.format(account, role_arn, credentials['Expiration']))
+            session = self.session_factory(aws_access_key_id = credentials['AccessKeyId'],
+                                           aws_secret_access_key = credentials['SecretAccessKey'],
+                                           aws_session_token = credentials['SessionToken'])
+            cached = self._account_sessions[account] = (session, credentials['Expiration'].timestamp() - ClientPool.REFRESH_MARGIN)
+        return cached
+
+    def _create(self, session, service, region_name):
+        import botocore.config
+        read_timeout = ClientPool.READ_TIMEOUTS.get(service, ClientPool.READ_TIMEOUT)
+        config = botocore.config.Config(max_pool_connections = self.max_pool_connections, read_timeout = read_timeout)
+        logger.debug('Client [{}:{}]: created'.format(service, region_name))
+        return session.client(service, region_name = region_name, config = config)
+
+# Process wide pool, kept between warm Lambda invocations
+pool = ClientPool()
+
+def get_client(service, region_name = None, account = None):
+    '''Return a client from the process wide pool, boto3.client signature'''
+    return pool.client(service, region_name, account)
+
+def split_region(region):
+    '''
+    Return the account id and region name of a region key, the key of a
+    region of another account is <ACCOUNT>:<REGION>, the account id is
+    None for the account the function runs in
+    '''
+    account, separator, region_name = region.rpartition(':')
+    return account or None, region_name
+
+def region_client(client_factory, service, region):
+    '''Return the client of a region key, the account is only passed to client_factory for other accounts'''
+    account, region_name = split_region(region)
+    if account is None:
+        return client_factory(service, region_name = region_name)
+    return client_factory(service, region_name = region_name, account = account)
@@ -0,0 +1,150 @@
+import logging
+import sys
+import time
+import random
+import threading
+import collections
+import concurrent.futures
+
+logger = logging.getLogger()
+
+# Unit of work run by the Executor, a single API call for a group of instances
+#   region: region the call is made in
+#   action: action name passed to the send callable
+#   instance_ids: list of instance ids in the call
+Task = collections.namedtuple('Task', ['region', 'action', 'instance_ids'])
+
+# Outcome of a Task
+#   outcome: value returned by the send callable or the exception it raised last
+#   latency: seconds from the first attempt to the outcome, including backoff
+#   attempts: number of times the send callable was called
+TaskResult = collections.namedtuple('TaskResult', ['task', 'outcome', 'latency', 'attempts'])
+
+# Error codes EC2 and other AWS APIs return when a request is throttled
+THROTTLING_ERRORS = frozenset(['RequestLimitExceeded', 'Throttling', 'ThrottlingException', 'TooManyRequestsException'])
+
+def is_client_error(error):
+    '''
+    Return True if an exception is a botocore ClientError. botocore is not
+    imported for the check, no ClientError exists until a client loaded it.
+    '''
+    exceptions = sys.modules.get('botocore.exceptions')
+    return exceptions is not None and isinstance(error, exceptions.ClientError)
+
+def is_throttled(error):
+    '''Return True if an exception is an AWS throttling error'''
+    if is_client_error(error):
+        return error.response.get('Error', {}).get('Code') in THROTTLING_ERRORS
+    return False
+
+class TokenBucket:
+    '''
+    Thread safe token bucket rate limiter.
+
+    :param rate: tokens added per second
+    :param capacity: maximum number of tokens, the allowed burst
+    '''
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''Take a token, waiting until one is available'''
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+class Executor:
+    '''
+    Runs Tasks with bounded parallelism and rate limiting per region.
+
+    Throttled calls are retried with exponential backoff and full jitter,
+    other errors are returned as the outcome of the task.
+
+    :param send: callable taking a Task and returning its outcome
+    :param max_workers: maximum number of concurrent calls per region
+    :param rate: calls per second allowed per region
+    :param burst: calls allowed in a burst per region
+    :param max_attempts: maximum number of attempts of a throttled task
+    :param base_delay: seconds of the first backoff
+    :param max_delay: maximum seconds of a backoff
+    '''
+    MAX_WORKERS = 4
+    RATE = 5.0
+    BURST = 10
+    MAX_ATTEMPTS = 5
+    BASE_DELAY = 0.5
+    MAX_DELAY = 20.0
+
+    def __init__(self, send, max_workers = MAX_WORKERS, rate = RATE, burst = BURST,
+                 max_attempts = MAX_ATTEMPTS, base_delay = BASE_DELAY, max_delay = MAX_DELAY):
+        self.send = send
+        self.max_workers = max_workers
+        self.rate = rate
+        self.burst = burst
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._buckets = {}
+
+    def run(self, tasks):
+        '''
+        Run tasks and return a TaskResult for each of them, in the order
+        of the tasks.
+        '''
+        tasks = list(tasks)
+        regions = collections.OrderedDict()
+        for task in tasks:
+            regions.setdefault(task.region, []).append(task)
+
+        results = {}
+        executors = []
+        try:
+            futures = {}
+            for region, region_tasks in regions.items():
+                executor = concurrent.futures.ThreadPoolExecutor(max_workers = self.max_workers)
+                executors.append(executor)
+                for task in region_tasks:
+                    futures[executor.submit(self._run_task, task)] = task
+            for future in concurrent.futures.as_completed(futures):
+                results[id(futures[future])] = future.result()
+        finally:
+            for executor in executors:
+                executor.shutdown(wait = True)
+
+        return [results[id(task)] for task in tasks]
+
+    def _run_task(self, task):
+        bucket = self._get_bucket(task.region)
+        start = time.monotonic()
+        attempts = 0
+        while True:
+            bucket.acquire()
+            attempts += 1
+            try:
+                outcome = self.send(task)
+            except Exception as e:
+                if is_throttled(e) and attempts < self.max_attempts:
+                    delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempts - 1)))
+                    logger.warning('Region [{}]: {} throttled, retrying in {:.2f} seconds'.format(task.region, task.action, delay))
+                    time.sleep(delay)
+                    continue
+                outcome = e
+            return TaskResult(task, outcome, time.monotonic() - start, attempts)
+
+    def _get_bucket(self, region):
+        # setdefault keeps a single bucket when threads race to create it
+        bucket = self._buckets.get(region)
+        if bucket is None:
+            bucket = self._buckets.setdefault(region, TokenBucket(self.rate, self.burst))
+        return bucket
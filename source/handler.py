@@ -1,20 +1,567 @@
 import logging
 import json
+import os
+import time
+import datetime
+import collections
+import concurrent.futures
 
+import clients
+import snapshot
+import shards
+import plan
+import instrumentation
 import repository.aws
+import provider.aws
 
 import scheduler
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Number of discovered instances evaluated together
+EVALUATION_BATCH_SIZE = 500
+
+# Skip runs when no schedule transition happened since the previous run
+SKIP_IDLE_RUNS = os.environ.get('SKIP_IDLE_RUNS', 'false').lower() == 'true'
+
+# A full scan runs at least this often to pick up new and re-tagged instances
+RECONCILE_INTERVAL = datetime.timedelta(minutes = int(os.environ.get('RECONCILE_MINUTES', '360')))
+
+# Name of a CloudWatch Events rule moved to the next schedule transition
+TRANSITION_RULE = os.environ.get('TRANSITION_RULE')
+
+# Where the instance snapshot is kept, a DynamoDB table or a local file
+SNAPSHOT_TABLE = os.environ.get('SNAPSHOT_TABLE')
+SNAPSHOT_PATH = os.environ.get('SNAPSHOT_PATH')
+
+# Evaluate and write the action plan without starting or stopping instances
+DRY_RUN = os.environ.get('DRY_RUN', 'false').lower() == 'true'
+
+# Where the action plan is written as JSON Lines, '-' for standard output.
+# A dry run writes the plan to standard output when no path is set.
+PLAN_PATH = os.environ.get('PLAN_PATH')
+
+# Emit an embedded metric format record with the timers and counters of every run
+METRICS = os.environ.get('METRICS', 'true').lower() == 'true'
+
+# Seconds kept free before the Lambda timeout to send actions and save the snapshot
+TIME_MARGIN = int(os.environ.get('TIME_MARGIN_SECONDS', '30'))
+
+# A run that stopped before its deadline is resumed within this window, later ones start again
+RESUME_WINDOW = datetime.timedelta(minutes = int(os.environ.get('RESUME_WINDOW_MINUTES', '30')))
+
+# Invoke the function again straight away when a run stops before its deadline
+CHAIN_INVOCATIONS = os.environ.get('CHAIN_INVOCATIONS', 'false').lower() == 'true'
+
+# Split full scans between this many workers, 1 scans everything in the running invocation
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', '1'))
+
+# How the work is split, 'region' or 'hash' of instance id, see shards.plan_shards
+SHARD_STRATEGY = os.environ.get('SHARD_STRATEGY', shards.REGION)
+
+# Where workers run, 'process' for a local process pool or 'lambda' to invoke the function once per shard
+SHARD_MODE = os.environ.get('SHARD_MODE', 'process')
+
+# Comma separated IAM roles assumed to scan other accounts, the account of the function is always scanned
+ROLE_ARNS = [role_arn.strip() for role_arn in os.environ.get('ROLE_ARNS', '').split(',') if role_arn.strip()]
+
+# Comma separated regions scanned in every account, all available regions when empty
+REGIONS = [region.strip() for region in os.environ.get('REGIONS', '').split(',') if region.strip()]
+
+# The regions available to each account are listed again after this long, the list is kept with the snapshot
+REGION_LIST_TTL = datetime.timedelta(minutes = int(os.environ.get('REGION_LIST_MINUTES', '1440')))
+
+# Regions without scheduled instances are only scanned again after this long, 0 scans them every run
+EMPTY_REGION_TTL = datetime.timedelta(minutes = int(os.environ.get('EMPTY_REGION_MINUTES', os.environ.get('RECONCILE_MINUTES', '360'))))
+
+# Regions that failed are scanned again after this long, doubling with every
+# failed retry up to RECONCILE_MINUTES
+REGION_RETRY_INTERVAL = datetime.timedelta(minutes = int(os.environ.get('REGION_RETRY_MINUTES', '1')))
+
+# How scheduled instances are found, 'instances' with describe_instances or 'tagging'
+# with the Resource Groups Tagging API, see repository.aws.TaggedEC2
+DISCOVERY = os.environ.get('DISCOVERY', 'instances')
+
+# Timestamp of a coordinated run passed to its workers
+_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# Transition index of the previous full scan, kept between warm invocations
+_transitions = None
+
+# Regions that failed in the previous run, see _next_retry
+_RegionRetry = collections.namedtuple('_RegionRetry', ['regions', 'attempts', 'retry_at'])
+_retry = None
+
 def run(event, context):
+    '''
+    Scan all regions, evaluate every scheduled instance and send the
+    resulting start and stop actions.
+
+    A dry run, from DRY_RUN or a "dry_run" key in the event, only writes
+    the plan and returns the number of planned actions. Nothing is
+    started, stopped or saved.
+
+    The time spent in each stage is emitted as one metrics record per run
+    unless METRICS is false.
+
+    When the Lambda context is provided the scan stops TIME_MARGIN seconds
+    before the timeout and the regions left to scan are saved as a cursor
+    with the snapshot. The next run within RESUME_WINDOW, or a chained
+    invocation with CHAIN_INVOCATIONS, only scans what is left so every
+    instance is evaluated once per window.
+
+    Regions that fail are not part of the cursor. With SKIP_IDLE_RUNS a
+    run that would be skipped scans only them once their retry is due,
+    a run with a transition due always scans every region.
+    '''
     logger.info('event: {}'.format(json.dumps(event)))
 
-    repo = repository.aws.EC2()
-    instances = repo.get_scheduled_instances()
-    for instance in instances:
-        instance.evaluate_schedule()
+    metrics = instrumentation.Metrics(enabled = METRICS)
+    cache = scheduler.schedule_cache
+    hits, misses = cache.hits, cache.misses
+    try:
+        with metrics.timer('Run'):
+            return _run(event, context, metrics)
+    finally:
+        metrics.increment('ScheduleCacheHits', cache.hits - hits)
+        metrics.increment('ScheduleCacheMisses', cache.misses - misses)
+        metrics.emit()
+
+def _run(event, context, metrics):
+    global _transitions, _retry
+
+    dry_run = DRY_RUN
+    if isinstance(event, dict) and 'dry_run' in event:
+        dry_run = bool(event['dry_run'])
+
+    if isinstance(event, dict) and 'shard' in event:
+        timestamp = datetime.datetime.strptime(event['timestamp'], _TIME_FORMAT)
+        deadline = _get_deadline(context)
+        if event.get('budget') is not None:
+            # Do not outlive the coordinator waiting on the report
+            limit = time.monotonic() + event['budget']
+            deadline = limit if deadline is None else min(deadline, limit)
+        return _run_shard(shards.from_dict(event['shard']), timestamp, dry_run, deadline, metrics)
+
+    timestamp = datetime.datetime.utcnow()
+    deadline = _get_deadline(context)
+    retry = None
+    if not dry_run and SKIP_IDLE_RUNS and _is_idle(_transitions, timestamp):
+        if _retry is None or timestamp < _retry.retry_at:
+            logger.info('No schedule transition since {}, next at {}, skipping run'.format(_transitions.timestamp, _transitions.next_transition))
+            metrics.increment('RunsSkipped')
+            return
+        # Nothing else is due, only the regions that failed are scanned, without coordinating workers
+        retry = _retry
+        logger.info('Retrying {} failed regions, attempt {}'.format(len(retry.regions), retry.attempts + 1))
+
+    if SHARD_COUNT > 1 and retry is None:
+        return _coordinate(timestamp, dry_run, deadline, context, metrics)
+
+    accounts = _configure_clients()
+
+    # Schedules of instances whose tag did not change since the last run are not parsed again
+    store = get_snapshot_store()
+    with metrics.timer('SnapshotLoad'):
+        previous = store.load(retry.regions if retry else None) if store else None
+        cursor = saved_cursor = store.load_cursor() if store and not dry_run and not retry else None
+    if cursor and timestamp - cursor.timestamp >= RESUME_WINDOW:
+        logger.warning('Cursor of the run at {} is too old, scanning all regions'.format(cursor.timestamp))
+        cursor = None
+    if cursor:
+        logger.info('Resuming the run at {}, {} regions left to scan'.format(cursor.timestamp, len(cursor.regions)))
+
+    # Start and stop actions are batched by region and sent once evaluated
+    dispatcher = provider.aws.Dispatcher(metrics = metrics)
+    repo = _new_repository(max_workers = repository.aws.EC2.MAX_WORKERS, dispatcher = dispatcher, previous = previous, metrics = metrics,
+                           accounts = accounts, regions = REGIONS or None)
+    # A resumed run only scans what is left, a retry the regions that failed and
+    # a new one skips the regions that were recently empty
+    if retry:
+        regions = dict((region, None) for region in retry.regions)
+    else:
+        regions = cursor.regions if cursor else _select_regions(store, repo, previous, timestamp, dry_run, metrics)
+    # The plan of each batch is written as soon as it is evaluated
+    writer = plan.open_plan(PLAN_PATH or ('-' if dry_run else None), timestamp, dry_run)
+
+    # Evaluate instances in batches as they are discovered, later pages are still being fetched.
+    # Every batch shares the run's timestamp so each zone is localized once per run.
+    evaluation = scheduler.EvaluationContext(timestamp)
+    transitions = scheduler.TransitionIndex(timestamp)
+    plan_summary = plan.PlanSummary()
+    if cursor:
+        transitions.add_transition(cursor.next_transition)
+    try:
+        instances = repo.iter_scheduled_instances(deadline, regions)
+        _evaluate_instances(instances, evaluation, transitions, writer, plan_summary, dry_run, metrics)
+    finally:
+        if writer:
+            writer.close()
+
+    # Instances that change state are logged one by one, the others only in this sampled summary
+    logger.info(plan_summary)
+
+    if dry_run:
+        planned = writer.summary()
+        logger.info('Dry run: {} to start, {} to stop, {} unchanged'.format(planned['start'], planned['stop'], planned['unchanged']))
+        return planned
+
+    # Evaluation only queued the actions, they are sent in parallel once all instances are evaluated
+    with metrics.timer('Actions'):
+        results = dispatcher.flush()
+    failed = [id for id, result in results.items() if result is not True]
+    logger.info('Actions: {} sent, {} failed'.format(len(results), len(failed)))
+    if dispatcher.reports:
+        slowest = max(dispatcher.reports, key = lambda report: report.latency)
+        logger.info('Slowest action: {} {} in {:.2f} seconds, {} attempts'.format(slowest.action, slowest.id, slowest.latency, slowest.attempts))
+
+    # Regions that were not scanned completely keep their previous snapshot
+    incomplete = bool(repo.cursor)
+    if store:
+        with metrics.timer('SnapshotSave'):
+            store.save(repo.snapshot)
+            if incomplete:
+                window = cursor.timestamp if cursor else timestamp
+                store.save_cursor(snapshot.Cursor(window, repo.cursor, transitions.next_transition))
+            elif saved_cursor:
+                store.save_cursor(None)
+    elif incomplete:
+        logger.error('No snapshot store to save the cursor, {} regions will not be scanned'.format(len(repo.cursor)))
+
+    # A retry only scanned the failed regions, the index of the last full scan still covers the others
+    if retry:
+        _transitions.add_transition(transitions.next_transition)
+        transitions = _transitions
+    # Failed actions are retried by the next run and unscanned regions resumed, do not let it be skipped.
+    # Failed regions are retried on their own, see _next_retry.
+    if failed or incomplete:
+        _transitions = None
+    elif not retry:
+        _transitions = transitions
+    _retry = _next_retry(repo.failed_regions, timestamp, metrics)
+    logger.info('Next schedule transition at {}'.format(transitions.next_transition))
+    if incomplete:
+        metrics.increment('RunsIncomplete')
+        if CHAIN_INVOCATIONS and context is not None:
+            _invoke_self(context)
+    if TRANSITION_RULE:
+        # Without a chained invocation the rule resumes the run in a minute
+        resume = incomplete and not CHAIN_INVOCATIONS
+        _schedule_next_run(TRANSITION_RULE, transitions, timestamp, resume, _retry.retry_at if _retry else None)
+
+def run_shard(shard, timestamp, dry_run = False, budget = None, client_factory = None):
+    '''
+    Scan, evaluate and act on the instances of one shard of a coordinated
+    run and return the shards report sent back to the coordinator.
+
+    Workers read the snapshot of their regions but only the coordinator
+    saves it, once every report is in.
+
+    :param shard: shards.Shard to process
+    :param timestamp: naive datetime.datetime in UTC of the coordinated run
+    :param dry_run: True to only plan the actions
+    :param budget: optional seconds the worker may scan for
+    :param client_factory: optional callable returning clients, boto3.client signature
+    '''
+    metrics = instrumentation.Metrics(enabled = METRICS)
+    deadline = time.monotonic() + budget if budget is not None else None
+    try:
+        with metrics.timer('Run'):
+            return _run_shard(shard, timestamp, dry_run, deadline, metrics, client_factory)
+    finally:
+        metrics.emit(properties = {'Shard': shard.index})
+
+def _run_shard(shard, timestamp, dry_run, deadline, metrics, client_factory = None):
+    logger.info('Shard [{}]: {} regions, {} hash shards'.format(shard.index, len(shard.regions), shard.count))
+    accounts = _configure_clients()
+
+    store = get_snapshot_store()
+    with metrics.timer('SnapshotLoad'):
+        previous = store.load(shard.regions) if store else None
+
+    dispatcher = provider.aws.Dispatcher(client_factory = client_factory, metrics = metrics)
+    repo = _new_repository(max_workers = repository.aws.EC2.MAX_WORKERS, client_factory = client_factory, dispatcher = dispatcher,
+                           previous = previous, metrics = metrics, accounts = accounts,
+                           shard = (shard.index, shard.count) if shard.count > 1 else None)
+    writer = plan.open_plan(PLAN_PATH or ('-' if dry_run else None), timestamp, dry_run)
+
+    evaluation = scheduler.EvaluationContext(timestamp)
+    transitions = scheduler.TransitionIndex(timestamp)
+    plan_summary = plan.PlanSummary()
+    try:
+        # The shard's regions are scanned from their first page
+        instances = repo.iter_scheduled_instances(deadline, dict((region, None) for region in shard.regions))
+        _evaluate_instances(instances, evaluation, transitions, writer, plan_summary, dry_run, metrics)
+    finally:
+        if writer:
+            writer.close()
+    logger.info(plan_summary)
+
+    if dry_run:
+        planned = writer.summary()
+        started, stopped, failed = planned['start'], planned['stop'], 0
+    else:
+        with metrics.timer('Actions'):
+            results = dispatcher.flush()
+        actions = collections.Counter(report.action for report in dispatcher.reports if report.outcome is True)
+        started, stopped = actions[provider.aws.Dispatcher.START], actions[provider.aws.Dispatcher.STOP]
+        failed = sum(1 for result in results.values() if result is not True)
+
+    # Regions left to scan keep their previous snapshot
+    region_snapshots = dict((region, region_snapshot) for region, region_snapshot in repo.snapshot.regions.items()
+                            if region not in repo.cursor)
+    return shards.make_report(shard, region_snapshots, transitions.next_transition, sum(plan_summary.counts.values()),
+                              started, stopped, failed, not repo.cursor, repo.failed_regions)
+
+def _coordinate(timestamp, dry_run, deadline, context, metrics, client_factory = None):
+    '''Split a run between SHARD_COUNT workers, merge their reports and save the snapshot once'''
+    global _transitions, _retry
+
+    accounts = _configure_clients()
+    store = get_snapshot_store()
+    with metrics.timer('SnapshotLoad'):
+        previous = store.load() if store else None
+    # Shards split the active regions of every account, the previous snapshot weighs them so the shards are balanced
+    repo = repository.aws.EC2(client_factory = client_factory, metrics = metrics, accounts = accounts, regions = REGIONS or None)
+    regions = list(_select_regions(store, repo, previous, timestamp, dry_run, metrics))
+    shard_list = shards.plan_shards(regions, SHARD_COUNT, SHARD_STRATEGY, previous)
+    logger.info('Coordinating {} shards by {} over {} regions'.format(len(shard_list), SHARD_STRATEGY, len(regions)))
+
+    budget = deadline - time.monotonic() if deadline is not None else None
+    with metrics.timer('Shards'):
+        reports = _run_shards(shard_list, timestamp, dry_run, budget, context, client_factory)
+    merge = shards.Merge(shard_list, reports)
+    totals = merge.totals
+    metrics.increment('ShardsFailed', len(merge.failed_shards))
+    logger.info('Shards: {} evaluated, {} started, {} stopped, {} failed, {} of {} shards failed'.format(
+        totals['evaluated'], totals['started'], totals['stopped'], totals['failed'], len(merge.failed_shards), len(shard_list)))
+
+    if dry_run:
+        return {'start': totals['started'], 'stop': totals['stopped'], 'unchanged': totals['evaluated'] - totals['started'] - totals['stopped']}
+
+    if store:
+        with metrics.timer('SnapshotSave'):
+            store.save(merge.snapshot)
+
+    transitions = scheduler.TransitionIndex(timestamp)
+    transitions.add_transition(merge.next_transition)
+    incomplete = not merge.complete
+    _transitions = transitions if not totals['failed'] and not incomplete else None
+    _retry = _next_retry(merge.failed_regions, timestamp, metrics)
+    logger.info('Next schedule transition at {}'.format(transitions.next_transition))
+    if incomplete:
+        metrics.increment('RunsIncomplete')
+    if TRANSITION_RULE:
+        # Shards that failed or ran out of time are scanned again by the next run, in a minute
+        _schedule_next_run(TRANSITION_RULE, transitions, timestamp, incomplete, _retry.retry_at if _retry else None)
+
+def _run_shards(shard_list, timestamp, dry_run, budget, context, client_factory = None):
+    '''Run the workers of a coordinated run and return their reports, None for a failed shard'''
+    if not shard_list:
+        return []
+    if SHARD_MODE == 'lambda':
+        # Each worker is a synchronous invocation, threads only wait on them
+        with concurrent.futures.ThreadPoolExecutor(max_workers = len(shard_list)) as executor:
+            return shards.fan_out(shard_list, _invoke_shard, executor, context.invoked_function_arn, timestamp, dry_run, budget)
+    with concurrent.futures.ProcessPoolExecutor(max_workers = min(len(shard_list), os.cpu_count() or 1)) as executor:
+        return shards.fan_out(shard_list, run_shard, executor, timestamp, dry_run, budget, client_factory)
+
+def _invoke_shard(shard, function_name, timestamp, dry_run, budget):
+    '''Invoke a function with the event of a shard and return its report'''
+    payload = {
+        'shard': shards.to_dict(shard),
+        'timestamp': timestamp.strftime(_TIME_FORMAT),
+        'dry_run': dry_run,
+        'budget': budget,
+    }
+    lambda_client = clients.get_client('lambda')
+    response = lambda_client.invoke(FunctionName = function_name, InvocationType = 'RequestResponse',
+                                    Payload = json.dumps(payload).encode('utf-8'))
+    result = json.loads(response['Payload'].read().decode('utf-8'))
+    if 'FunctionError' in response:
+        raise RuntimeError('{}: {}'.format(response['FunctionError'], result))
+    return result
+
+def _evaluate_instances(instances, evaluation, transitions, writer, plan_summary, dry_run, metrics):
+    '''Evaluate instances in batches as they are discovered and index their transitions'''
+    batch = []
+    # Discovery is the scan time less the evaluation time
+    with metrics.timer('Scan'):
+        for instance in instances:
+            transitions.add(instance.schedule)
+            batch.append(instance)
+            if len(batch) >= EVALUATION_BATCH_SIZE:
+                _evaluate_batch(batch, evaluation, writer, plan_summary, dry_run, metrics)
+                batch = []
+        _evaluate_batch(batch, evaluation, writer, plan_summary, dry_run, metrics)
+
+def _evaluate_batch(batch, evaluation, writer, plan_summary, dry_run, metrics):
+    with metrics.timer('Evaluation'):
+        entries = scheduler.evaluate_instances(batch, context = evaluation, dry_run = dry_run)
+    metrics.increment('InstancesEvaluated', len(entries))
+    plan_summary.add(entries)
+    if writer:
+        writer.write(entries)
+
+def _select_regions(store, repo, previous, timestamp, dry_run, metrics):
+    '''
+    Return the regions a new run scans as a cursor dict, see
+    repository.aws.EC2.iter_scheduled_instances.
+
+    The region list is read from the store and only described again once
+    it is REGION_LIST_TTL old or the scanned accounts changed. Regions
+    that were empty at their last scan are skipped until their scan is
+    EMPTY_REGION_TTL old, see snapshot.Snapshot.regions_to_scan.
+    '''
+    region_list = store.load_region_list() if store and not REGIONS else None
+    if region_list is None or timestamp - region_list.timestamp >= REGION_LIST_TTL or region_list.accounts != repo.accounts:
+        region_list = snapshot.RegionList(timestamp, repo.accounts, repo.get_regions())
+        # A list missing an account that could not be reached is not kept, the next run lists the regions again
+        if store and not REGIONS and not repo.unreachable and not dry_run:
+            store.save_region_list(region_list)
+    else:
+        metrics.increment('RegionListCached')
+
+    regions = (previous or snapshot.Snapshot()).regions_to_scan(region_list.regions, timestamp, EMPTY_REGION_TTL)
+    skipped = len(region_list.regions) - len(regions)
+    metrics.increment('RegionsSkipped', skipped)
+    if skipped:
+        logger.info('Skipping {} of {} regions without scheduled instances'.format(skipped, len(region_list.regions)))
+    return dict((region, None) for region in regions)
+
+def on_event(event, context):
+    '''
+    Handle an EC2 instance state-change or tag change event, only the
+    instance in the event is read from the snapshot, updated and evaluated.
+
+    The entry of the instance is saved before acting and only when the
+    event changed it. It is saved as observed at the time of the event so
+    a newer entry, from a later event or scan, is kept and not acted on.
+    Changes to pending or stopping are ignored, a failed action is logged
+    and left to the next run. With DRY_RUN the planned action is only
+    logged and nothing is saved.
+    '''
+    logger.info('event: {}'.format(json.dumps(event)))
+
+    accounts = clients.pool.set_roles(ROLE_ARNS)
+    store = get_snapshot_store()
+    dispatcher = provider.aws.Dispatcher()
+    repo = repository.aws.EC2(accounts = accounts, dispatcher = dispatcher)
+    region, instance_id = repo.get_event_instance(event)
+    entry = store.load_instance(region, instance_id) if store and region else None
+    if entry is not None:
+        repo.previous.regions[region] = snapshot.RegionSnapshot(snapshot.NEVER_SCANNED, {instance_id: entry})
+
+    region, instance = repo.apply_event(event)
+    dry_run = DRY_RUN
+    if store and region and not dry_run:
+        updated = repo.previous.regions[region].instances.get(instance_id)
+        if updated != entry and not store.save_instance(region, instance_id, updated, _get_event_time(event)):
+            return
+
+    if instance:
+        planned = instance.evaluate_schedule(dry_run = dry_run)
+        if dry_run:
+            logger.info('Dry run: Instance [{}] {}'.format(instance.id, planned.action or 'unchanged'))
+            return
+        for id, result in dispatcher.flush().items():
+            if result is not True:
+                logger.error('Instance [{}]: {}'.format(id, result))
+
+def _get_event_time(event):
+    '''Return the time of an event as a naive datetime.datetime in UTC, now if it has none'''
+    if event.get('time'):
+        return datetime.datetime.strptime(event['time'], '%Y-%m-%dT%H:%M:%SZ')
+    return datetime.datetime.utcnow()
+
+def _new_repository(**kwargs):
+    '''Return the EC2 repository of the DISCOVERY backend, given the parameters of repository.aws.EC2'''
+    if DISCOVERY == 'tagging':
+        return repository.aws.TaggedEC2(**kwargs)
+    return repository.aws.EC2(**kwargs)
+
+def _configure_clients():
+    '''Size the pooled clients for the region workers and register the roles of other accounts, return their ids'''
+    # Pooled clients are shared by the region workers, size their connection pools to match
+    clients.pool.configure(max_pool_connections = repository.aws.EC2.MAX_WORKERS)
+    return clients.pool.set_roles(ROLE_ARNS)
+
+def get_snapshot_store():
+    '''Return the configured snapshot store or None'''
+    if SNAPSHOT_TABLE:
+        return snapshot.DynamoDBSnapshotStore(SNAPSHOT_TABLE)
+    if SNAPSHOT_PATH:
+        return snapshot.FileSnapshotStore(SNAPSHOT_PATH)
+    return None
+
+def _is_idle(transitions, timestamp):
+    '''Return True if no indexed transition passed since the last full scan and it is still recent'''
+    if transitions is None:
+        return False
+    if timestamp - transitions.timestamp >= RECONCILE_INTERVAL:
+        return False
+    next_transition = transitions.next_transition
+    return next_transition is None or timestamp <= next_transition
+
+def _next_retry(failed_regions, timestamp, metrics):
+    '''
+    Return the _RegionRetry of the regions that failed in a run, None when
+    none did. The retry is delayed by REGION_RETRY_INTERVAL, doubled for
+    every earlier run in a row that had failed regions, so a region that
+    keeps failing does not wake the function up every minute.
+    '''
+    if not failed_regions:
+        return None
+    metrics.increment('RegionsFailed', len(failed_regions))
+    attempts = _retry.attempts + 1 if _retry else 1
+    delay = min(REGION_RETRY_INTERVAL * 2 ** min(attempts - 1, 16), RECONCILE_INTERVAL)
+    logger.warning('{} regions failed, retrying them at {}'.format(len(failed_regions), timestamp + delay))
+    return _RegionRetry(sorted(failed_regions), attempts, timestamp + delay)
+
+def _get_deadline(context):
+    '''Return the time.monotonic() value a run must stop scanning at, None without a Lambda context'''
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return None
+    return time.monotonic() + context.get_remaining_time_in_millis() / 1000.0 - TIME_MARGIN
+
+def _invoke_self(context):
+    '''Invoke the running function asynchronously to resume the scan'''
+    logger.info('Function [{}]: invoking to resume the scan'.format(context.invoked_function_arn))
+    lambda_client = clients.get_client('lambda')
+    lambda_client.invoke(FunctionName = context.invoked_function_arn, InvocationType = 'Event',
+                         Payload = json.dumps({'resume': True}).encode('utf-8'))
+
+def _schedule_next_run(rule_name, transitions, timestamp, resume = False, retry_at = None):
+    '''
+    Move a CloudWatch Events rule to the minute of the next transition, or
+    the next reconciliation, or the retry of failed regions, or the next
+    minute to resume an incomplete run. The description and state of the
+    rule are read back first as put_rule replaces them.
+    '''
+    next_run = timestamp + RECONCILE_INTERVAL
+    if transitions.next_transition is not None:
+        next_run = min(next_run, transitions.next_transition)
+    if retry_at is not None:
+        next_run = min(next_run, retry_at)
+    # A resume, or a transition already passed by the earlier part of a resumed run, runs in the next minute
+    soonest = timestamp + datetime.timedelta(minutes = 1)
+    if resume or next_run < soonest:
+        next_run = soonest
+    expression = 'cron({} {} {} {} ? {})'.format(next_run.minute, next_run.hour, next_run.day, next_run.month, next_run.year)
+    logger.info('Rule [{}]: ScheduleExpression= {}'.format(rule_name, expression))
+    events = clients.get_client('events')
+    rule = events.describe_rule(Name = rule_name)
+    events.put_rule(Name = rule_name, ScheduleExpression = expression,
+                    Description = rule.get('Description', ''), State = rule.get('State', 'ENABLED'))
 
 if __name__ == '__main__':
-    run(None, None)
+    import sys
+
+    # Replay recorded events when event files are given, otherwise run a full scan
+    logger.addHandler(logging.StreamHandler())
+    for path in sys.argv[1:]:
+        with open(path) as f:
+            on_event(json.load(f), None)
+    if len(sys.argv) == 1:
+        run(None, None)
@@ -0,0 +1,121 @@
+import json
+import sys
+import time
+import threading
+import collections
+
+class Metrics:
+    '''
+    Timers and counters of a run, emitted as a single CloudWatch embedded
+    metric format (EMF) record.
+
+    Totals are published as metrics, the values of each region are added
+    to the record as a Regions property for CloudWatch Logs Insights.
+    A disabled Metrics object records nothing and emits nothing.
+
+    :param enabled: False to turn instrumentation off
+    :param namespace: CloudWatch metrics namespace
+    '''
+    NAMESPACE = 'InstanceScheduler'
+
+    def __init__(self, enabled = True, namespace = NAMESPACE):
+        self.enabled = enabled
+        self.namespace = namespace
+        self.counters = collections.Counter()
+        self.timers = collections.Counter()
+        self.regions = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value = 1, region = None):
+        '''Add value to a counter, and to the counter of a region when provided'''
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] += value
+            if region is not None:
+                self._region(region)[name] += value
+
+    def add_time(self, name, seconds, region = None):
+        '''Add seconds to a timer, and to the timer of a region when provided'''
+        if not self.enabled:
+            return
+        with self._lock:
+            self.timers[name] += seconds
+            if region is not None:
+                self._region(region)[name + 'Time'] += seconds * 1000
+
+    def timer(self, name, region = None):
+        '''Return a context manager adding the time spent in its block to a timer'''
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, region)
+
+    def _region(self, region):
+        values = self.regions.get(region)
+        if values is None:
+            values = self.regions[region] = collections.Counter()
+        return values
+
+    def to_emf(self, timestamp = None, properties = None):
+        '''
+        Return the embedded metric format record of the run
+
+        :param timestamp: seconds since the epoch, now by default
+        :param properties: optional dict of extra properties
+        '''
+        timestamp = time.time() if timestamp is None else timestamp
+        definitions = []
+        record = {}
+        for name, seconds in sorted(self.timers.items()):
+            definitions.append({'Name': name + 'Time', 'Unit': 'Milliseconds'})
+            record[name + 'Time'] = round(seconds * 1000, 3)
+        for name, value in sorted(self.counters.items()):
+            definitions.append({'Name': name, 'Unit': 'Count'})
+            record[name] = value
+        record['Regions'] = dict((region, dict((name, round(value, 3)) for name, value in values.items()))
+                                 for region, values in self.regions.items())
+        record.update(properties or {})
+        record['_aws'] = {
+            'Timestamp': int(timestamp * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': self.namespace,
+                'Dimensions': [[]],
+                'Metrics': definitions,
+            }],
+        }
+        return record
+
+    def emit(self, stream = None, properties = None):
+        '''Write the embedded metric format record as a single line, Lambda sends standard output to CloudWatch Logs'''
+        if not self.enabled:
+            return
+        stream = stream or sys.stdout
+        stream.write(json.dumps(self.to_emf(properties = properties), separators = (',', ':')) + '\n')
+        stream.flush()
+
+class _Timer:
+    __slots__ = ('metrics', 'name', 'region', 'start')
+
+    def __init__(self, metrics, name, region):
+        self.metrics = metrics
+        self.name = name
+        self.region = region
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.add_time(self.name, time.perf_counter() - self.start, self.region)
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+_NULL_TIMER = _NullTimer()
+
+# Shared default of the instrumented classes, records nothing
+DISABLED = Metrics(enabled = False)
@@ -0,0 +1,23 @@
+class LazyMessage:
+    '''
+    Log message formatted with str.format only when a handler emits it.
+
+    The logging module calls str on the message after checking the
+    level, so a disabled level costs the creation of this object only.
+    Arguments are still evaluated by the caller, guard expensive ones
+    with logger.isEnabledFor.
+
+    :param format: str.format format string
+    :param args: positional format arguments
+    '''
+    __slots__ = ('format', 'args')
+
+    def __init__(self, format, *args):
+        self.format = format
+        self.args = args
+
+    def __str__(self):
+        return self.format.format(*self.args)
+
+# logger.debug(lazy('Instance [{}]: {}', id, value))
+lazy = LazyMessage
@@ -0,0 +1,104 @@
+import json
+import sys
+import random
+import collections
+
+class PlanWriter:
+    '''
+    Writes scheduler.PlanEntry objects as JSON Lines as they are computed.
+
+    Entries are written and flushed one batch at a time so a plan is never
+    held in memory, only the number of entries per action is kept.
+
+    :param stream: writable text stream, standard output by default
+    :param timestamp: optional naive datetime.datetime in UTC of the evaluation
+    :param dry_run: True when the plan was not acted on
+    '''
+    def __init__(self, stream = None, timestamp = None, dry_run = False):
+        self.stream = stream or sys.stdout
+        self.timestamp = timestamp.isoformat() if timestamp else None
+        self.dry_run = dry_run
+        self.counts = collections.Counter()
+
+    def write(self, entries):
+        '''Write an iterable of PlanEntry, one JSON object per line'''
+        for entry in entries:
+            self.stream.write(json.dumps(self.to_dict(entry), separators = (',', ':')) + '\n')
+            self.counts[entry.action] += 1
+        self.stream.flush()
+
+    def to_dict(self, entry):
+        '''Return the JSON serialisable representation of a PlanEntry'''
+        return {
+            'timestamp': self.timestamp,
+            'dry_run': self.dry_run,
+            'id': entry.id,
+            'running': entry.running,
+            'target': entry.target,
+            'schedule': str(entry.schedule) if entry.schedule else None,
+            'action': entry.action,
+            'reason': entry.reason,
+        }
+
+    def close(self):
+        '''Close the stream unless it is standard output'''
+        if self.stream is not sys.stdout:
+            self.stream.close()
+
+    def summary(self):
+        '''Return the number of planned starts, stops and unchanged instances'''
+        return {
+            'start': self.counts['start'],
+            'stop': self.counts['stop'],
+            'unchanged': self.counts[None],
+        }
+
+def open_plan(path, timestamp = None, dry_run = False):
+    '''
+    Return a PlanWriter for a path, '-' writes to standard output and
+    None returns None.
+    '''
+    if path is None:
+        return None
+    if path == '-':
+        return PlanWriter(sys.stdout, timestamp, dry_run)
+    return PlanWriter(open(path, 'a'), timestamp, dry_run)
+
+class PlanSummary:
+    '''
+    Aggregated view of the plan of a run, logged once instead of a line
+    per instance.
+
+    Entries are counted by action and reason, each count keeps a uniform
+    random sample of instance ids (reservoir sampling) so a summary line
+    stays the same size for any fleet.
+
+    :param sample_size: instance ids kept per action and reason
+    :param rng: optional random.Random used for sampling
+    '''
+    SAMPLE_SIZE = 3
+
+    def __init__(self, sample_size = SAMPLE_SIZE, rng = None):
+        self.sample_size = sample_size
+        self.rng = rng or random.Random()
+        self.counts = collections.Counter()
+        self.samples = {}
+
+    def add(self, entries):
+        '''Count an iterable of scheduler.PlanEntry'''
+        for entry in entries:
+            key = (entry.action, entry.reason)
+            self.counts[key] += 1
+            sample = self.samples.setdefault(key, [])
+            if len(sample) < self.sample_size:
+                sample.append(entry.id)
+            else:
+                index = self.rng.randrange(self.counts[key])
+                if index < self.sample_size:
+                    sample[index] = entry.id
+
+    def __str__(self):
+        parts = []
+        for (action, reason), count in sorted(self.counts.items(), key = lambda item: (item[0][0] or '', item[0][1])):
+            parts.append('{} ({}): {} e.g. {}'.format(action or 'none', reason, count, ', '.join(str(id) for id in self.samples[(action, reason)])))
+        return '{} instances evaluated; {}'.format(sum(self.counts.values()), '; '.join(parts))
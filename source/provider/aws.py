@@ -1,32 +1,174 @@
 import logging
 import json
-import boto3
+import collections
 
-logging.getLogger('boto3').setLevel(logging.ERROR)
-logging.getLogger('botocore').setLevel(logging.ERROR)
+import clients
+import instrumentation
+
+from executor import Executor, Task, is_client_error, is_throttled
 
 logger = logging.getLogger()
 
+# Outcome of an action sent by a Dispatcher
+#   id: instance id in <REGION>:<INSTANCE_ID> or <ACCOUNT>:<REGION>:<INSTANCE_ID> format
+#   action: Dispatcher.START or Dispatcher.STOP
+#   outcome: True or the error
+#   latency: seconds taken by the API call of the instance's batch, including backoff
+#   attempts: number of calls made for the batch
+ActionReport = collections.namedtuple('ActionReport', ['id', 'action', 'outcome', 'latency', 'attempts'])
+
 class EC2:
     '''
     AWS provider that knows how to start and stop EC2 instances.
 
-    :param id: EC2 instance id in <REGION>:<INSTANCE_ID> format
+    When a dispatcher is provided the start and stop requests are queued
+    on it and sent in batches, otherwise they are sent straight away.
+
+    Instances of other accounts carry the account in their id, their
+    requests are sent with the clients of that account.
+
+    :param id: EC2 instance id in <REGION>:<INSTANCE_ID> format, or
+        <ACCOUNT>:<REGION>:<INSTANCE_ID> for another account
+    :param dispatcher: optional provider.aws.Dispatcher object
     '''
 
-    def __init__(self, id):
+    def __init__(self, id, dispatcher = None):
         self.id = id
+        self.dispatcher = dispatcher
 
     def stop(self):
-        ec2 = boto3.client('ec2', region_name = self._get_region())
-        ec2.stop_instances(InstanceIds = [self._get_instance_id()])
+        if self.dispatcher:
+            self.dispatcher.add(self.id, Dispatcher.STOP)
+        else:
+            ec2 = clients.region_client(clients.get_client, 'ec2', self._get_region())
+            ec2.stop_instances(InstanceIds = [self._get_instance_id()])
 
     def start(self):
-        ec2 = boto3.client('ec2', region_name = self._get_region())
-        ec2.start_instances(InstanceIds = [self._get_instance_id()])
+        if self.dispatcher:
+            self.dispatcher.add(self.id, Dispatcher.START)
+        else:
+            ec2 = clients.region_client(clients.get_client, 'ec2', self._get_region())
+            ec2.start_instances(InstanceIds = [self._get_instance_id()])
 
     def _get_region(self):
-        return self.id.split(':')[0]
+        '''Return the region key of the instance, <ACCOUNT>:<REGION> for another account'''
+        return self.id.rsplit(':', 1)[0]
 
     def _get_instance_id(self):
-        return self.id.split(':')[1]
+        return self.id.rsplit(':', 1)[1]
+
+
+class Dispatcher:
+    '''
+    Collects EC2 start and stop requests and sends them in batches grouped
+    by region, account and action.
+
+    Adding an action only records it, flush sends the batches through an
+    executor.Executor with bounded parallelism, rate limiting and backoff
+    on throttling. A batch rejected for another reason is retried one
+    instance at a time so one bad instance does not fail the others.
+
+    The outcome of every instance is recorded in results, True when the
+    instance is reported back in the API response, otherwise the error.
+    reports holds an ActionReport with the latency of every instance.
+
+    :param batch_size: maximum number of instance ids per API call
+    :param client_factory: callable returning an EC2 client, boto3.client signature
+    :param executor: optional executor.Executor, its send callable is replaced
+    :param metrics: optional instrumentation.Metrics recording API latency and actions
+    '''
+    START = 'start'
+    STOP = 'stop'
+
+    # Maximum number of instance ids sent in a single API call
+    MAX_BATCH_SIZE = 1000
+
+    _OPERATIONS = {
+        START: ('start_instances', 'StartingInstances'),
+        STOP: ('stop_instances', 'StoppingInstances'),
+    }
+
+    # Metrics counter of the instances changed by each action
+    _COUNTERS = {
+        START: 'InstancesStarted',
+        STOP: 'InstancesStopped',
+    }
+
+    def __init__(self, batch_size = MAX_BATCH_SIZE, client_factory = None, executor = None, metrics = None):
+        if not 0 < batch_size <= Dispatcher.MAX_BATCH_SIZE:
+            raise ValueError('batch_size must be between 1 and {}'.format(Dispatcher.MAX_BATCH_SIZE))
+        self.batch_size = batch_size
+        self.client_factory = client_factory or clients.get_client
+        self.executor = executor or Executor(None)
+        self.executor.send = self._send
+        self.metrics = metrics or instrumentation.DISABLED
+        self.results = {}
+        self.reports = []
+        self._batches = {}
+
+    def add(self, id, action):
+        '''Queue an action for an instance in <REGION>:<INSTANCE_ID> or <ACCOUNT>:<REGION>:<INSTANCE_ID> format'''
+        if action not in Dispatcher._OPERATIONS:
+            raise ValueError('invalid action "{}"'.format(action))
+
+        region, instance_id = id.rsplit(':', 1)
+        self._batches.setdefault((region, action), []).append(instance_id)
+
+    def plan(self):
+        '''Return the queued actions as a list of executor.Task, one per API call'''
+        tasks = []
+        for (region, action), instance_ids in sorted(self._batches.items()):
+            for i in range(0, len(instance_ids), self.batch_size):
+                tasks.append(Task(region, action, instance_ids[i:i + self.batch_size]))
+        return tasks
+
+    def flush(self):
+        '''Send all queued actions and return the results'''
+        tasks = self.plan()
+        self._batches = {}
+
+        while tasks:
+            retries = []
+            for result in self.executor.run(tasks):
+                task = result.task
+                self.metrics.increment('ChangeStateRetries', result.attempts - 1, task.region)
+                if is_client_error(result.outcome) and not is_throttled(result.outcome) and len(task.instance_ids) > 1:
+                    logger.warning('Region [{}]: {} of {} instances failed, retrying individually: {}'.format(task.region, task.action, len(task.instance_ids), result.outcome))
+                    retries.extend(Task(task.region, task.action, [instance_id]) for instance_id in task.instance_ids)
+                    continue
+                for instance_id in task.instance_ids:
+                    if isinstance(result.outcome, Exception):
+                        outcome = result.outcome
+                    else:
+                        outcome = result.outcome[instance_id]
+                    self._record(task, instance_id, outcome, result)
+            tasks = retries
+
+        return self.results
+
+    def _send(self, task):
+        '''Make the API call of a task and return the outcome of each instance'''
+        operation, response_key = Dispatcher._OPERATIONS[task.action]
+        ec2 = clients.region_client(self.client_factory, 'ec2', task.region)
+        with self.metrics.timer('ChangeState', task.region):
+            response = getattr(ec2, operation)(InstanceIds = task.instance_ids)
+        self.metrics.increment('ChangeStateCalls', region = task.region)
+
+        changed = set(item['InstanceId'] for item in response.get(response_key, []))
+        outcomes = {}
+        for instance_id in task.instance_ids:
+            if instance_id in changed:
+                outcomes[instance_id] = True
+            else:
+                outcomes[instance_id] = 'not reported in {} response'.format(operation)
+        return outcomes
+
+    def _record(self, task, instance_id, outcome, result):
+        id = task.region + ':' + instance_id
+        if outcome is not True:
+            logger.error('Instance [{}]: {}'.format(id, outcome))
+            self.metrics.increment('ActionsFailed', region = task.region)
+        else:
+            self.metrics.increment(Dispatcher._COUNTERS[task.action], region = task.region)
+        self.results[id] = outcome
+        self.reports.append(ActionReport(id, task.action, outcome, result.latency, result.attempts))
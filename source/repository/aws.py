@@ -1,13 +1,23 @@
+import re
 import logging
 import json
-import boto3
+import time
+import queue
+import datetime
+import threading
+import concurrent.futures
 
+import clients
+import shards
+import snapshot
+import instrumentation
 import provider.aws
 
-from scheduler import Schedule, Instance
+import scheduler
 
-logging.getLogger('boto3').setLevel(logging.ERROR)
-logging.getLogger('botocore').setLevel(logging.ERROR)
+from executor import is_client_error
+from logs import lazy
+from scheduler import Instance
 
 logger = logging.getLogger()
 
@@ -15,53 +25,442 @@ class EC2():
     '''
     AWS repository that knows how to retrieve scheduled EC2 instances.
 
-    :param start_time: datetime.time object in HH:MM format
-    :param stop_time: datetime.time object in HH:MM format
-    :param time_zone: datetime.tzinfo object
-    :param days: set of Day enums
+    Regions are scanned concurrently, a region that fails or does not
+    answer within region_timeout is logged and skipped so it does not
+    prevent instances in other regions from being scheduled.
+
+    The regions of other accounts are scanned alongside those of the
+    account the function runs in. They are keyed <ACCOUNT>:<REGION> and
+    their instance ids are <ACCOUNT>:<REGION>:<INSTANCE_ID>.
+
+    :param max_workers: maximum number of regions scanned at the same time
+    :param region_timeout: seconds to wait for the next page of a region
+    :param page_size: describe_instances MaxResults per page, 5 to 1000
+    :param client_factory: callable returning an EC2 client, boto3.client signature
+    :param dispatcher: optional provider.aws.Dispatcher used to batch start and stop actions
+    :param exclude_tags: tag keys that exclude an instance from scheduling
+    :param previous: optional snapshot.Snapshot of the previous run, schedules
+        of instances whose tag did not change are not parsed again
+    :param metrics: optional instrumentation.Metrics recording API latency and instance counts
+    :param accounts: ids of other accounts to scan, their clients are
+        requested from client_factory with an account keyword, see
+        clients.ClientPool.set_roles
+    :param shard: optional (index, count) tuple, only the instances whose id
+        hashes to index are scheduled, see shards.in_shard
+    :param regions: optional list of region names scanned in every account
+        instead of the regions describe_regions returns
     '''
     SCHEDULE_TAG = 'Schedule'
 
-    def __init__(self):
-        pass
+    # Instance states requested from describe_instances
+    SCHEDULABLE_STATES = ['pending', 'running', 'stopping', 'stopped']
+
+    # States an instance can be started or stopped from, state changes to
+    # pending or stopping are ignored by apply_event
+    SETTLED_STATES = ('running', 'stopped')
+
+    # Instances carrying any of these tags are managed elsewhere and ignored
+    EXCLUDE_TAGS = ('aws:autoscaling:groupName',)
+
+    MAX_WORKERS = 8
+    REGION_TIMEOUT = 60
+    PAGE_SIZE = 500
+
+    # detail-type of the events handled by apply_event
+    STATE_CHANGE_EVENT = 'EC2 Instance State-change Notification'
+    TAG_CHANGE_EVENT = 'Tag Change on Resource'
+
+    # Messages passed from the region workers to iter_scheduled_instances
+    _STARTED = 'started'
+    _PAGE = 'page'
+    _DONE = 'done'
+
+    def __init__(self, max_workers = MAX_WORKERS, region_timeout = REGION_TIMEOUT, page_size = PAGE_SIZE, client_factory = None, dispatcher = None, exclude_tags = EXCLUDE_TAGS, previous = None, metrics = None, accounts = None, shard = None, regions = None):
+        self.max_workers = max_workers
+        self.region_timeout = region_timeout
+        self.page_size = page_size
+        self.client_factory = client_factory or clients.get_client
+        self.dispatcher = dispatcher
+        self.exclude_tags = frozenset(exclude_tags)
+        self.previous = previous or snapshot.Snapshot()
+        self.metrics = metrics or instrumentation.DISABLED
+        self.accounts = list(accounts or [])
+        self.shard = shard
+        self.regions = list(regions) if regions is not None else None
+        # Accounts get_regions could not reach
+        self.unreachable = []
+        # Schedules rebuilt from the previous snapshot, shared by equal entries
+        self._compact_schedules = {}
+        # Regions scanned completely by iter_scheduled_instances
+        self.snapshot = snapshot.Snapshot()
+        # Regions left to scan when iter_scheduled_instances stopped at its deadline
+        self.cursor = {}
+        # Regions that failed or timed out in iter_scheduled_instances
+        self.failed_regions = []
 
     def get_scheduled_instances(self):
-        instances = []
+        '''Return a list of all scheduled instances'''
+        return list(self.iter_scheduled_instances())
 
-        ec2 = boto3.client('ec2')
-        regions = [region['RegionName'] for region in ec2.describe_regions()['Regions']]
-
-        for region in regions:
-            ec2 = boto3.client('ec2', region_name = region)
-            # TODO: Add filters to ignore the following instances
-            #   Instance State = shutting-down or terminated
-            #   Instances in auto-scaling groups
-            filters = [
-                {
-                    'Name': 'tag-key',
-                    'Values': [
-                        EC2.SCHEDULE_TAG
-                    ]
-                }
-            ]
-            result = ec2.describe_instances(Filters = filters)
-
-            # TODO: Get rid of this double 'for' loop
-            for reservation in result['Reservations']:
-                for ec2_instance in reservation['Instances']:
-                    id = region + ':' + ec2_instance['InstanceId']
-                    running = self._get_state(ec2_instance['State'])
-                    schedule = self._get_schedule(ec2_instance['Tags'])
-                    logger.info('Instance [{}]: Running= {} Schedule= {}'.format(id, running, schedule))
-                    # Ignore instances that are not running or stopped
-                    if running != None:
-                        try:
-                            instances.append(Instance(id, running, Schedule.from_string(schedule), provider.aws.EC2(id)))
-                        except Exception as e:
-                            logger.error('Instance [{}]: {}'.format(id, e))
+    def iter_scheduled_instances(self, deadline = None, cursor = None):
+        '''
+        Generate scheduled instances as describe_instances pages arrive.
+
+        Instances are yielded while later pages and other regions are still
+        being fetched, so callers can start evaluating schedules straight
+        away. A region is dropped if it does not return a page within
+        region_timeout seconds.
+
+        Regions that fail or time out are recorded in self.failed_regions,
+        their previous snapshot is kept with the pages already yielded.
+
+        Once deadline passes no further page is yielded and the regions
+        left to scan are recorded in self.cursor with the token of their
+        next page, a later call given that cursor yields each remaining
+        instance once.
+
+        :param deadline: optional time.monotonic() value to stop at
+        :param cursor: optional dict of region name to the describe_instances
+            token to resume from, None to scan the region from its first page.
+            Only these regions are scanned, all regions when cursor is None.
+        '''
+        if cursor is not None:
+            regions = list(cursor)
+        else:
+            regions = self.get_regions()
+            cursor = dict((region, None) for region in regions)
+        scanned = datetime.datetime.utcnow()
+        region_snapshots = dict((region, snapshot.RegionSnapshot(scanned)) for region in regions)
+        self.cursor = {}
+        self.failed_regions = []
+
+        pages = queue.Queue()
+        cancelled = threading.Event()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers = self.max_workers)
+        try:
+            for region in regions:
+                executor.submit(self._scan_region, region, region_snapshots[region], pages, cancelled, cursor[region])
+
+            # Regions still being scanned and the time they last made progress
+            pending = set(regions)
+            active = {}
+            # Token of the next page of each region after the pages already yielded,
+            # and the regions whose last page was yielded
+            tokens = dict(cursor)
+            exhausted = set()
+            while pending:
+                if deadline is not None and time.monotonic() >= deadline:
+                    self._stop_at_deadline(pending, tokens, exhausted, cursor, region_snapshots)
+                    break
+                try:
+                    message, region, payload = pages.get(timeout = self._poll_timeout(active, deadline))
+                except queue.Empty:
+                    # Nothing arrived, drop the regions that have been idle too long
+                    now = time.time()
+                    for region, last_seen in list(active.items()):
+                        if now - last_seen >= self.region_timeout:
+                            logger.error('Region [{}]: timed out after {} seconds'.format(region, self.region_timeout))
+                            self._fail_region(region, region_snapshots)
+                            pending.discard(region)
+                            del active[region]
+                    continue
+
+                if message == EC2._STARTED and region in pending:
+                    active[region] = time.time()
+                elif message == EC2._PAGE and region in pending:
+                    active[region] = time.time()
+                    instances, tokens[region] = payload
+                    for instance in instances:
+                        yield instance
+                    if tokens[region] is None:
+                        exhausted.add(region)
+                elif message == EC2._DONE and region in pending:
+                    if payload is not None:
+                        logger.error('Region [{}]: {}'.format(region, payload))
+                        self._fail_region(region, region_snapshots)
+                    elif cursor[region] is not None:
+                        # Earlier pages of a resumed region were scanned by a previous call
+                        self.snapshot.regions[region] = self._merge_region(region, region_snapshots[region])
+                    else:
+                        self.snapshot.regions[region] = region_snapshots[region]
+                    pending.discard(region)
+                    active.pop(region, None)
+        finally:
+            # Stop the workers and do not wait on regions that timed out
+            cancelled.set()
+            executor.shutdown(wait = False)
+
+    def _poll_timeout(self, active, deadline = None):
+        '''Seconds until the next active region would time out or the deadline passes'''
+        timeout = self.region_timeout
+        if active:
+            timeout = max(0, min(active.values()) + self.region_timeout - time.time())
+        if deadline is not None:
+            timeout = max(0, min(timeout, deadline - time.monotonic()))
+        return timeout
+
+    def _stop_at_deadline(self, pending, tokens, exhausted, cursor, region_snapshots):
+        '''Record the regions left to scan in self.cursor, keeping what was already scanned'''
+        for region in pending:
+            if region in exhausted and cursor[region] is None:
+                self.snapshot.regions[region] = region_snapshots[region]
+                continue
+            self.snapshot.regions[region] = self._merge_region(region, region_snapshots[region])
+            if region not in exhausted:
+                self.cursor[region] = tokens[region]
+        logger.warning('Deadline reached, {} regions left to scan'.format(len(self.cursor)))
+
+    def _fail_region(self, region, region_snapshots):
+        '''Record a region that failed in self.failed_regions, keeping the pages already yielded'''
+        self.failed_regions.append(region)
+        if region_snapshots[region].instances:
+            self.snapshot.regions[region] = self._merge_region(region, region_snapshots[region])
+
+    def _merge_region(self, region, region_snapshot):
+        '''Return the previous snapshot of a partially scanned region updated with region_snapshot'''
+        previous = self.previous.regions.get(region)
+        if previous is None:
+            return snapshot.RegionSnapshot(snapshot.NEVER_SCANNED, dict(region_snapshot.instances))
+        instances = dict(previous.instances)
+        instances.update(region_snapshot.instances)
+        return snapshot.RegionSnapshot(previous.scanned, instances)
+
+    def get_regions(self):
+        '''
+        Return the names of all regions available to the account, followed
+        by the <ACCOUNT>:<REGION> keys of the other accounts. An account
+        that can not be reached is logged, recorded in self.unreachable and
+        skipped. With a regions allow-list no region is described.
+        '''
+        self.unreachable = []
+        if self.regions is not None:
+            return self.regions + [account + ':' + region for account in self.accounts for region in self.regions]
+        regions = self._describe_regions(None)
+        if not self.accounts:
+            return regions
+        # Each account assumes its role on the first call, reach them concurrently
+        with concurrent.futures.ThreadPoolExecutor(max_workers = self.max_workers) as executor:
+            futures = [executor.submit(self._describe_regions, account) for account in self.accounts]
+            for account, future in zip(self.accounts, futures):
+                try:
+                    regions.extend(account + ':' + region for region in future.result())
+                except Exception as e:
+                    logger.error('Account [{}]: {}'.format(account, e))
+                    self.unreachable.append(account)
+        return regions
+
+    def _describe_regions(self, account):
+        '''Return the region names of an account, None for the account the function runs in'''
+        if account is None:
+            ec2 = self.client_factory('ec2')
+        else:
+            ec2 = self.client_factory('ec2', account = account)
+        with self.metrics.timer('DescribeRegions'):
+            return [region['RegionName'] for region in ec2.describe_regions()['Regions']]
+
+    def _scan_region(self, region, region_snapshot, pages, cancelled, starting_token = None):
+        '''Put the scheduled instances of a region and the next page token on the pages queue, a page at a time'''
+        error = None
+        pages.put((EC2._STARTED, region, None))
+        try:
+            for page in self._get_region_pages(region, region_snapshot, starting_token):
+                if cancelled.is_set():
+                    break
+                pages.put((EC2._PAGE, region, page))
+        except Exception as e:
+            error = e
+        finally:
+            pages.put((EC2._DONE, region, error))
+
+    def _get_region_pages(self, region, region_snapshot, starting_token = None):
+        '''
+        Generate a tuple of (scheduled instances, next page token or None)
+        for each describe_instances page of a region
+        '''
+        ec2 = clients.region_client(self.client_factory, 'ec2', region)
+        # Only instances that can be started or stopped are returned
+        filters = [
+            {
+                'Name': 'tag-key',
+                'Values': [
+                    EC2.SCHEDULE_TAG
+                ]
+            },
+            {
+                'Name': 'instance-state-name',
+                'Values': EC2.SCHEDULABLE_STATES
+            }
+        ]
+        # Tokens are the raw NextToken of the service, a paginator would read them as its own StartingToken format
+        kwargs = {'Filters': filters, 'MaxResults': self.page_size}
+        token = starting_token
+        while True:
+            if token:
+                kwargs['NextToken'] = token
+            # Each page is a describe_instances call, time it on its own
+            with self.metrics.timer('DescribeInstances', region):
+                result = ec2.describe_instances(**kwargs)
+            self.metrics.increment('DescribeInstancesCalls', region = region)
+            token = result.get('NextToken') or None
+            yield self._get_page_instances(region, result, region_snapshot), token
+            if token is None:
+                break
+
+    def _get_page_instances(self, region, result, region_snapshot):
+        '''Return the scheduled instances of a describe_instances page and record them in region_snapshot'''
+        ec2_instances = [ec2_instance for reservation in result['Reservations'] for ec2_instance in reservation['Instances']]
+        return self._get_instances(region, ec2_instances, region_snapshot)
+
+    def _get_instances(self, region, ec2_instances, region_snapshot):
+        '''
+        Return the scheduled instances of a list of dicts with the InstanceId,
+        State and Tags of describe_instances and record them in region_snapshot
+        '''
+        instances = []
+        for ec2_instance in ec2_instances:
+            # Instances of other hash shards are left to their own worker
+            if self.shard is not None and not shards.in_shard(ec2_instance['InstanceId'], *self.shard):
+                continue
+            id = region + ':' + ec2_instance['InstanceId']
+            # EC2 filters can not exclude a tag key, skip excluded instances before parsing
+            if self._is_excluded(ec2_instance['Tags']):
+                logger.debug(lazy('Instance [{}]: excluded by tag', id))
+                continue
+            running = self._get_state(ec2_instance['State'])
+            schedule = self._get_schedule(ec2_instance['Tags'])
+            logger.debug(lazy('Instance [{}]: Running= {} Schedule= {}', id, running, schedule))
+            # Ignore instances that are not running or stopped
+            if running != None:
+                compiled = self._get_compiled_schedule(id, schedule)
+                region_snapshot.instances[ec2_instance['InstanceId']] = snapshot.InstanceEntry(
+                    running, snapshot.tag_hash(schedule), compiled.to_compact() if compiled else None)
+                if compiled:
+                    instances.append(Instance(id, running, compiled, provider.aws.EC2(id, self.dispatcher)))
 
+        self.metrics.increment('InstancesScanned', len(ec2_instances), region)
+        self.metrics.increment('InstancesScheduled', len(instances), region)
         return instances
 
+    def apply_event(self, event):
+        '''
+        Update the previous snapshot from an EC2 instance state-change or
+        tag change event and return the affected scheduled Instance.
+
+        Only the instance named in the event is looked at, an instance that
+        is not in the snapshot is described with a single API call.
+
+        A change to a transient state, pending or stopping, leaves the
+        snapshot as is, the instance is updated once it settled.
+
+        :param event: CloudWatch Events event dict
+        :rtype: tuple of (region key, Instance or None), (None, None) if the
+            event is not a supported event
+        '''
+        region, instance_id = self.get_event_instance(event)
+        if region is None:
+            logger.warning('Unsupported event: {}'.format(event.get('detail-type')))
+            return None, None
+
+        detail_type = event['detail-type']
+        detail = event['detail']
+        id = region + ':' + instance_id
+        if detail_type == EC2.STATE_CHANGE_EVENT:
+            tags = None
+            running = self._get_state({'Name': detail['state']})
+            if running is not None and detail['state'] not in EC2.SETTLED_STATES:
+                logger.debug('Instance [{}]: {}, waiting for a settled state'.format(id, detail['state']))
+                return region, None
+        else:
+            tags = [{'Key': key, 'Value': value} for key, value in detail.get('tags', {}).items()]
+            running = None
+
+        region_snapshot = self.previous.regions.setdefault(region, snapshot.RegionSnapshot(snapshot.NEVER_SCANNED))
+        entry = region_snapshot.instances.get(instance_id)
+
+        if tags is None and entry is None:
+            # State change of an instance that is not known to be scheduled
+            logger.debug('Instance [{}]: not in snapshot, ignoring state change'.format(id))
+            return region, None
+
+        if detail_type == EC2.TAG_CHANGE_EVENT:
+            if self._is_excluded(tags) or self._get_schedule(tags) is None:
+                region_snapshot.instances.pop(instance_id, None)
+                logger.info('Instance [{}]: no longer scheduled'.format(id))
+                return region, None
+            schedule = self._get_schedule(tags)
+            running = entry.running if entry is not None else self._describe_state(region, instance_id)
+            compiled = self._get_compiled_schedule(id, schedule)
+            hash_value = snapshot.tag_hash(schedule)
+        else:
+            compiled = scheduler.Schedule.from_compact(entry.schedule) if entry.schedule else None
+            hash_value = entry.tag_hash
+
+        if running is None:
+            region_snapshot.instances.pop(instance_id, None)
+            logger.info('Instance [{}]: terminated'.format(id))
+            return region, None
+
+        region_snapshot.instances[instance_id] = snapshot.InstanceEntry(running, hash_value, compiled.to_compact() if compiled else None)
+        logger.info('Instance [{}]: Running= {} Schedule= {}'.format(id, running, compiled))
+        if compiled is None:
+            return region, None
+        return region, Instance(id, running, compiled, provider.aws.EC2(id, self.dispatcher))
+
+    def get_event_instance(self, event):
+        '''
+        Return the (region key, instance id) an EC2 instance state-change or
+        tag change event is about, (None, None) for other events
+        '''
+        detail_type = event.get('detail-type')
+        detail = event.get('detail', {})
+        if detail_type == EC2.STATE_CHANGE_EVENT:
+            instance_id = detail['instance-id']
+        elif detail_type == EC2.TAG_CHANGE_EVENT and detail.get('resource-type') == 'instance':
+            instance_id = event['resources'][0].split('/')[-1]
+        else:
+            return None, None
+        region = event.get('region')
+        if event.get('account') in self.accounts:
+            region = event['account'] + ':' + region
+        return region, instance_id
+
+    def _describe_state(self, region, instance_id):
+        '''Return the running state of a single instance, None if it no longer exists'''
+        ec2 = clients.region_client(self.client_factory, 'ec2', region)
+        result = ec2.describe_instances(InstanceIds = [instance_id])
+        for reservation in result['Reservations']:
+            for ec2_instance in reservation['Instances']:
+                return self._get_state(ec2_instance['State'])
+        return None
+
+    def _get_compiled_schedule(self, id, schedule):
+        '''
+        Return the Schedule of an instance or None if it is invalid, reusing
+        the previous snapshot when the tag value did not change.
+        '''
+        entry = self.previous.get(id)
+        if entry is not None and entry.tag_hash == snapshot.tag_hash(schedule):
+            if entry.schedule is None:
+                return None
+            compiled = self._compact_schedules.get(entry.schedule)
+            if compiled is not None:
+                self.metrics.increment('SnapshotSchedulesReused')
+                return compiled
+            try:
+                compiled = self._compact_schedules[entry.schedule] = scheduler.Schedule.from_compact(entry.schedule)
+                self.metrics.increment('SnapshotSchedulesReused')
+                return compiled
+            except (TypeError, ValueError) as e:
+                logger.debug(lazy('Instance [{}]: invalid snapshot schedule {}', id, e))
+
+        try:
+            with self.metrics.timer('ScheduleParse'):
+                return scheduler.get_schedule(schedule)
+        except ValueError as e:
+            # The cache logs each invalid schedule string once
+            logger.debug(lazy('Instance [{}]: {}', id, e))
+            return None
+
     def _get_state(self, ec2_state):
         '''Return the running state of an EC2 instances, True, False or None'''
         state_map = {
@@ -76,6 +475,13 @@ class EC2():
 
         return state_map[ec2_state['Name']]
 
+    def _is_excluded(self, tags):
+        '''Return True if any of the instance tags is an excluded tag key'''
+        for tag in tags:
+            if tag['Key'] in self.exclude_tags:
+                return True
+        return False
+
     def _get_schedule(self, tags):
         '''Return the schedule string from a set of instance tags'''
         schedule = None
@@ -85,3 +491,84 @@ class EC2():
                 schedule = tag['Value'].strip()
 
         return schedule
+
+class TaggedEC2(EC2):
+    '''
+    AWS repository that finds scheduled EC2 instances with the Resource
+    Groups Tagging API.
+
+    Each region is paged through with tag:GetResources, which only returns
+    the ARN and tags of the instances carrying the schedule tag. The state
+    of the instances of a page is then fetched with a single
+    DescribeInstanceStatus call instead of full instance descriptions.
+    Scanning, cursors, snapshots and events behave as with EC2, the cursor
+    holds GetResources pagination tokens.
+
+    Takes the parameters of EC2, page_size is capped at PAGE_LIMIT.
+    '''
+    # Most resources a GetResources page and instance ids a DescribeInstanceStatus call take
+    PAGE_LIMIT = 100
+
+    RESOURCE_TYPE = 'ec2:instance'
+
+    # Instance ids named by an InvalidInstanceID.NotFound error
+    _INSTANCE_ID = re.compile(r'i-[0-9a-f]+')
+
+    def _get_region_pages(self, region, region_snapshot, starting_token = None):
+        '''
+        Generate a tuple of (scheduled instances, next page token or None)
+        for each GetResources page of a region
+        '''
+        tagging = clients.region_client(self.client_factory, 'resourcegroupstaggingapi', region)
+        ec2 = clients.region_client(self.client_factory, 'ec2', region)
+        # Tokens are the raw PaginationToken of the service, a paginator would read them as its own StartingToken format
+        kwargs = {
+            'TagFilters': [{'Key': EC2.SCHEDULE_TAG}],
+            'ResourceTypeFilters': [TaggedEC2.RESOURCE_TYPE],
+            'ResourcesPerPage': min(self.page_size, TaggedEC2.PAGE_LIMIT),
+        }
+        token = starting_token
+        while True:
+            if token:
+                kwargs['PaginationToken'] = token
+            with self.metrics.timer('GetResources', region):
+                result = tagging.get_resources(**kwargs)
+            self.metrics.increment('GetResourcesCalls', region = region)
+            tags = {}
+            for mapping in result['ResourceTagMappingList']:
+                instance_id = mapping['ResourceARN'].split('/')[-1]
+                # Instances of other hash shards are not described
+                if self.shard is None or shards.in_shard(instance_id, *self.shard):
+                    tags[instance_id] = mapping['Tags']
+            ec2_instances = [
+                {'InstanceId': instance_id, 'State': state, 'Tags': tags[instance_id]}
+                for instance_id, state in self._describe_status(ec2, region, list(tags))
+            ]
+            # The last page has an empty token
+            token = result.get('PaginationToken') or None
+            yield self._get_instances(region, ec2_instances, region_snapshot), token
+            if token is None:
+                break
+
+    def _describe_status(self, ec2, region, instance_ids):
+        '''
+        Return (instance id, state) tuples of the instances that still exist,
+        the tags of terminated instances are returned by GetResources for a while
+        '''
+        statuses = []
+        while instance_ids:
+            try:
+                with self.metrics.timer('DescribeInstanceStatus', region):
+                    result = ec2.describe_instance_status(InstanceIds = instance_ids, IncludeAllInstances = True)
+            except Exception as e:
+                if not is_client_error(e) or e.response.get('Error', {}).get('Code') != 'InvalidInstanceID.NotFound':
+                    raise
+                missing = set(TaggedEC2._INSTANCE_ID.findall(e.response['Error'].get('Message', ''))) & set(instance_ids)
+                if not missing:
+                    raise
+                logger.debug(lazy('Region [{}]: {} tagged instances no longer exist', region, len(missing)))
+                instance_ids = [instance_id for instance_id in instance_ids if instance_id not in missing]
+                continue
+            statuses.extend((status['InstanceId'], status['InstanceState']) for status in result['InstanceStatuses'])
+            break
+        return statuses
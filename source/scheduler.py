@@ -2,11 +2,29 @@ import logging
 import enum
 import datetime
 import re
-import time
-import pytz
+import bisect
+import functools
+import threading
+import collections
+
+import zones
+
+from logs import lazy
 
 logger = logging.getLogger()
 
+# Whitespace is ignored anywhere in a schedule string
+_WHITESPACE = re.compile(r'\s')
+
+# Start and stop times in H:M format, one or two digits each
+_TIME = re.compile(r'(\d{1,2}):(\d{1,2})')
+
+# Windows of the extended format, H:M-H:M
+_WINDOW = re.compile(r'(\d{1,2}:\d{1,2})-(\d{1,2}:\d{1,2})')
+
+_DAY_MINUTES = 24 * 60
+_WEEK_MINUTES = 7 * _DAY_MINUTES
+
 class Day(enum.IntEnum):
     '''
     Day enumeration based on datetime.date.weekday()
@@ -16,104 +34,313 @@ class Day(enum.IntEnum):
     Wed = 2
     Thu = 3
     Fri = 4
-    Sat = 6
-    Sun = 7
+    Sat = 5
+    Sun = 6
 
 class Schedule:
     '''
-    Weekly schedule that can evaluate a target state against a timestamp.
+    Immutable weekly schedule that can evaluate a target state against a
+    timestamp.
+
+    A schedule is a set of start/stop windows per day. The original format
+    has one start and stop time shared by its days, either may be unset:
+
+        08:00;18:00;Europe/London;Mon,Tue,Wed,Thu,Fri
+
+    The extended format has several windows per day, windows that stop
+    the next day when their stop is not after their start, and per-day
+    overrides of the windows, NONE for no window:
+
+        08:00-12:00,13:00-18:00;Europe/London;Mon,Tue,Wed,Thu,Fri;Fri=08:00-16:00
+        22:00-06:00;UTC;Mon,Tue,Wed,Thu;Sat,Sun=10:00-14:00;Wed=NONE
+
+    Times are stored as minutes since midnight and the windows compiled
+    into a sorted table of minutes of the week and the target from each
+    of them, evaluated with a binary search. Schedules are hashable and
+    can be shared between instances.
 
     :param start_time: datetime.time object in HH:MM format
     :param stop_time: datetime.time object in HH:MM format
     :param time_zone: datetime.tzinfo object
     :param days: set of Day enums
     '''
+    __slots__ = ('_windows', '_time_zone', '_start', '_stop', '_days', '_points', '_targets', '_day_transitions')
+
     def __init__(self, start_time, stop_time, time_zone, days):
-        self.start_time = start_time
-        self.stop_time = stop_time
+        if not self._is_validate_time_property(start_time):
+            raise TypeError('start_time must be a datetime.time object')
+        if not self._is_validate_time_property(stop_time):
+            raise TypeError('stop_time must be a datetime.time object')
 
-        self._validate_start_stop()
+        self._validate_start_stop(start_time, stop_time)
 
-        self.time_zone = time_zone
-        self.days = days
+        error_message = 'days must be a set of scheduler.Days'
+        if not isinstance(days, (set, frozenset)):
+            raise TypeError(error_message)
+        for item in days:
+            if not isinstance(item, Day):
+                raise TypeError(error_message)
+
+        window = ((self._to_minutes(start_time), self._to_minutes(stop_time)),)
+        mask = sum(1 << day for day in days)
+        self._initialize(tuple(window if mask >> day & 1 else () for day in range(7)), time_zone)
+
+    @classmethod
+    def from_windows(cls, windows, time_zone):
+        '''
+        Build a Schedule object from start/stop windows per day.
+
+        A window whose stop is not after its start stops the next day.
+        Windows that overlap, on one day or across midnight, act as one.
+
+        :param: cls: Schedule class
+        :param: windows: dict of Day to iterable of (start, stop) datetime.time tuples
+        :param: time_zone: datetime.tzinfo object
+        ;rtype: Schedule object
+        '''
+        day_windows = []
+        for day in Day:
+            minutes = set()
+            for start, stop in windows.get(day, ()):
+                if not isinstance(start, datetime.time) or not isinstance(stop, datetime.time):
+                    raise TypeError('windows must be pairs of datetime.time objects')
+                if start == stop:
+                    raise ValueError('window "{}-{}" is empty'.format(cls._format_minutes(cls._to_minutes(start)), cls._format_minutes(cls._to_minutes(stop))))
+                minutes.add((cls._to_minutes(start), cls._to_minutes(stop)))
+            day_windows.append(tuple(sorted(minutes)))
+        if not any(day_windows):
+            raise ValueError('at least one window must be set')
+
+        schedule = cls.__new__(cls)
+        schedule._initialize(tuple(day_windows), time_zone)
+        return schedule
+
+    def _initialize(self, windows, time_zone):
+        '''Set the windows of each day and compile them, windows is a tuple of 7 tuples of (start, stop) minutes'''
+        if not isinstance(time_zone, datetime.tzinfo):
+            raise TypeError('time_zone must be a datetime.tzinfo object')
+
+        # Schedules of the original format keep their start and stop time
+        mask = 0
+        shared = set()
+        for day, day_windows in enumerate(windows):
+            if day_windows:
+                mask |= 1 << day
+                shared.add(day_windows)
+        start = stop = None
+        if len(shared) == 1:
+            day_windows = shared.pop()
+            if len(day_windows) == 1:
+                start, stop = day_windows[0]
+                if start is not None and stop is not None and stop <= start:
+                    start = stop = None
+
+        object.__setattr__(self, '_windows', windows)
+        object.__setattr__(self, '_time_zone', time_zone)
+        object.__setattr__(self, '_start', start)
+        object.__setattr__(self, '_stop', stop)
+        object.__setattr__(self, '_days', mask)
+        points, targets, day_transitions = self._compile(windows)
+        object.__setattr__(self, '_points', points)
+        object.__setattr__(self, '_targets', targets)
+        object.__setattr__(self, '_day_transitions', day_transitions)
+
+    @staticmethod
+    @functools.lru_cache(maxsize = 1024)
+    def _compile(windows):
+        '''
+        Return the interval table of the windows of each day.
+
+        The table is a sorted tuple of points in the week and the target
+        from each of them to the next: True from a start, False from a stop
+        until the end of its day, and None from a midnight outside any
+        window. The target before the first point is the target of the
+        last one, as the week wraps around.
+
+        A point is twice the minutes since Monday midnight, a start or stop
+        is passed once its minute is over, as in evaluate. A midnight is one
+        less, it is passed as soon as the day starts.
+
+        Tables do not depend on the time zone, schedules sharing windows
+        share their table.
+
+        :rtype: tuple of (points, targets, transitions of each day as
+            tuples of (minutes since midnight, True or False))
+        '''
+        # Windows as [start, stop) minutes of the week, stop past the end of the week when it wraps
+        intervals = []
+        edges = []
+        for day, day_windows in enumerate(windows):
+            midnight = day * _DAY_MINUTES
+            for start, stop in day_windows:
+                if start is None:
+                    edges.append((midnight + stop, False))
+                elif stop is None:
+                    edges.append((midnight + start, True))
+                else:
+                    intervals.append([midnight + start, midnight + stop + (_DAY_MINUTES if stop <= start else 0)])
+
+        # Overlapping and adjacent windows are merged, including across the end of the week
+        intervals.sort()
+        merged = []
+        for start, stop in intervals:
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], stop)
+            else:
+                merged.append([start, stop])
+        while len(merged) > 1 and merged[-1][1] >= merged[0][0] + _WEEK_MINUTES:
+            start, stop = merged.pop(0)
+            merged[-1][1] = max(merged[-1][1], stop + _WEEK_MINUTES)
+        if merged and merged[-1][1] - merged[-1][0] >= _WEEK_MINUTES:
+            # Windows that cover the whole week never stop
+            return (0,), (True,), ((),) * 7
+
+        for start, stop in merged:
+            edges.append((start % _WEEK_MINUTES, True))
+            edges.append((stop % _WEEK_MINUTES, False))
+
+        # Targets reset at midnight unless a window is open
+        table = dict((2 * minutes, target) for minutes, target in edges)
+        for day in range(7):
+            midnight = day * _DAY_MINUTES
+            if not any(start < midnight + offset <= stop for start, stop in merged for offset in (0, _WEEK_MINUTES)):
+                table[2 * midnight - 1] = None
+
+        points = tuple(sorted(table))
+        day_transitions = tuple(
+            tuple(sorted((minutes - day * _DAY_MINUTES, target) for minutes, target in edges
+                         if day * _DAY_MINUTES <= minutes < (day + 1) * _DAY_MINUTES))
+            for day in range(7))
+        return points, tuple(table[point] for point in points), day_transitions
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Schedule is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('Schedule is immutable')
+
+    def __eq__(self, other):
+        if not isinstance(other, Schedule):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __str__(self):
+        if self._is_simple():
+            return '{};{};{};{}'.format(
+                self._format_minutes(self._start),
+                self._format_minutes(self._stop),
+                self._time_zone,
+                ','.join(day.name for day in sorted(self.days)))
+
+        # The windows shared by most days come first, the other days are overrides
+        groups = collections.OrderedDict()
+        for day in Day:
+            if self._windows[day]:
+                groups.setdefault(self._windows[day], []).append(day)
+        base = max(groups, key = lambda day_windows: len(groups[day_windows]))
+        fields = [self._format_windows(base), str(self._time_zone), ','.join(day.name for day in groups.pop(base))]
+        for day_windows, days in groups.items():
+            fields.append('{}={}'.format(','.join(day.name for day in days), self._format_windows(day_windows)))
+        return ';'.join(fields)
+
+    def __repr__(self):
+        return 'Schedule({!r})'.format(str(self))
+
+    def _key(self):
+        return (self._windows, str(self._time_zone))
+
+    def _is_simple(self):
+        '''Return True if the schedule has the original format, one start and stop time shared by its days'''
+        return self._start is not None or self._stop is not None or not self._days
 
     @property
     def start_time(self):
-        return self._start_time
-
-    @start_time.setter
-    def start_time(self, value):
-        if self._is_validate_time_property(value):
-            self._start_time = value
-        else:
-            raise TypeError('start_time must be a datetime.time object')
+        return self._to_time(self._start)
 
     @property
     def stop_time(self):
-        return self._stop_time
+        return self._to_time(self._stop)
 
-    @stop_time.setter
-    def stop_time(self, value):
-        if self._is_validate_time_property(value):
-            self._stop_time = value
-        else:
-            raise TypeError('stop_time must be a datetime.time object')
+    @property
+    def start_minutes(self):
+        '''Start time in minutes since midnight, None if unset or the schedule has the extended format'''
+        return self._start
+
+    @property
+    def stop_minutes(self):
+        '''Stop time in minutes since midnight, None if unset or the schedule has the extended format'''
+        return self._stop
 
     @property
     def time_zone(self):
         return self._time_zone
 
-    @time_zone.setter
-    def time_zone(self, value):
-        if isinstance(value, datetime.tzinfo):
-            self._time_zone = value
-        else:
-            raise TypeError('time_zone must be a datetime.tzinfo object')
-
     @property
     def days(self):
+        '''Days with at least one window'''
+        return set(day for day in Day if self._days & (1 << day))
+
+    @property
+    def day_mask(self):
+        '''Days as a bitmask of 1 << Day'''
         return self._days
 
-    @days.setter
-    def days(self, value):
-        error_message = 'days must be a set of scheduler.Days'
-        if not isinstance(value, set):
-            raise TypeError(error_message)
-        for item in value:
-            if not isinstance(item, Day):
-                raise TypeError(error_message)
-        self._days = value
+    @property
+    def windows(self):
+        '''Dict of Day to the tuple of (start, stop) minutes since midnight of its windows'''
+        return dict((day, self._windows[day]) for day in Day if self._windows[day])
 
-    def _is_validate_time_property(self, value):
+    @staticmethod
+    def _is_validate_time_property(value):
         if value == None or isinstance(value, datetime.time):
             return True
         else:
             return False
 
-    # TODO:
-    #   Consider making this class immutable.
-    #   Currently this function is not called when the start_time and
-    #   stop_time setters are called. This can lead to an inconsistent
-    #   object if the start_time or stop_time are set after creation.
-    def _validate_start_stop(self):
-        start = self.start_time
-        stop = self.stop_time
-
+    @staticmethod
+    def _validate_start_stop(start, stop):
         # At least one time must be set
-        if not start and not stop:
+        if start is None and stop is None:
             raise ValueError('start_time or stop_time must be set'.format())
         # Only one time being set is OK
-        if not start or not stop:
+        if start is None or stop is None:
             return
         # If both set, stop must be after start
         if stop <= start:
-            raise ValueError('stop_time "{}" must be after start_time "{}"'.format(start, stop))
+            raise ValueError('stop_time "{}" must be after start_time "{}"'.format(stop, start))
+
+    @staticmethod
+    def _to_minutes(value):
+        if value is None:
+            return None
+        return value.hour * 60 + value.minute
 
-    def evaluate(self, timestamp):
+    @staticmethod
+    def _to_time(minutes):
+        if minutes is None:
+            return None
+        return datetime.time(minutes // 60, minutes % 60)
+
+    @staticmethod
+    def _format_minutes(minutes):
+        if minutes is None:
+            return 'NONE'
+        return '{:02d}:{:02d}'.format(minutes // 60, minutes % 60)
+
+    @classmethod
+    def _format_windows(cls, windows):
+        return ','.join('{}-{}'.format(cls._format_minutes(start), cls._format_minutes(stop)) for start, stop in windows) or 'NONE'
+
+    def evaluate(self, timestamp, context = None):
         '''
         Evaluate a schedule against the provided timestamp
 
-        :param timestamp: A naive datetime.datetime object
+        :param timestamp: A naive datetime.datetime object in UTC
+        :param context: optional EvaluationContext for timestamp, shared by
+            the schedules evaluated in a run so each zone is localized once
         :rvalue True, False or None based on the following
         Given a set of Days
             Return None if timestamp is not in the set of days
@@ -130,44 +357,111 @@ class Schedule:
         Given a stop time only
             Return None if timestamp is before stop time
             Return False if timestamp is after stop time
-        '''
-        target = None
 
-        # Validate timestamp
-        if not isinstance(timestamp, datetime.datetime):
-            raise TypeError('timestamp must be a datetime.datetime object')
-        if timestamp.tzinfo is not None:
-            raise ValueError('timestamp must be naive')
+        Given windows of the extended format
+            Return True if timestamp is in a window
+            Return False if timestamp is after the stop of a window on the same day
+            Return None otherwise
+        '''
+        if context is None:
+            context = EvaluationContext(timestamp)
+        elif context.timestamp != timestamp:
+            raise ValueError('context was created for timestamp "{}"'.format(context.timestamp))
+
+        clock = context.clock(self._time_zone)
+        target = self._evaluate_clock(clock)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('DAYS: {}'.format(self.days))
+            logger.debug('NOW  : {} {}'.format(clock.now, clock.now.tzinfo))
+            logger.debug('TARGET: {}'.format(target))
+        return target
 
-        # Localize the timestamp and get the day
-        now = self._localize(timestamp.date(), timestamp.time(), self.time_zone)
-        day = now.weekday()
-        logger.debug('DAYS: {}'.format(self.days))
-        logger.debug('DAY : {}'.format(day))
+    def _evaluate_clock(self, clock):
+        '''Evaluate the schedule against the local time of a _ZoneClock in its time zone'''
+        points = self._points
+        if clock._fixed_offset:
+            # Number of points passed, a minute is passed once it is over
+            minutes, remainder = divmod(clock._week_us, 60000000)
+            index = bisect.bisect_left(points, 2 * minutes + (remainder > 0))
+        else:
+            # On a DST transition date the starts and stops of the day are localized one at a time
+            midnight = clock.weekday * _DAY_MINUTES
+            index = bisect.bisect_left(points, 2 * midnight - 1)
+            high = bisect.bisect_left(points, 2 * (midnight + _DAY_MINUTES) - 1, index)
+            while index < high:
+                middle = (index + high) // 2
+                point = points[middle]
+                if point % 2 or clock.is_after(point // 2 - midnight):
+                    index = middle + 1
+                else:
+                    high = middle
+        # The target of the last point passed, before the first point of the week that of the last one
+        return self._targets[index - 1]
+
+    def next_transition(self, after):
+        '''
+        Return the next start or stop time after a timestamp.
 
-        # Localize the start and stop time, use the date from the provided time
-        start = stop = None
-        if self.start_time:
-            start = self._localize(now.date(), self.start_time, self.time_zone)
-            logger.debug('START: {} {}'.format(start, start.tzinfo))
-        if self.stop_time:
-            stop = self._localize(now.date(), self.stop_time, self.time_zone)
-            logger.debug('STOP : {} {}'.format(stop, stop.tzinfo))
-        logger.debug('NOW  : {} {}'.format(now, now.tzinfo))
-
-        # Evaluate the schedule
-        if day in self.days:
-            if start and now > start:
-                target = True
-
-            if stop and now > stop:
-                target = False
-
-        logger.debug('TARGET: {}'.format(target))
-        return target
+        Between transitions evaluate can only return the previous target
+        or None, any evaluation later than the transition sees the new
+        target.
 
-    def _localize(self, date, time, time_zone):
-        return time_zone.localize(datetime.datetime.combine(date, time))
+        :param after: A naive datetime.datetime object in UTC
+        :rtype: A naive datetime.datetime object in UTC or None if the
+            schedule has no days
+        '''
+        if not isinstance(after, datetime.datetime):
+            raise TypeError('after must be a datetime.datetime object')
+        if after.tzinfo is not None:
+            raise ValueError('after must be naive')
+
+        local_date = zones.to_local(after, self._time_zone).date()
+
+        # A schedule with any day set has a transition within a week
+        for days_ahead in range(8):
+            date = local_date + datetime.timedelta(days = days_ahead)
+            transitions = []
+            for minutes, target in self._day_transitions[date.weekday()]:
+                local = zones.localize(self._time_zone, datetime.datetime.combine(date, self._to_time(minutes)))
+                transition = zones.to_utc(local)
+                if transition > after:
+                    transitions.append(transition)
+            if transitions:
+                return min(transitions)
+
+        return None
+
+    def transitions(self, start, end, offsets = None):
+        '''
+        Generate the transitions of the schedule in the interval [start, end].
+
+        A stop transition takes precedence over a start transition on the
+        same day, as in evaluate, so a start is only generated when it is
+        before the next stop of the day.
+
+        :param start: A naive datetime.datetime object in UTC
+        :param end: A naive datetime.datetime object in UTC
+        :param offsets: optional dict shared between calls to cache the UTC
+            offsets of each local date
+        :rtype: iterator of (naive datetime.datetime in UTC, True for a start
+            or False for a stop) in time order
+        '''
+        if offsets is None:
+            offsets = {}
+
+        date = zones.to_local(start, self._time_zone).date()
+        last_date = zones.to_local(end, self._time_zone).date()
+        one_day = datetime.timedelta(days = 1)
+        while date <= last_date:
+            day_transitions = [(_local_to_utc(self._time_zone, date, minutes, offsets), target)
+                               for minutes, target in self._day_transitions[date.weekday()]]
+            for index, (transition, target) in enumerate(day_transitions):
+                if target and index + 1 < len(day_transitions) and day_transitions[index + 1][0] <= transition:
+                    continue
+                if start <= transition <= end:
+                    yield transition, target
+            date += one_day
 
     @classmethod
     def from_string(cls, schedule_string):
@@ -179,6 +473,8 @@ class Schedule:
         ;rtype: Schedule object
         '''
         schedule_tokens = cls._validate_format(schedule_string)
+        if '-' in schedule_tokens[0]:
+            return cls._from_windows_tokens(schedule_tokens)
 
         start = cls._validate_time_string(schedule_tokens[0])
         stop = cls._validate_time_string(schedule_tokens[1])
@@ -187,12 +483,63 @@ class Schedule:
 
         return cls(start, stop, zone, days)
 
+    @classmethod
+    def _from_windows_tokens(cls, schedule_tokens):
+        '''Build a Schedule object from the fields of the extended format'''
+        windows = cls._validate_windows_string(schedule_tokens[0])
+        zone = cls._validate_time_zone_string(schedule_tokens[1])
+        day_windows = dict((day, windows) for day in cls._validate_days_string(schedule_tokens[2]))
+        for override in schedule_tokens[3:]:
+            days_string, separator, windows_string = override.partition('=')
+            if not separator:
+                raise ValueError('invalid override "{}", expected DAYS=WINDOWS'.format(override))
+            windows = cls._validate_windows_string(windows_string)
+            for day in cls._validate_days_string(days_string):
+                day_windows[day] = windows
+        return cls.from_windows(day_windows, zone)
+
+    def to_compact(self):
+        '''
+        Return the schedule as a (start minutes, stop minutes, zone name, day mask)
+        tuple, followed for the extended format by the minutes of the week of
+        the start and the stop minutes since midnight of each window
+        '''
+        compact = (self._start, self._stop, str(self._time_zone), self._days)
+        if self._is_simple():
+            return compact
+        return compact + tuple(minutes for day in Day for start, stop in self._windows[day] for minutes in (day * _DAY_MINUTES + start, stop))
+
+    @classmethod
+    def from_compact(cls, compact):
+        '''
+        Build a Schedule object from a to_compact tuple without parsing a
+        schedule string.
+
+        :param: cls: Schedule class
+        :param: compact: (start minutes, stop minutes, zone name, day mask, windows...)
+        ;rtype: Schedule object
+        '''
+        start, stop, zone, mask = compact[:4]
+        zone = cls._validate_time_zone_string(zone)
+        if len(compact) > 4:
+            windows = {}
+            for index in range(4, len(compact), 2):
+                day, start = divmod(compact[index], _DAY_MINUTES)
+                windows.setdefault(Day(day), []).append((cls._to_time(start), cls._to_time(compact[index + 1])))
+            return cls.from_windows(windows, zone)
+        days = set(day for day in Day if mask & (1 << day))
+        return cls(cls._to_time(start), cls._to_time(stop), zone, days)
+
     @staticmethod
     def _validate_format(schedule):
-        '''Remove whitespace and ensure four fields separated by semicolon'''
-        schedule_no_whitespace = re.sub('\s', '', schedule)
+        '''
+        Remove whitespace and ensure four fields separated by semicolon, or
+        at least three for the extended format
+        '''
+        schedule_no_whitespace = _WHITESPACE.sub('', schedule)
         schedule_tokens = schedule_no_whitespace.split(';')
-        if len(schedule_tokens) != 4:
+        extended = '-' in schedule_tokens[0]
+        if len(schedule_tokens) != 4 and not (extended and len(schedule_tokens) >= 3):
             raise ValueError('incorrect schedule "{}"'.format(schedule))
         return schedule_tokens
 
@@ -200,23 +547,31 @@ class Schedule:
     def _validate_time_string(time_string):
         '''Ensure time in HH:MM format'''
         TIME_NONE = 'NONE'
-        TIME_FORMAT = '%H:%M'
 
         if time_string.upper() == TIME_NONE:
             return None
-        try:
-            tm = time.strptime(time_string, TIME_FORMAT)
-            return datetime.time(tm.tm_hour, tm.tm_min)
-        except:
+        match = _TIME.fullmatch(time_string)
+        if match is None or int(match.group(1)) > 23 or int(match.group(2)) > 59:
             raise ValueError('invalid time "{}", expected HH:MM'.format(time_string))
+        return datetime.time(int(match.group(1)), int(match.group(2)))
+
+    @classmethod
+    def _validate_windows_string(cls, windows_string):
+        '''Ensure comma separated windows in HH:MM-HH:MM format or NONE, return (start, stop) datetime.time tuples'''
+        if windows_string.upper() == 'NONE':
+            return []
+        windows = []
+        for window in windows_string.split(','):
+            match = _WINDOW.fullmatch(window)
+            if match is None:
+                raise ValueError('invalid window "{}", expected HH:MM-HH:MM'.format(window))
+            windows.append((cls._validate_time_string(match.group(1)), cls._validate_time_string(match.group(2))))
+        return windows
 
     @staticmethod
     def _validate_time_zone_string(time_zone):
         '''Ensure valid timezone'''
-        try:
-            return pytz.timezone(time_zone)
-        except:
-            raise ValueError('invalid timezone "{}"'.format(time_zone))
+        return zones.get_zone(time_zone)
 
     @staticmethod
     def _validate_days_string(days_string):
@@ -233,6 +588,109 @@ class Schedule:
         return days
 
 
+
+def _local_to_utc(time_zone, date, minutes, offsets):
+    '''
+    Return the naive UTC time of minutes since midnight on a local date.
+
+    Dates with a single UTC offset are cached in offsets, on a DST
+    transition date the time is localized with zones.localize.
+    '''
+    key = (time_zone, date)
+    offset = offsets.get(key, False)
+    if offset is False:
+        first = zones.localize(time_zone, datetime.datetime.combine(date, datetime.time.min))
+        last = zones.localize(time_zone, datetime.datetime.combine(date, datetime.time.max))
+        offset = offsets[key] = first.utcoffset() if first.utcoffset() == last.utcoffset() else None
+
+    local = datetime.datetime.combine(date, datetime.time(minutes // 60, minutes % 60))
+    if offset is None:
+        return zones.to_utc(zones.localize(time_zone, local))
+    return local - offset
+
+
+class ScheduleCache:
+    '''
+    Bounded LRU cache of Schedule objects keyed by schedule string.
+
+    Strings are normalized by removing whitespace so equivalent strings
+    share one Schedule object. Parse errors are cached and logged once,
+    later lookups raise the same error without parsing the string again.
+
+    :param max_size: maximum number of schedule strings kept
+    '''
+    MAX_SIZE = 1024
+
+    def __init__(self, max_size = MAX_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, schedule_string):
+        '''
+        Return the Schedule for a schedule string, parsing it on a miss.
+
+        :param schedule_string: string represenation of a Schedule
+        :rtype: Schedule object
+        :raises ValueError: if the schedule string is invalid
+        '''
+        if not isinstance(schedule_string, str):
+            raise ValueError('invalid schedule "{}"'.format(schedule_string))
+        key = _WHITESPACE.sub('', schedule_string)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if entry is None:
+            try:
+                entry = (Schedule.from_string(key), None)
+            except ValueError as e:
+                logger.error('Schedule [{}]: {}'.format(schedule_string, e))
+                entry = (None, str(e))
+            with self._lock:
+                self._entries[key] = entry
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last = False)
+
+        schedule, error = entry
+        if error is not None:
+            raise ValueError(error)
+        return schedule
+
+    def clear(self):
+        '''Remove all entries and reset the counters'''
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+# Process wide cache, kept between warm Lambda invocations
+schedule_cache = ScheduleCache()
+
+def get_schedule(schedule_string):
+    '''Return the shared Schedule for a schedule string from the process wide cache'''
+    return schedule_cache.get(schedule_string)
+
+
+# Decision taken for an instance by an evaluation
+#   id: instance id
+#   running: running state before the evaluation
+#   target: target evaluated from the schedule, True, False or None
+#   schedule: the instance's Schedule or None
+#   action: 'start', 'stop' or None when the running state is kept
+#   reason: short human readable explanation of the action
+PlanEntry = collections.namedtuple('PlanEntry', ['id', 'running', 'target', 'schedule', 'action', 'reason'])
+
 class Instance:
     '''
     Cloud provider compute instance representation that can change it's
@@ -243,24 +701,57 @@ class Instance:
     :param schedule: scheduler.Schedule object
     :param provider: cloud provider class that implements start and stop
     '''
+    __slots__ = ('id', 'running', 'schedule', 'provider')
+
     def __init__(self, id, running, schedule, provider = None):
         self.id = id
         self.running = running
         self.schedule = schedule
         self.provider = provider
 
-    def evaluate_schedule(self, timestamp = None):
-        '''Evaluate instance's schedule and change running state as required'''
+    def evaluate_schedule(self, timestamp = None, context = None, dry_run = False):
+        '''
+        Evaluate instance's schedule and change running state as required
+
+        :param dry_run: only plan the change, the running state is left unchanged
+        :rtype: PlanEntry
+        '''
         if timestamp == None:
-            timestamp = datetime.datetime.utcnow()
+            timestamp = context.timestamp if context else datetime.datetime.utcnow()
 
-        if self.schedule:
-            target = self.schedule.evaluate(timestamp)
-            logger.info('Instance [{}]: Running= {}, Target= {}'.format(self.id, self.running, target))
+        if not self.schedule:
+            return self.plan(None)
+        return self.apply_target(self.schedule.evaluate(timestamp, context), dry_run)
+
+    def apply_target(self, target, dry_run = False):
+        '''
+        Change running state to an already evaluated target, None leaves it unchanged
 
-            if target is not None and target != self.running:
-                logger.info('Instance [{}]: Changing Running to {}'.format(self.id, target))
-                self._toggle_running()
+        :param dry_run: only plan the change, the running state is left unchanged
+        :rtype: PlanEntry
+        '''
+        # Only instances that change state are logged at INFO, see plan.PlanSummary for the others
+        logger.debug(lazy('Instance [{}]: Running= {}, Target= {}', self.id, self.running, target))
+
+        entry = self.plan(target)
+        if entry.action and not dry_run:
+            logger.info(lazy('Instance [{}]: Changing Running to {}, Schedule= {}', self.id, target, self.schedule))
+            self._toggle_running()
+        return entry
+
+    def plan(self, target):
+        '''Return the PlanEntry of an already evaluated target without acting on it'''
+        if not self.schedule:
+            action, reason = None, 'no schedule'
+        elif target is None:
+            action, reason = None, 'no start or stop time passed today'
+        elif target == self.running:
+            action, reason = None, 'already running' if target else 'already stopped'
+        elif target:
+            action, reason = 'start', 'start time passed'
+        else:
+            action, reason = 'stop', 'stop time passed'
+        return PlanEntry(self.id, self.running, target, self.schedule, action, reason)
 
     def _toggle_running(self):
         '''Change instance's running state based on it's current state'''
@@ -281,3 +772,163 @@ class Instance:
 
     def _start(self):
         self.running = True
+
+
+class EvaluationContext:
+    '''
+    Per run cache of localized times for a single UTC timestamp.
+
+    Every instance evaluated in a run shares the same timestamp, so the
+    local time, weekday and UTC offset of each time zone are computed once
+    and reused by every schedule in that zone.
+
+    :param timestamp: A naive datetime.datetime object in UTC
+    '''
+    __slots__ = ('timestamp', '_clocks')
+
+    def __init__(self, timestamp):
+        if not isinstance(timestamp, datetime.datetime):
+            raise TypeError('timestamp must be a datetime.datetime object')
+        if timestamp.tzinfo is not None:
+            raise ValueError('timestamp must be naive')
+
+        self.timestamp = timestamp
+        self._clocks = {}
+
+    def clock(self, time_zone):
+        '''Return the _ZoneClock of the timestamp in a time zone'''
+        clock = self._clocks.get(time_zone)
+        if clock is None:
+            clock = self._clocks[time_zone] = _ZoneClock(time_zone, self.timestamp)
+        return clock
+
+class _ZoneClock:
+    '''
+    Local time of a UTC timestamp in one time zone, shared by every
+    schedule in that zone.
+
+    When the local date has a single UTC offset, start and stop times are
+    compared as integers against the local time of day. On a DST
+    transition date each distinct time is localized once, non-existent and
+    repeated times resolve to standard time, see zones.localize.
+    '''
+    __slots__ = ('time_zone', 'now', 'weekday', 'day_bit', '_timestamp', '_fixed_offset', '_now_us', '_week_us', '_instants')
+
+    def __init__(self, time_zone, timestamp):
+        self.time_zone = time_zone
+        self._timestamp = timestamp
+        self.now = now = zones.to_local(timestamp, time_zone)
+        self.weekday = now.weekday()
+        self.day_bit = 1 << self.weekday
+
+        first = zones.localize(time_zone, datetime.datetime.combine(now.date(), datetime.time.min))
+        last = zones.localize(time_zone, datetime.datetime.combine(now.date(), datetime.time.max))
+        self._fixed_offset = first.utcoffset() == last.utcoffset() == now.utcoffset()
+        self._now_us = ((now.hour * 60 + now.minute) * 60 + now.second) * 1000000 + now.microsecond
+        # Microseconds since Monday midnight in local time
+        self._week_us = self.weekday * _DAY_MINUTES * 60000000 + self._now_us
+        self._instants = {}
+
+    def is_after(self, minutes):
+        '''Return True if now is strictly after minutes since midnight on the local date'''
+        if self._fixed_offset:
+            return self._now_us > minutes * 60000000
+
+        instant = self._instants.get(minutes)
+        if instant is None:
+            local = datetime.datetime.combine(self.now.date(), datetime.time(minutes // 60, minutes % 60))
+            # Compared in UTC, aware times sharing a zoneinfo zone compare as wall times
+            instant = self._instants[minutes] = zones.to_utc(zones.localize(self.time_zone, local))
+        return self._timestamp > instant
+
+def evaluate_schedules(schedules, timestamp, context = None):
+    '''
+    Evaluate many schedules against one timestamp in a single pass.
+
+    Schedules are grouped by time zone so the local time is computed once
+    per zone, and identical schedules are evaluated once. The result is
+    the same as calling Schedule.evaluate on each schedule with a shared
+    EvaluationContext.
+
+    :param schedules: iterable of Schedule objects or None
+    :param timestamp: A naive datetime.datetime object in UTC
+    :param context: optional EvaluationContext for timestamp, reused across calls
+    :rtype: list of True, False or None in the order of schedules
+    '''
+    if context is None:
+        context = EvaluationContext(timestamp)
+    elif context.timestamp != timestamp:
+        raise ValueError('context was created for timestamp "{}"'.format(context.timestamp))
+    schedules = list(schedules)
+
+    # Distinct schedules grouped by zone
+    by_zone = {}
+    for schedule in set(schedules):
+        if schedule is not None:
+            by_zone.setdefault(schedule.time_zone, []).append(schedule)
+
+    targets = {None: None}
+    for time_zone, group in by_zone.items():
+        clock = context.clock(time_zone)
+        for schedule in group:
+            targets[schedule] = schedule._evaluate_clock(clock)
+
+    return [targets[schedule] for schedule in schedules]
+
+def evaluate_instances(instances, timestamp = None, context = None, dry_run = False):
+    '''
+    Evaluate the schedules of many instances with evaluate_schedules and
+    change their running state as required.
+
+    :param instances: iterable of Instance objects
+    :param timestamp: A naive datetime.datetime object in UTC, defaults to now
+    :param context: optional EvaluationContext for timestamp, reused across calls
+    :param dry_run: only plan the changes, running states are left unchanged
+    :rtype: list of PlanEntry of the instances with a schedule
+    '''
+    if timestamp == None:
+        timestamp = context.timestamp if context else datetime.datetime.utcnow()
+
+    instances = [instance for instance in instances if instance.schedule]
+    targets = evaluate_schedules([instance.schedule for instance in instances], timestamp, context)
+    return [instance.apply_target(target, dry_run) for instance, target in zip(instances, targets)]
+
+
+class TransitionIndex:
+    '''
+    Sorted index of the next transition of every distinct schedule after
+    a timestamp.
+
+    Until next_transition no schedule in the index returns a new target,
+    so a run in between would take no action on the indexed instances.
+
+    :param timestamp: A naive datetime.datetime object in UTC
+    '''
+    def __init__(self, timestamp):
+        self.timestamp = timestamp
+        self._schedules = set()
+        self._transitions = []
+
+    def __len__(self):
+        return len(self._transitions)
+
+    def add(self, schedule):
+        '''Add the next transition of a schedule, each distinct schedule is added once'''
+        if schedule is None or schedule in self._schedules:
+            return
+        self._schedules.add(schedule)
+        self.add_transition(schedule.next_transition(self.timestamp))
+
+    def add_transition(self, transition):
+        '''Add a transition computed elsewhere, such as by an earlier part of the run, None is ignored'''
+        if transition is not None:
+            bisect.insort(self._transitions, transition)
+
+    @property
+    def next_transition(self):
+        '''Earliest transition in the index or None'''
+        return self._transitions[0] if self._transitions else None
+
+    def count_between(self, start, end):
+        '''Number of indexed transitions in the interval (start, end]'''
+        return bisect.bisect_right(self._transitions, end) - bisect.bisect_right(self._transitions, start)
@@ -0,0 +1,170 @@
+import logging
+import zlib
+import datetime
+import collections
+
+import snapshot
+
+logger = logging.getLogger()
+
+# A share of the work of a coordinated run, scanned, evaluated and acted on by one worker
+#   index: position of the shard in the plan, and its hash bucket when count is above 1
+#   regions: names of the regions scanned by the shard
+#   count: number of shards the instances of each region are split between by
+#       hash of instance id, 1 when the shard owns its regions
+Shard = collections.namedtuple('Shard', ['index', 'regions', 'count'])
+
+REGION = 'region'
+HASH = 'hash'
+STRATEGIES = (REGION, HASH)
+
+_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+def plan_shards(regions, count, strategy = REGION, previous = None):
+    '''
+    Split the regions of a run between at most count shards.
+
+    By region, each shard owns whole regions. Regions are balanced by the
+    number of instances they had in the previous snapshot, largest first,
+    so one busy region does not hold back the whole run. Regions that were
+    never scanned count as a single instance.
+
+    By hash, every shard scans all regions and keeps the instances whose
+    id hashes to its index, for fleets concentrated in a few regions.
+
+    :param regions: list of region names
+    :param count: maximum number of shards
+    :param strategy: REGION or HASH
+    :param previous: optional snapshot.Snapshot used to weigh regions
+    :rtype: list of Shard, never empty shards
+    '''
+    if strategy not in STRATEGIES:
+        raise ValueError('invalid shard strategy "{}"'.format(strategy))
+    if count < 1:
+        raise ValueError('count must be at least 1')
+    regions = sorted(regions)
+    if not regions:
+        return []
+
+    if strategy == HASH:
+        return [Shard(index, regions, count) for index in range(count)]
+
+    previous = previous or snapshot.Snapshot()
+    def weight(region):
+        region_snapshot = previous.regions.get(region)
+        return max(1, len(region_snapshot.instances)) if region_snapshot else 1
+
+    # Longest processing time first, each region goes to the lightest shard so far
+    shards = [[0, []] for i in range(min(count, len(regions)))]
+    for region in sorted(regions, key = lambda region: (-weight(region), region)):
+        lightest = min(shards, key = lambda shard: shard[0])
+        lightest[0] += weight(region)
+        lightest[1].append(region)
+    return [Shard(index, sorted(shard_regions), 1) for index, (total, shard_regions) in enumerate(shards)]
+
+def in_shard(instance_id, index, count):
+    '''Return True if an instance id belongs to the hash shard index of count'''
+    return zlib.crc32(instance_id.encode('utf-8')) % count == index
+
+def to_dict(shard):
+    '''Return a Shard as a JSON serializable dict'''
+    return {'index': shard.index, 'regions': list(shard.regions), 'count': shard.count}
+
+def from_dict(data):
+    '''Return the Shard of a dict from to_dict'''
+    return Shard(data['index'], list(data['regions']), data['count'])
+
+def make_report(shard, region_snapshots, next_transition, evaluated, started, stopped, failed, complete, failed_regions = ()):
+    '''
+    Return the JSON serializable report a worker sends back to the coordinator
+
+    :param shard: Shard processed by the worker
+    :param region_snapshots: dict of region name to the snapshot.RegionSnapshot
+        of the regions scanned completely
+    :param next_transition: naive datetime.datetime in UTC or None
+    :param evaluated: number of instances evaluated
+    :param started: number of instances started, or planned to
+    :param stopped: number of instances stopped, or planned to
+    :param failed: number of failed actions
+    :param complete: False if the worker stopped before scanning all its regions
+    :param failed_regions: regions that failed or timed out
+    '''
+    return {
+        'shard': to_dict(shard),
+        'regions': dict((region, snapshot.Snapshot.encode_region(region_snapshot).decode('utf-8'))
+                        for region, region_snapshot in region_snapshots.items()),
+        'next_transition': next_transition.strftime(_TIME_FORMAT) if next_transition else None,
+        'evaluated': evaluated,
+        'started': started,
+        'stopped': stopped,
+        'failed': failed,
+        'complete': complete,
+        'failed_regions': list(failed_regions),
+    }
+
+def fan_out(shards, worker, executor, *args):
+    '''
+    Run worker(shard, *args) for every shard on a concurrent.futures
+    executor and return the reports in shard order, None for the shards
+    whose worker raised.
+    '''
+    futures = [executor.submit(worker, shard, *args) for shard in shards]
+    reports = []
+    for shard, future in zip(shards, futures):
+        try:
+            reports.append(future.result())
+        except Exception as e:
+            logger.error('Shard [{}]: {}'.format(shard.index, e))
+            reports.append(None)
+    return reports
+
+class Merge:
+    '''
+    Combined reports of the workers of a coordinated run.
+
+    A region is only part of the merged snapshot when every shard covering
+    it scanned it completely, otherwise its previous snapshot is kept.
+    Hash shards each hold a share of the instances of a region, their
+    shares are joined and the earliest scan time is kept. The regions that
+    failed in any worker are listed in failed_regions.
+
+    :param shards: list of Shard of the run
+    :param reports: list of reports from make_report in shard order, None
+        for a shard that failed
+    '''
+    def __init__(self, shards, reports):
+        self.snapshot = snapshot.Snapshot()
+        self.next_transition = None
+        self.totals = collections.Counter()
+        self.failed_shards = []
+        self.complete = True
+        self.failed_regions = []
+
+        shares = {}
+        for shard, report in zip(shards, reports):
+            if report is None:
+                self.failed_shards.append(shard.index)
+                self.complete = False
+                continue
+            self.complete = self.complete and report['complete']
+            self.failed_regions.extend(region for region in report.get('failed_regions', []) if region not in self.failed_regions)
+            for name in ('evaluated', 'started', 'stopped', 'failed'):
+                self.totals[name] += report[name]
+            if report['next_transition']:
+                next_transition = datetime.datetime.strptime(report['next_transition'], _TIME_FORMAT)
+                if self.next_transition is None or next_transition < self.next_transition:
+                    self.next_transition = next_transition
+            for region, data in report['regions'].items():
+                region_snapshot = snapshot.Snapshot.decode_region(data.encode('utf-8'))
+                if region_snapshot is not None:
+                    shares.setdefault(region, []).append((shard.count, region_snapshot))
+
+        for region, region_shares in shares.items():
+            if len(region_shares) < region_shares[0][0]:
+                logger.warning('Region [{}]: scanned by {} of {} shards, keeping its previous snapshot'.format(region, len(region_shares), region_shares[0][0]))
+                continue
+            instances = {}
+            for count, region_snapshot in region_shares:
+                instances.update(region_snapshot.instances)
+            scanned = min(region_snapshot.scanned for count, region_snapshot in region_shares)
+            self.snapshot.regions[region] = snapshot.RegionSnapshot(scanned, instances)
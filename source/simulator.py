@@ -0,0 +1,147 @@
+import logging
+import json
+import datetime
+import collections
+
+import scheduler
+
+logger = logging.getLogger()
+
+class Simulator:
+    '''
+    Forecasts the running time of a fleet of scheduled instances over a
+    time range.
+
+    Running intervals are computed from the schedule transitions in the
+    range rather than by evaluating every instance at every tick. Each
+    instance takes the target of its schedule at start, if any, and then
+    keeps its running state until a transition changes it, as it would
+    with the scheduler running continuously. Instances sharing a
+    schedule and an initial state share their intervals, so the cost
+    grows with the number of distinct schedules, not the fleet size.
+
+    :param start: A naive datetime.datetime object in UTC
+    :param end: A naive datetime.datetime object in UTC, after start
+    '''
+    def __init__(self, start, end):
+        if end <= start:
+            raise ValueError('end must be after start')
+        self.start = start
+        self.end = end
+        self._groups = collections.Counter()
+        self._intervals = {}
+        self._offsets = {}
+
+    def add(self, schedule, running, count = 1):
+        '''
+        Add instances to the fleet
+
+        :param schedule: scheduler.Schedule object or None when not scheduled
+        :param running: running state of the instances before start
+        :param count: number of instances
+        '''
+        self._groups[(schedule, bool(running))] += count
+
+    @classmethod
+    def from_snapshot(cls, fleet, start, end):
+        '''
+        Build a Simulator from the instances of a snapshot.Snapshot, the
+        running state recorded in the snapshot is the state before start.
+        '''
+        simulator = cls(start, end)
+        schedules = {None: None}
+        for region_snapshot in fleet.regions.values():
+            for entry in region_snapshot.instances.values():
+                schedule = schedules.get(entry.schedule)
+                if schedule is None and entry.schedule is not None:
+                    schedule = schedules[entry.schedule] = scheduler.Schedule.from_compact(entry.schedule)
+                simulator.add(schedule, entry.running)
+        return simulator
+
+    def intervals(self, schedule, running):
+        '''Return the (start, end) intervals an instance with schedule is running in'''
+        key = (schedule, bool(running))
+        intervals = self._intervals.get(key)
+        if intervals is None:
+            intervals = self._intervals[key] = self._compute_intervals(schedule, running)
+        return intervals
+
+    def _compute_intervals(self, schedule, running):
+        intervals = []
+        if schedule is not None:
+            target = schedule.evaluate(self.start)
+            if target is not None:
+                running = target
+        started = self.start if running else None
+        if schedule is not None:
+            for timestamp, target in schedule.transitions(self.start, self.end, self._offsets):
+                if target and started is None:
+                    started = timestamp
+                elif not target and started is not None:
+                    if timestamp > started:
+                        intervals.append((started, timestamp))
+                    started = None
+        if started is not None and started < self.end:
+            intervals.append((started, self.end))
+        return intervals
+
+    def running_hours(self):
+        '''
+        Return the instance hours of the fleet over the range, keyed by
+        schedule string, None for instances without a schedule.
+        '''
+        hours = collections.Counter()
+        for (schedule, running), count in self._groups.items():
+            seconds = sum((end - start).total_seconds() for start, end in self.intervals(schedule, running))
+            hours[str(schedule) if schedule else None] += count * seconds / 3600.0
+        return dict(hours)
+
+    def time_series(self, step = datetime.timedelta(hours = 1)):
+        '''
+        Return the average number of running instances in each step of the
+        range, as a list of (step start, running count). The last step is
+        shortened to end with the range.
+        '''
+        # Running count changes, summed over every group
+        changes = collections.Counter()
+        for (schedule, running), count in self._groups.items():
+            for start, end in self.intervals(schedule, running):
+                changes[start] += count
+                changes[end] -= count
+        changes = sorted(changes.items())
+
+        series = []
+        index = 0
+        running = 0
+        step_start = self.start
+        while step_start < self.end:
+            step_end = min(step_start + step, self.end)
+            position = step_start
+            seconds = 0.0
+            while index < len(changes) and changes[index][0] <= step_end:
+                timestamp, change = changes[index]
+                seconds += running * (timestamp - position).total_seconds()
+                running += change
+                position = timestamp
+                index += 1
+            seconds += running * (step_end - position).total_seconds()
+            series.append((step_start, seconds / (step_end - step_start).total_seconds()))
+            step_start = step_end
+        return series
+
+if __name__ == '__main__':
+    import sys
+    import snapshot
+
+    # Forecast a snapshot file: simulator.py SNAPSHOT START END [STEP_MINUTES]
+    logger.addHandler(logging.StreamHandler())
+    time_format = '%Y-%m-%dT%H:%M'
+    start = datetime.datetime.strptime(sys.argv[2], time_format)
+    end = datetime.datetime.strptime(sys.argv[3], time_format)
+    step = datetime.timedelta(minutes = int(sys.argv[4]) if len(sys.argv) > 4 else 60)
+
+    simulator = Simulator.from_snapshot(snapshot.FileSnapshotStore(sys.argv[1]).load(), start, end)
+    print(json.dumps({
+        'running_hours': simulator.running_hours(),
+        'time_series': [[timestamp.strftime(time_format), count] for timestamp, count in simulator.time_series(step)],
+    }, indent = 2))
@@ -0,0 +1,484 @@
+import logging
+import json
+import os
+import zlib
+import sqlite3
+import datetime
+import collections
+import concurrent.futures
+
+import clients
+
+from executor import is_client_error
+
+logger = logging.getLogger()
+
+# Snapshot of a scheduled instance
+#   running: running state when the instance was last seen
+#   tag_hash: crc32 of the schedule tag value
+#   schedule: compact schedule from scheduler.Schedule.to_compact or None if invalid
+InstanceEntry = collections.namedtuple('InstanceEntry', ['running', 'tag_hash', 'schedule'])
+
+# Scan time of a region only known from events
+NEVER_SCANNED = datetime.datetime(1970, 1, 1)
+
+# Where a scan stopped before its time budget ran out
+#   timestamp: naive datetime.datetime in UTC of the run that started the scan
+#   regions: dict of region name to the describe_instances token to resume
+#       from, None to scan the region from its first page
+#   next_transition: earliest schedule transition of the instances already
+#       evaluated, naive datetime.datetime in UTC or None
+Cursor = collections.namedtuple('Cursor', ['timestamp', 'regions', 'next_transition'])
+
+# Key under which stores keep the cursor, never a region name
+CURSOR_KEY = '#cursor'
+
+# Regions available to the scanned accounts when they were last listed
+#   timestamp: naive datetime.datetime in UTC of the listing
+#   accounts: sorted ids of the other accounts the list includes
+#   regions: region names and <ACCOUNT>:<REGION> keys
+RegionList = collections.namedtuple('RegionList', ['timestamp', 'accounts', 'regions'])
+
+# Key under which stores keep the region list, never a region name
+REGION_LIST_KEY = '#regions'
+
+_RESERVED_KEYS = (CURSOR_KEY, REGION_LIST_KEY)
+
+def encode_cursor(cursor):
+    '''Encode a Cursor as JSON text'''
+    return json.dumps({
+        't': cursor.timestamp.strftime(Snapshot._TIME_FORMAT),
+        'r': cursor.regions,
+        'n': cursor.next_transition.strftime(Snapshot._TIME_FORMAT) if cursor.next_transition else None,
+    }, separators = (',', ':'))
+
+def decode_cursor(data):
+    '''Decode a Cursor from JSON text'''
+    data = json.loads(data)
+    next_transition = datetime.datetime.strptime(data['n'], Snapshot._TIME_FORMAT) if data['n'] else None
+    return Cursor(datetime.datetime.strptime(data['t'], Snapshot._TIME_FORMAT), data['r'], next_transition)
+
+def encode_region_list(region_list):
+    '''Encode a RegionList as JSON text'''
+    return json.dumps({
+        't': region_list.timestamp.strftime(Snapshot._TIME_FORMAT),
+        'a': list(region_list.accounts),
+        'r': list(region_list.regions),
+    }, separators = (',', ':'))
+
+def decode_region_list(data):
+    '''Decode a RegionList from JSON text'''
+    data = json.loads(data)
+    return RegionList(datetime.datetime.strptime(data['t'], Snapshot._TIME_FORMAT), data['a'], data['r'])
+
+def _load_instance(store, region, instance_id):
+    '''Return the InstanceEntry of one instance from the region of a store saving whole regions'''
+    region_snapshot = store.load([region]).regions.get(region)
+    return region_snapshot.instances.get(instance_id) if region_snapshot else None
+
+def _save_instance(store, region, instance_id, entry):
+    '''Save the InstanceEntry of one instance in the region of a store saving whole regions'''
+    region_snapshot = store.load([region]).regions.get(region) or RegionSnapshot(NEVER_SCANNED)
+    if entry is None:
+        region_snapshot.instances.pop(instance_id, None)
+    else:
+        region_snapshot.instances[instance_id] = entry
+    store.save(Snapshot({region: region_snapshot}))
+    return True
+
+def tag_hash(value):
+    '''Return the hash stored for a schedule tag value'''
+    return zlib.crc32((value or '').encode('utf-8'))
+
+class RegionSnapshot:
+    '''
+    Scheduled instances of a region at the time it was scanned.
+
+    :param scanned: naive datetime.datetime in UTC of the scan
+    :param instances: dict of instance id to InstanceEntry
+    '''
+    __slots__ = ('scanned', 'instances')
+
+    def __init__(self, scanned, instances = None):
+        self.scanned = scanned
+        self.instances = instances if instances is not None else {}
+
+class Snapshot:
+    '''
+    Instance inventory persisted between runs, keyed by region.
+
+    Each region is encoded on its own as versioned compact JSON so that
+    stores can read and write regions independently, regions encoded
+    with another version are ignored.
+
+    Regions of other accounts are keyed <ACCOUNT>:<REGION>.
+
+    :param regions: dict of region name to RegionSnapshot
+    '''
+    VERSION = 1
+
+    _TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+    def __init__(self, regions = None):
+        self.regions = regions if regions is not None else {}
+
+    def get(self, id):
+        '''Return the InstanceEntry of an instance id in <REGION>:<INSTANCE_ID> or <ACCOUNT>:<REGION>:<INSTANCE_ID> format or None'''
+        region, instance_id = id.rsplit(':', 1)
+        region_snapshot = self.regions.get(region)
+        if region_snapshot is None:
+            return None
+        return region_snapshot.instances.get(instance_id)
+
+    def update(self, other):
+        '''Replace the regions present in another snapshot'''
+        self.regions.update(other.regions)
+
+    def regions_to_scan(self, regions, timestamp, empty_ttl):
+        '''
+        Return the regions worth scanning at timestamp, in the order given.
+
+        Regions that had instances at their last scan are always scanned,
+        as are regions never scanned. Regions that were empty are only
+        scanned again once their scan is empty_ttl old, a zero empty_ttl
+        scans every region.
+
+        :param regions: list of region names
+        :param timestamp: naive datetime.datetime in UTC
+        :param empty_ttl: datetime.timedelta
+        '''
+        selected = []
+        for region in regions:
+            region_snapshot = self.regions.get(region)
+            if region_snapshot is None or region_snapshot.instances or timestamp - region_snapshot.scanned >= empty_ttl:
+                selected.append(region)
+        return selected
+
+    @staticmethod
+    def encode_region(region_snapshot):
+        '''Encode a RegionSnapshot as compact JSON bytes'''
+        data = {
+            'v': Snapshot.VERSION,
+            's': region_snapshot.scanned.strftime(Snapshot._TIME_FORMAT),
+            'i': dict((instance_id, [int(entry.running), entry.tag_hash, entry.schedule])
+                      for instance_id, entry in region_snapshot.instances.items()),
+        }
+        return json.dumps(data, separators = (',', ':')).encode('utf-8')
+
+    @staticmethod
+    def decode_region(data):
+        '''Decode a RegionSnapshot from JSON bytes, None if the version is not supported'''
+        data = json.loads(data.decode('utf-8'))
+        if data.get('v') != Snapshot.VERSION:
+            return None
+        scanned = datetime.datetime.strptime(data['s'], Snapshot._TIME_FORMAT)
+        instances = dict((instance_id, InstanceEntry(bool(running), hash_value, tuple(schedule) if schedule else None))
+                         for instance_id, (running, hash_value, schedule) in data['i'].items())
+        return RegionSnapshot(scanned, instances)
+
+
+class FileSnapshotStore:
+    '''
+    Snapshot store backed by a local JSON file, for tests and local runs.
+
+    :param path: file path of the snapshot
+    '''
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, regions = None):
+        '''Load the snapshot, only the listed regions when regions is provided'''
+        snapshot = Snapshot()
+        for region, data in self._read().items():
+            if region in _RESERVED_KEYS or (regions is not None and region not in regions):
+                continue
+            region_snapshot = Snapshot.decode_region(data.encode('utf-8'))
+            if region_snapshot is not None:
+                snapshot.regions[region] = region_snapshot
+        return snapshot
+
+    def save(self, snapshot):
+        '''Replace the regions present in snapshot, other regions in the file are kept'''
+        regions = self._read()
+        for region, region_snapshot in snapshot.regions.items():
+            regions[region] = Snapshot.encode_region(region_snapshot).decode('utf-8')
+        self._write(regions)
+
+    def load_instance(self, region, instance_id):
+        '''Return the InstanceEntry of one instance or None'''
+        return _load_instance(self, region, instance_id)
+
+    def save_instance(self, region, instance_id, entry, updated):
+        '''Save the InstanceEntry of one instance, None removes it. The file keeps no update times, the entry is always saved.'''
+        return _save_instance(self, region, instance_id, entry)
+
+    def load_cursor(self):
+        '''Return the saved Cursor or None'''
+        data = self._read().get(CURSOR_KEY)
+        return decode_cursor(data) if data else None
+
+    def save_cursor(self, cursor):
+        '''Save a Cursor, None removes the saved cursor'''
+        regions = self._read()
+        if cursor is None:
+            if CURSOR_KEY not in regions:
+                return
+            del regions[CURSOR_KEY]
+        else:
+            regions[CURSOR_KEY] = encode_cursor(cursor)
+        self._write(regions)
+
+    def load_region_list(self):
+        '''Return the saved RegionList or None'''
+        data = self._read().get(REGION_LIST_KEY)
+        return decode_region_list(data) if data else None
+
+    def save_region_list(self, region_list):
+        '''Save a RegionList'''
+        regions = self._read()
+        regions[REGION_LIST_KEY] = encode_region_list(region_list)
+        self._write(regions)
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'rb') as f:
+            return json.loads(f.read().decode('utf-8'))
+
+    def _write(self, regions):
+        # Write then rename so a failed save does not corrupt the previous snapshot
+        temporary = self.path + '.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(json.dumps(regions, separators = (',', ':')).encode('utf-8'))
+        os.replace(temporary, self.path)
+
+
+class SQLiteSnapshotStore:
+    '''
+    Snapshot store backed by a SQLite database, one row per region.
+
+    :param path: database file path or ':memory:'
+    '''
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS regions (region TEXT PRIMARY KEY, data BLOB NOT NULL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS cursor (id INTEGER PRIMARY KEY CHECK (id = 0), data TEXT NOT NULL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS region_list (id INTEGER PRIMARY KEY CHECK (id = 0), data TEXT NOT NULL)')
+
+    def load(self, regions = None):
+        '''Load the snapshot, only the listed regions when regions is provided'''
+        snapshot = Snapshot()
+        if regions is None:
+            rows = self.connection.execute('SELECT region, data FROM regions')
+        else:
+            regions = list(regions)
+            query = 'SELECT region, data FROM regions WHERE region IN ({})'.format(','.join('?' * len(regions)))
+            rows = self.connection.execute(query, regions)
+        for region, data in rows:
+            region_snapshot = Snapshot.decode_region(zlib.decompress(data))
+            if region_snapshot is not None:
+                snapshot.regions[region] = region_snapshot
+        return snapshot
+
+    def save(self, snapshot):
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO regions (region, data) VALUES (?, ?)',
+                [(region, zlib.compress(Snapshot.encode_region(region_snapshot)))
+                 for region, region_snapshot in snapshot.regions.items()])
+
+    def load_instance(self, region, instance_id):
+        '''Return the InstanceEntry of one instance or None'''
+        return _load_instance(self, region, instance_id)
+
+    def save_instance(self, region, instance_id, entry, updated):
+        '''Save the InstanceEntry of one instance, None removes it. The database keeps no update times, the entry is always saved.'''
+        return _save_instance(self, region, instance_id, entry)
+
+    def load_cursor(self):
+        '''Return the saved Cursor or None'''
+        row = self.connection.execute('SELECT data FROM cursor WHERE id = 0').fetchone()
+        return decode_cursor(row[0]) if row else None
+
+    def save_cursor(self, cursor):
+        '''Save a Cursor, None removes the saved cursor'''
+        with self.connection:
+            if cursor is None:
+                self.connection.execute('DELETE FROM cursor')
+            else:
+                self.connection.execute('INSERT OR REPLACE INTO cursor (id, data) VALUES (0, ?)', (encode_cursor(cursor),))
+
+    def load_region_list(self):
+        '''Return the saved RegionList or None'''
+        row = self.connection.execute('SELECT data FROM region_list WHERE id = 0').fetchone()
+        return decode_region_list(row[0]) if row else None
+
+    def save_region_list(self, region_list):
+        '''Save a RegionList'''
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO region_list (id, data) VALUES (0, ?)', (encode_region_list(region_list),))
+
+
+class DynamoDBSnapshotStore:
+    '''
+    Snapshot store backed by a DynamoDB table with a 'region' string hash
+    key and an 'instance' string range key.
+
+    Every instance is an item of its own so an event reads and writes a
+    single instance. The scan time of a region is kept in its item of
+    instance REGION_ITEM, the cursor and the region list in the
+    REGION_ITEM items of CURSOR_KEY and REGION_LIST_KEY.
+
+    Instance items record when their entry was observed and a write only
+    replaces or deletes an item that is not newer, so the scheduled run
+    and concurrent events do not lose each other's updates. save only
+    writes the instances that changed since they were loaded.
+
+    :param table_name: name of the DynamoDB table
+    :param client_factory: callable returning a DynamoDB client, boto3.client signature
+    '''
+    # Range key of the items that are not instances
+    REGION_ITEM = '#'
+
+    # Instance items written at the same time by save
+    MAX_WORKERS = 8
+
+    def __init__(self, table_name, client_factory = None):
+        self.table_name = table_name
+        self.client_factory = client_factory or clients.get_client
+        # Instances of the regions loaded, save compares them with the new snapshot
+        self._loaded = {}
+
+    def load(self, regions = None):
+        '''Load the snapshot, only the listed regions when regions is provided'''
+        dynamodb = self.client_factory('dynamodb')
+        if regions is None:
+            pages = dynamodb.get_paginator('scan').paginate(TableName = self.table_name)
+        else:
+            regions = list(regions)
+            paginator = dynamodb.get_paginator('query')
+            pages = (page for region in regions for page in paginator.paginate(
+                TableName = self.table_name, KeyConditionExpression = '#r = :r',
+                ExpressionAttributeNames = {'#r': 'region'}, ExpressionAttributeValues = {':r': {'S': region}}))
+
+        scanned = {}
+        instances = dict((region, {}) for region in regions or [])
+        for page in pages:
+            for item in page['Items']:
+                region, key = item['region']['S'], item['instance']['S']
+                if region in _RESERVED_KEYS:
+                    continue
+                if key == DynamoDBSnapshotStore.REGION_ITEM:
+                    scanned[region] = datetime.datetime.strptime(item['scanned']['S'], Snapshot._TIME_FORMAT)
+                else:
+                    instances.setdefault(region, {})[key] = self._decode_entry(item)
+
+        snapshot = Snapshot()
+        for region in set(scanned) | set(instances):
+            region_instances = instances.get(region, {})
+            self._loaded[region] = dict(region_instances)
+            if region in scanned or region_instances:
+                snapshot.regions[region] = RegionSnapshot(scanned.get(region, NEVER_SCANNED), region_instances)
+        return snapshot
+
+    def save(self, snapshot):
+        '''Save the scan time of the regions in snapshot and the instances that changed, observed at that time'''
+        dynamodb = self.client_factory('dynamodb')
+        unknown = [region for region in snapshot.regions if region not in self._loaded]
+        if unknown:
+            self.load(unknown)
+
+        writes = []
+        for region, region_snapshot in snapshot.regions.items():
+            dynamodb.put_item(TableName = self.table_name, Item = {
+                'region': {'S': region},
+                'instance': {'S': DynamoDBSnapshotStore.REGION_ITEM},
+                'scanned': {'S': region_snapshot.scanned.strftime(Snapshot._TIME_FORMAT)},
+            })
+            loaded = self._loaded[region]
+            writes.extend((region, instance_id, entry, region_snapshot.scanned)
+                          for instance_id, entry in region_snapshot.instances.items() if loaded.get(instance_id) != entry)
+            writes.extend((region, instance_id, None, region_snapshot.scanned)
+                          for instance_id in loaded if instance_id not in region_snapshot.instances)
+            self._loaded[region] = dict(region_snapshot.instances)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers = DynamoDBSnapshotStore.MAX_WORKERS) as executor:
+            for future in [executor.submit(self.save_instance, *write) for write in writes]:
+                future.result()
+
+    def load_instance(self, region, instance_id):
+        '''Return the InstanceEntry of one instance or None'''
+        dynamodb = self.client_factory('dynamodb')
+        item = dynamodb.get_item(TableName = self.table_name, Key = self._key(region, instance_id), ConsistentRead = True).get('Item')
+        return self._decode_entry(item) if item else None
+
+    def save_instance(self, region, instance_id, entry, updated):
+        '''
+        Save the InstanceEntry of one instance observed at updated, None
+        removes it. Return False if the stored entry is newer and was kept.
+        '''
+        dynamodb = self.client_factory('dynamodb')
+        condition = {
+            'ConditionExpression': 'attribute_not_exists(#u) OR #u <= :u',
+            'ExpressionAttributeNames': {'#u': 'updated'},
+            'ExpressionAttributeValues': {':u': {'S': updated.strftime(Snapshot._TIME_FORMAT)}},
+        }
+        try:
+            if entry is None:
+                dynamodb.delete_item(TableName = self.table_name, Key = self._key(region, instance_id), **condition)
+            else:
+                item = self._key(region, instance_id)
+                item.update(self._encode_entry(entry))
+                item['updated'] = condition['ExpressionAttributeValues'][':u']
+                dynamodb.put_item(TableName = self.table_name, Item = item, **condition)
+        except Exception as e:
+            if not is_client_error(e) or e.response.get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+                raise
+            logger.info('Instance [{}:{}]: a newer entry is saved, keeping it'.format(region, instance_id))
+            return False
+        return True
+
+    def load_cursor(self):
+        '''Return the saved Cursor or None'''
+        dynamodb = self.client_factory('dynamodb')
+        item = dynamodb.get_item(TableName = self.table_name, Key = self._key(CURSOR_KEY, DynamoDBSnapshotStore.REGION_ITEM)).get('Item')
+        return decode_cursor(item['cursor']['S']) if item else None
+
+    def save_cursor(self, cursor):
+        '''Save a Cursor, None removes the saved cursor'''
+        dynamodb = self.client_factory('dynamodb')
+        if cursor is None:
+            dynamodb.delete_item(TableName = self.table_name, Key = self._key(CURSOR_KEY, DynamoDBSnapshotStore.REGION_ITEM))
+        else:
+            item = self._key(CURSOR_KEY, DynamoDBSnapshotStore.REGION_ITEM)
+            item['cursor'] = {'S': encode_cursor(cursor)}
+            dynamodb.put_item(TableName = self.table_name, Item = item)
+
+    def load_region_list(self):
+        '''Return the saved RegionList or None'''
+        dynamodb = self.client_factory('dynamodb')
+        item = dynamodb.get_item(TableName = self.table_name, Key = self._key(REGION_LIST_KEY, DynamoDBSnapshotStore.REGION_ITEM)).get('Item')
+        return decode_region_list(item['regions']['S']) if item else None
+
+    def save_region_list(self, region_list):
+        '''Save a RegionList'''
+        dynamodb = self.client_factory('dynamodb')
+        item = self._key(REGION_LIST_KEY, DynamoDBSnapshotStore.REGION_ITEM)
+        item['regions'] = {'S': encode_region_list(region_list)}
+        dynamodb.put_item(TableName = self.table_name, Item = item)
+
+    @staticmethod
+    def _key(region, instance):
+        return {'region': {'S': region}, 'instance': {'S': instance}}
+
+    @staticmethod
+    def _encode_entry(entry):
+        attributes = {'running': {'BOOL': entry.running}, 'tag_hash': {'N': str(entry.tag_hash)}}
+        if entry.schedule:
+            attributes['schedule'] = {'S': json.dumps(list(entry.schedule), separators = (',', ':'))}
+        return attributes
+
+    @staticmethod
+    def _decode_entry(item):
+        schedule = tuple(json.loads(item['schedule']['S'])) if 'schedule' in item else None
+        return InstanceEntry(item['running']['BOOL'], int(item['tag_hash']['N']), schedule)
@@ -0,0 +1,56 @@
+import datetime
+
+# zoneinfo is part of the standard library from Python 3.9, pytz is the fallback
+try:
+    import zoneinfo
+except ImportError:
+    zoneinfo = None
+
+UTC = datetime.timezone.utc
+
+BACKEND = 'zoneinfo' if zoneinfo else 'pytz'
+
+def get_zone(name):
+    '''
+    Return the datetime.tzinfo of a time zone name.
+
+    zoneinfo zones are used when available. Names zoneinfo does not know,
+    such as names in another case, are looked up with pytz when it is
+    installed.
+
+    :raises ValueError: if the time zone is unknown
+    '''
+    if zoneinfo is not None:
+        try:
+            return zoneinfo.ZoneInfo(name)
+        except Exception:
+            pass
+    try:
+        import pytz
+        return pytz.timezone(name)
+    except Exception:
+        raise ValueError('invalid timezone "{}"'.format(name))
+
+def localize(time_zone, local):
+    '''
+    Return a naive local datetime.datetime made aware in a time zone.
+
+    Non-existent and repeated times resolve to standard time, as pytz
+    localize does by default, with either backend.
+    '''
+    if hasattr(time_zone, 'localize'):
+        return time_zone.localize(local)
+    first = local.replace(tzinfo = time_zone, fold = 0)
+    second = local.replace(tzinfo = time_zone, fold = 1)
+    if first.utcoffset() == second.utcoffset():
+        return first
+    # Around a transition standard time is the side without a DST offset
+    return second if first.dst() else first
+
+def to_local(timestamp, time_zone):
+    '''Return a naive datetime.datetime in UTC as an aware datetime in a time zone'''
+    return timestamp.replace(tzinfo = UTC).astimezone(time_zone)
+
+def to_utc(local):
+    '''Return an aware datetime.datetime as a naive datetime in UTC'''
+    return local.astimezone(UTC).replace(tzinfo = None)
@@ -0,0 +1,178 @@
+import time
+import botocore.exceptions
+
+class StubEC2Client:
+    '''
+    Minimal stand-in for a boto3 EC2 client.
+
+    :param regions: dict of region name to list of describe_instances instance dicts
+    :param region_name: region the client is bound to
+    :param latency: dict of region name to seconds slept on every API call
+    :param errors: dict of region name to exception raised on every API call
+    :param failing: set of instance ids that can not be started or stopped
+    :param orphans: instance ids returned by get_resources that no longer exist
+    '''
+    def __init__(self, regions, region_name = None, latency = None, errors = None, failing = None, orphans = None):
+        self.regions = regions
+        self.region_name = region_name
+        self.latency = latency or {}
+        self.errors = errors or {}
+        self.failing = failing or set()
+        self.orphans = orphans or []
+        self.calls = []
+        self.actions = []
+        self.filters = None
+
+    def _call(self, name):
+        self.calls.append(name)
+        time.sleep(self.latency.get(self.region_name, 0))
+        if self.region_name in self.errors:
+            raise self.errors[self.region_name]
+
+    def describe_regions(self):
+        self._call('describe_regions')
+        return {'Regions': [{'RegionName': region} for region in self.regions]}
+
+    def describe_instances(self, Filters = None, InstanceIds = None, MaxResults = None, NextToken = None):
+        '''Instances of the region, tokens are the string offset of the next page'''
+        self._call('describe_instances')
+        instances = self.regions.get(self.region_name, [])
+        if InstanceIds is not None:
+            instances = [instance for instance in instances if instance['InstanceId'] in InstanceIds]
+        self.filters = Filters
+        for item in Filters or []:
+            if item['Name'] == 'instance-state-name':
+                instances = [instance for instance in instances if instance['State']['Name'] in item['Values']]
+        offset = int(NextToken or 0)
+        page_size = MaxResults or len(instances)
+        result = {'Reservations': [{'Instances': instances[offset:offset + page_size]}]}
+        if offset + page_size < len(instances):
+            result['NextToken'] = str(offset + page_size)
+        return result
+
+    def describe_instance_status(self, InstanceIds, IncludeAllInstances = False):
+        self._call('describe_instance_status')
+        instances = dict((instance['InstanceId'], instance) for instance in self.regions.get(self.region_name, []))
+        missing = [instance_id for instance_id in InstanceIds if instance_id not in instances]
+        if missing:
+            error = {'Error': {'Code': 'InvalidInstanceID.NotFound', 'Message': "The instance IDs '{}' do not exist".format(', '.join(missing))}}
+            raise botocore.exceptions.ClientError(error, 'DescribeInstanceStatus')
+        return {'InstanceStatuses': [{'InstanceId': instance_id, 'InstanceState': instances[instance_id]['State']} for instance_id in InstanceIds]}
+
+    def start_instances(self, InstanceIds):
+        return self._change_state('start_instances', 'StartingInstances', InstanceIds)
+
+    def stop_instances(self, InstanceIds):
+        return self._change_state('stop_instances', 'StoppingInstances', InstanceIds)
+
+    def _change_state(self, operation_name, response_key, instance_ids):
+        self._call(operation_name)
+        self.actions.append((operation_name, list(instance_ids)))
+        failed = [instance_id for instance_id in instance_ids if instance_id in self.failing]
+        if failed:
+            error = {'Error': {'Code': 'IncorrectInstanceState', 'Message': 'cannot change state of {}'.format(failed)}}
+            raise botocore.exceptions.ClientError(error, operation_name)
+        return {response_key: [{'InstanceId': instance_id} for instance_id in instance_ids]}
+
+    def get_resources(self, TagFilters = None, ResourceTypeFilters = None, ResourcesPerPage = None, PaginationToken = None):
+        '''tag:GetResources over the instances of the region and the orphans, tokens are the string offset of the next page'''
+        self._call('get_resources')
+        page_size = ResourcesPerPage or 100
+        offset = int(PaginationToken or 0)
+        keys = [tag_filter['Key'] for tag_filter in TagFilters or []]
+        tagged = [(instance['InstanceId'], instance['Tags']) for instance in self.regions.get(self.region_name, [])]
+        tagged.extend((instance_id, [{'Key': 'Schedule', 'Value': '10:00;22:00;UTC;Mon'}]) for instance_id in self.orphans)
+        mappings = [{'ResourceARN': 'arn:aws:ec2:{}:123456789012:instance/{}'.format(self.region_name, instance_id), 'Tags': tags}
+                    for instance_id, tags in tagged if all(any(tag['Key'] == key for tag in tags) for key in keys)]
+        end = offset + page_size
+        return {'ResourceTagMappingList': mappings[offset:end], 'PaginationToken': str(end) if end < len(mappings) else ''}
+
+class StubClientFactory:
+    '''
+    Callable with the boto3.client signature returning StubEC2Client objects.
+
+    :param accounts: optional dict of account id to the regions of that
+        account, clients requested with an account keyword see these.
+        A missing account raises like a role that can not be assumed.
+    :param orphans: optional dict of region name to instance ids returned by
+        get_resources that no longer exist
+    '''
+    def actions(self):
+        '''Return the start and stop calls made by all clients as (region key, operation, ids)'''
+        return [(client.region_key,) + action for client in self.clients for action in client.actions]
+
+    def __init__(self, regions, latency = None, errors = None, failing = None, accounts = None, orphans = None):
+        self.regions = regions
+        self.latency = latency or {}
+        self.errors = errors or {}
+        self.failing = failing or set()
+        self.accounts = accounts or {}
+        self.orphans = orphans or {}
+        self.clients = []
+
+    def __call__(self, service, region_name = None, account = None, **kwargs):
+        regions = self.regions
+        if account is not None:
+            if account not in self.accounts:
+                error = {'Error': {'Code': 'AccessDenied', 'Message': 'not authorized to assume a role in {}'.format(account)}}
+                raise botocore.exceptions.ClientError(error, 'AssumeRole')
+            regions = self.accounts[account]
+        client = StubEC2Client(regions, region_name, self.latency, self.errors, self.failing, self.orphans.get(region_name))
+        client.region_key = account + ':' + region_name if account and region_name else region_name
+        self.clients.append(client)
+        return client
+
+class StubDynamoDB:
+    '''
+    Stand-in for a boto3 DynamoDB client holding items in memory, keyed by
+    region and instance. Items larger than the DynamoDB item size limit are
+    rejected and the only condition understood is the one on the updated
+    attribute of DynamoDBSnapshotStore.save_instance.
+    '''
+    MAX_ITEM_SIZE = 400 * 1024
+
+    def __init__(self):
+        self.items = {}
+
+    def put_item(self, TableName, Item, **condition):
+        size = sum(len(name) + len(str(next(iter(value.values())))) for name, value in Item.items())
+        if size > StubDynamoDB.MAX_ITEM_SIZE:
+            raise ValueError('Item size has exceeded the maximum allowed size')
+        key = (Item['region']['S'], Item['instance']['S'])
+        self._check(key, condition)
+        self.items[key] = Item
+
+    def get_item(self, TableName, Key, ConsistentRead = False):
+        item = self.items.get((Key['region']['S'], Key['instance']['S']))
+        return {'Item': item} if item else {}
+
+    def delete_item(self, TableName, Key, **condition):
+        key = (Key['region']['S'], Key['instance']['S'])
+        self._check(key, condition)
+        self.items.pop(key, None)
+
+    def get_paginator(self, operation_name):
+        return self
+
+    def paginate(self, TableName, ExpressionAttributeValues = None, **kwargs):
+        region = ExpressionAttributeValues[':r']['S'] if ExpressionAttributeValues else None
+        yield {'Items': [item for key, item in sorted(self.items.items()) if region is None or key[0] == region]}
+
+    def _check(self, key, condition):
+        if not condition:
+            return
+        item = self.items.get(key)
+        if item and item['updated']['S'] > condition['ExpressionAttributeValues'][':u']['S']:
+            error = {'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'The conditional request failed'}}
+            raise botocore.exceptions.ClientError(error, 'PutItem')
+
+def ec2_instance(instance_id, state = 'running', schedule = '10:00;22:00;UTC;Mon,Tue,Wed,Thu,Fri,Sat,Sun', tags = None):
+    '''Build a describe_instances style instance dict'''
+    instance_tags = [{'Key': 'Schedule', 'Value': schedule}]
+    for key, value in (tags or {}).items():
+        instance_tags.append({'Key': key, 'Value': value})
+    return {
+        'InstanceId': instance_id,
+        'State': {'Name': state},
+        'Tags': instance_tags,
+    }
@@ -0,0 +1,69 @@
+import context
+import unittest
+import os
+import sys
+import json
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../benchmarks')))
+
+import benchmark
+
+class BenchmarkTestCase(unittest.TestCase):
+    """
+    Smoke tests for the benchmark suite
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_synthetic_fleet(self):
+        '''
+            The fleet has the requested size spread over regions
+        '''
+        fleet = benchmark.synthetic_fleet(100)
+        self.assertEqual(sum(len(instances) for instances in fleet.values()), 100)
+        self.assertEqual(len(fleet), len(benchmark.REGIONS))
+
+    def test_results_written(self):
+        '''
+            Every benchmark writes its metrics and compares with a previous run
+        '''
+        output = os.path.join(self.directory, 'results.json')
+        self.assertEqual(benchmark.main(['--sizes', '10', '--output', output, '--no-budget']), 0)
+        with open(output) as f:
+            results = json.load(f)['results']
+
+        self.assertEqual(sorted(results), [
+            'handler.import',
+            'handler.run[10]',
+            'repository.get_scheduled_instances[10]',
+            'repository.tagged.get_scheduled_instances[10]',
+            'schedule.evaluate[10]',
+            'schedule.from_string[10]',
+        ])
+        for values in results.values():
+            self.assertEqual(sorted(values), ['items', 'p50', 'p99', 'peak_memory', 'repeat', 'throughput'])
+
+        self.assertEqual(benchmark.compare(results, results), [])
+
+class ColdStartTestCase(unittest.TestCase):
+    """
+    Import time of the Lambda entry point
+    """
+
+    def test_deferred_modules(self):
+        '''
+            Importing the handler does not load boto3 or botocore
+        '''
+        modules = benchmark.import_module()[2]
+        self.assertIn('handler', modules)
+        for module in benchmark.DEFERRED_MODULES:
+            self.assertNotIn(module, modules)
+
+if __name__ == '__main__':
+    unittest.main()
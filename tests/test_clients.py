@@ -0,0 +1,169 @@
+import context
+import unittest
+import datetime
+import threading
+
+import clients
+
+class StubSession:
+    '''
+    Stand-in for boto3.session.Session that records the clients created
+    '''
+    created = []
+
+    def client(self, service, region_name = None, config = None):
+        client = (service, region_name, config.max_pool_connections)
+        StubSession.created.append(client)
+        return object()
+
+class ClientPoolTestCase(unittest.TestCase):
+    """
+    Unit tests for clients.ClientPool
+    """
+
+    def setUp(self):
+        StubSession.created = []
+        self.pool = clients.ClientPool(session_factory = StubSession)
+
+    def test_client_reused(self):
+        '''
+            A client is created once per service and region
+        '''
+        first = self.pool.client('ec2', 'us-east-1')
+        second = self.pool.client('ec2', region_name = 'us-east-1')
+        other = self.pool.client('ec2', 'eu-west-1')
+
+        self.assertIs(first, second)
+        self.assertIsNot(first, other)
+        self.assertEqual(len(StubSession.created), 2)
+
+    def test_client_reused_across_threads(self):
+        '''
+            Concurrent callers share a single client
+        '''
+        results = []
+        threads = [threading.Thread(target = lambda: results.append(self.pool.client('ec2', 'us-east-1'))) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(set(id(client) for client in results)), 1)
+        self.assertEqual(len(StubSession.created), 1)
+
+    def test_configure(self):
+        '''
+            Changing the connection pool size replaces existing clients
+        '''
+        first = self.pool.client('ec2', 'us-east-1')
+        self.pool.configure(max_pool_connections = 20)
+        second = self.pool.client('ec2', 'us-east-1')
+
+        self.assertIsNot(first, second)
+        self.assertEqual(StubSession.created[-1], ('ec2', 'us-east-1', 20))
+
+    def test_configure_unchanged(self):
+        '''
+            Configuring the same connection pool size keeps existing clients
+        '''
+        first = self.pool.client('ec2', 'us-east-1')
+        self.pool.configure(max_pool_connections = self.pool.max_pool_connections)
+        self.assertIs(first, self.pool.client('ec2', 'us-east-1'))
+
+class StubSTS:
+    '''
+    Stand-in for a boto3 STS client issuing credentials valid for an hour
+    '''
+    def __init__(self, session):
+        self.session = session
+
+    def assume_role(self, RoleArn, RoleSessionName, DurationSeconds):
+        self.session.assumed.append(RoleArn)
+        expiration = datetime.datetime.fromtimestamp(self.session.clock() + DurationSeconds, datetime.timezone.utc)
+        return {'Credentials': {
+            'AccessKeyId': 'key-{}'.format(len(self.session.assumed)),
+            'SecretAccessKey': 'secret',
+            'SessionToken': 'token',
+            'Expiration': expiration,
+        }}
+
+class StubAccountSession:
+    '''
+    Stand-in for boto3.session.Session recording assumed roles and the credentials of its clients
+    '''
+    assumed = []
+    now = 1000000.0
+
+    def __init__(self, aws_access_key_id = None, aws_secret_access_key = None, aws_session_token = None):
+        self.access_key = aws_access_key_id
+
+    @staticmethod
+    def clock():
+        return StubAccountSession.now
+
+    def client(self, service, region_name = None, config = None):
+        if service == 'sts':
+            return StubSTS(StubAccountSession)
+        return (service, region_name, self.access_key)
+
+class AccountTestCase(unittest.TestCase):
+    """
+    Clients of other accounts from clients.ClientPool
+    """
+
+    def setUp(self):
+        StubAccountSession.assumed = []
+        StubAccountSession.now = 1000000.0
+        self.pool = clients.ClientPool(session_factory = StubAccountSession, clock = StubAccountSession.clock)
+        self.accounts = self.pool.set_roles([
+            'arn:aws:iam::111111111111:role/scheduler',
+            'arn:aws:iam::222222222222:role/scheduler',
+        ])
+
+    def test_set_roles(self):
+        '''
+            The account of each role is returned
+        '''
+        self.assertEqual(self.accounts, ['111111111111', '222222222222'])
+
+    def test_credentials_cached(self):
+        '''
+            A role is assumed once for all the clients of its account
+        '''
+        first = self.pool.client('ec2', 'us-east-1', '111111111111')
+        self.assertIs(first, self.pool.client('ec2', 'us-east-1', '111111111111'))
+        self.pool.client('ec2', 'eu-west-1', '111111111111')
+        self.pool.client('ec2', 'eu-west-1', '222222222222')
+
+        self.assertEqual(first, ('ec2', 'us-east-1', 'key-1'))
+        self.assertEqual(StubAccountSession.assumed, ['arn:aws:iam::111111111111:role/scheduler', 'arn:aws:iam::222222222222:role/scheduler'])
+        self.assertEqual(self.pool.client('ec2', 'us-east-1'), ('ec2', 'us-east-1', None))
+
+    def test_credentials_refreshed(self):
+        '''
+            Credentials are assumed again with new clients before they expire
+        '''
+        first = self.pool.client('ec2', 'us-east-1', '111111111111')
+        StubAccountSession.now += clients.ClientPool.SESSION_DURATION - clients.ClientPool.REFRESH_MARGIN - 1
+        self.assertIs(first, self.pool.client('ec2', 'us-east-1', '111111111111'))
+
+        StubAccountSession.now += 1
+        second = self.pool.client('ec2', 'us-east-1', '111111111111')
+        self.assertEqual(second, ('ec2', 'us-east-1', 'key-2'))
+        self.assertEqual(len(StubAccountSession.assumed), 2)
+
+    def test_unknown_account(self):
+        '''
+            An account without a registered role is rejected
+        '''
+        self.assertRaises(ValueError, self.pool.client, 'ec2', 'us-east-1', '333333333333')
+
+    def test_split_region(self):
+        '''
+            Region keys of other accounts carry the account id
+        '''
+        self.assertEqual(clients.split_region('us-east-1'), (None, 'us-east-1'))
+        self.assertEqual(clients.split_region('111111111111:us-east-1'), ('111111111111', 'us-east-1'))
+
+if __name__ == '__main__':
+    unittest.main()
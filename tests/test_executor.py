@@ -0,0 +1,119 @@
+import context
+import unittest
+import time
+import threading
+import botocore.exceptions
+
+from executor import Executor, Task, TokenBucket, is_throttled
+
+def throttling_error():
+    error = {'Error': {'Code': 'RequestLimitExceeded', 'Message': 'Request limit exceeded.'}}
+    return botocore.exceptions.ClientError(error, 'StartInstances')
+
+class FakeProvider:
+    '''
+    Send callable with injectable latency and throttling errors
+
+    :param latency: seconds each call takes
+    :param throttled: number of calls per task answered with a throttling error
+    '''
+    def __init__(self, latency = 0, throttled = 0):
+        self.latency = latency
+        self.throttled = throttled
+        self.calls = {}
+        self.active = {}
+        self.max_active = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, task):
+        key = tuple(task.instance_ids)
+        with self._lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+            attempt = self.calls[key]
+            self.active[task.region] = self.active.get(task.region, 0) + 1
+            self.max_active[task.region] = max(self.max_active.get(task.region, 0), self.active[task.region])
+        try:
+            time.sleep(self.latency)
+            if attempt <= self.throttled:
+                raise throttling_error()
+            return dict((instance_id, True) for instance_id in task.instance_ids)
+        finally:
+            with self._lock:
+                self.active[task.region] -= 1
+
+class ExecutorTestCase(unittest.TestCase):
+    """
+    Unit tests for executor
+    """
+
+    def test_results_in_order(self):
+        '''
+            A result is returned for every task, in task order
+        '''
+        tasks = [Task('region-{}'.format(i % 3), 'start', ['i-{}'.format(i)]) for i in range(9)]
+        results = Executor(FakeProvider()).run(tasks)
+
+        self.assertEqual([result.task for result in results], tasks)
+        self.assertEqual([result.outcome for result in results], [{'i-{}'.format(i): True} for i in range(9)])
+
+    def test_bounded_parallelism(self):
+        '''
+            Calls in a region never exceed max_workers, regions run in parallel
+        '''
+        fake = FakeProvider(latency = 0.05)
+        tasks = [Task(region, 'start', ['{}-{}'.format(region, i)]) for region in ['a', 'b'] for i in range(8)]
+        start = time.time()
+        Executor(fake, max_workers = 2, rate = 1000, burst = 1000).run(tasks)
+        elapsed = time.time() - start
+
+        self.assertEqual(fake.max_active, {'a': 2, 'b': 2})
+        self.assertLess(elapsed, 0.05 * 8)
+
+    def test_throttling_backoff(self):
+        '''
+            Throttled calls are retried until they succeed
+        '''
+        fake = FakeProvider(throttled = 2)
+        executor = Executor(fake, base_delay = 0.01, max_delay = 0.02)
+        result = executor.run([Task('a', 'stop', ['i-1'])])[0]
+
+        self.assertEqual(result.outcome, {'i-1': True})
+        self.assertEqual(result.attempts, 3)
+        self.assertGreater(result.latency, 0)
+
+    def test_throttling_exhausted(self):
+        '''
+            The throttling error is returned once max_attempts is reached
+        '''
+        fake = FakeProvider(throttled = 10)
+        executor = Executor(fake, max_attempts = 3, base_delay = 0.01, max_delay = 0.02)
+        result = executor.run([Task('a', 'stop', ['i-1'])])[0]
+
+        self.assertTrue(is_throttled(result.outcome))
+        self.assertEqual(result.attempts, 3)
+
+    def test_error_returned(self):
+        '''
+            Other errors are not retried
+        '''
+        def send(task):
+            raise ValueError('bad task')
+        result = Executor(send).run([Task('a', 'stop', ['i-1'])])[0]
+
+        self.assertIsInstance(result.outcome, ValueError)
+        self.assertEqual(result.attempts, 1)
+
+    def test_token_bucket(self):
+        '''
+            Tokens beyond the burst are handed out at the bucket rate
+        '''
+        bucket = TokenBucket(rate = 50, capacity = 2)
+        start = time.time()
+        for i in range(7):
+            bucket.acquire()
+        elapsed = time.time() - start
+
+        self.assertGreaterEqual(elapsed, 5 / 50.0 * 0.9)
+
+if __name__ == '__main__':
+    unittest.main()
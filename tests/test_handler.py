@@ -0,0 +1,436 @@
+import context
+import unittest
+import io
+import os
+import json
+import shutil
+import tempfile
+import datetime
+import unittest.mock
+
+import clients
+import handler
+import scheduler
+import snapshot
+
+from stubs import StubClientFactory, StubDynamoDB, ec2_instance
+
+EVENTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'events')
+
+class HandlerTestCase(unittest.TestCase):
+    """
+    Unit tests for handler
+    """
+
+    def test_idle_without_previous_scan(self):
+        '''
+            A cold start always scans
+        '''
+        self.assertFalse(handler._is_idle(None, datetime.datetime(2018, 4, 23, 12, 0)))
+
+    def test_idle_before_transition(self):
+        '''
+            A run before the next transition is idle
+        '''
+        timestamp = datetime.datetime(2018, 4, 23, 12, 0)
+        transitions = scheduler.TransitionIndex(timestamp)
+        transitions.add(scheduler.Schedule.from_string('10:00;13:00;UTC;Mon'))
+
+        self.assertTrue(handler._is_idle(transitions, datetime.datetime(2018, 4, 23, 12, 30)))
+        self.assertTrue(handler._is_idle(transitions, datetime.datetime(2018, 4, 23, 13, 0)))
+        self.assertFalse(handler._is_idle(transitions, datetime.datetime(2018, 4, 23, 13, 1)))
+
+    def test_idle_reconcile(self):
+        '''
+            A full scan runs once the reconcile interval has passed
+        '''
+        timestamp = datetime.datetime(2018, 4, 23, 12, 0)
+        transitions = scheduler.TransitionIndex(timestamp)
+
+        self.assertTrue(handler._is_idle(transitions, timestamp + datetime.timedelta(minutes = 1)))
+        self.assertFalse(handler._is_idle(transitions, timestamp + handler.RECONCILE_INTERVAL))
+
+class DryRunTestCase(unittest.TestCase):
+    """
+    Plan a full scan through handler.run without acting on it
+    """
+
+    def test_dry_run(self):
+        '''
+            A dry run writes the plan as JSON Lines and sends no action
+        '''
+        factory = StubClientFactory({'us-east-1': [
+            ec2_instance('i-1', 'stopped', schedule = '00:00;NONE;UTC;Mon,Tue,Wed,Thu,Fri,Sat,Sun'),
+            ec2_instance('i-2', 'running', schedule = 'NONE;00:00;UTC;Mon,Tue,Wed,Thu,Fri,Sat,Sun'),
+        ]})
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'plan.jsonl')
+
+        with unittest.mock.patch.object(handler, 'PLAN_PATH', path), \
+                unittest.mock.patch.object(clients, 'get_client', factory):
+            summary = handler.run({'dry_run': True}, None)
+
+        self.assertEqual(summary, {'start': 1, 'stop': 1, 'unchanged': 0})
+        self.assertEqual(factory.actions(), [])
+        with open(path) as f:
+            entries = sorted((json.loads(line) for line in f), key = lambda entry: entry['id'])
+        self.assertEqual([(entry['id'], entry['running'], entry['action'], entry['dry_run']) for entry in entries], [
+            ('us-east-1:i-1', False, 'start', True),
+            ('us-east-1:i-2', True, 'stop', True),
+        ])
+
+class MetricsTestCase(unittest.TestCase):
+    """
+    Metrics record emitted by handler.run
+    """
+
+    def test_run_record(self):
+        '''
+            A run emits one record with its API latency, instances and actions
+        '''
+        factory = StubClientFactory({
+            'us-east-1': [ec2_instance('i-1', 'stopped', schedule = '00:00;NONE;UTC;Mon,Tue,Wed,Thu,Fri,Sat,Sun')],
+            'eu-west-1': [ec2_instance('i-2', 'stopped', schedule = 'invalid')],
+        })
+        stream = io.StringIO()
+        with unittest.mock.patch.object(clients, 'get_client', factory), \
+                unittest.mock.patch('sys.stdout', stream):
+            handler.run({}, None)
+
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(len(records), 1)
+        record = records[0]
+        self.assertIn('_aws', record)
+        self.assertEqual(record['InstancesScanned'], 2)
+        self.assertEqual(record['InstancesEvaluated'], 1)
+        self.assertEqual(record['InstancesStarted'], 1)
+        self.assertEqual(record['Regions']['us-east-1']['DescribeInstancesCalls'], 1)
+        self.assertIn('DescribeInstancesTime', record['Regions']['eu-west-1'])
+        for name in ['RunTime', 'ScanTime', 'EvaluationTime', 'ActionsTime', 'DescribeRegionsTime']:
+            self.assertIn(name, record)
+
+class LambdaContext:
+    '''
+    Stand-in for the Lambda context object
+
+    :param remaining: seconds left before the function times out
+    '''
+    invoked_function_arn = 'arn:aws:lambda:us-east-1:123456789012:function:scheduler'
+
+    def __init__(self, remaining):
+        self.remaining = remaining
+
+    def get_remaining_time_in_millis(self):
+        return int(self.remaining * 1000)
+
+class ResumeTestCase(unittest.TestCase):
+    """
+    Runs stopped before the Lambda timeout and resumed from their cursor
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'snapshot.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_handler(self, factory, remaining):
+        with unittest.mock.patch.object(handler, 'SNAPSHOT_PATH', self.path), \
+                unittest.mock.patch.object(handler, 'METRICS', False), \
+                unittest.mock.patch.object(handler, 'TIME_MARGIN', 0), \
+                unittest.mock.patch.object(clients, 'get_client', factory):
+            handler.run({}, LambdaContext(remaining))
+
+    def test_resumed_once(self):
+        '''
+            Every instance is started once across a stopped run and its resume
+        '''
+        schedule = '00:00;NONE;UTC;Mon,Tue,Wed,Thu,Fri,Sat,Sun'
+        factory = StubClientFactory({
+            'us-east-1': [ec2_instance('i-{}'.format(i), 'stopped', schedule) for i in range(1200)],
+        }, latency = {'us-east-1': 0.05})
+        store = snapshot.FileSnapshotStore(self.path)
+
+        self.run_handler(factory, 0.08)
+        cursor = store.load_cursor()
+        self.assertEqual(list(cursor.regions), ['us-east-1'])
+        first = [id for region, operation, ids in factory.actions() for id in ids]
+        self.assertLess(len(first), 1200)
+
+        self.run_handler(factory, 60)
+        self.assertIsNone(store.load_cursor())
+        started = [id for region, operation, ids in factory.actions() for id in ids]
+        self.assertEqual(len(started), 1200)
+        self.assertEqual(len(set(started)), 1200)
+        self.assertEqual(len(store.load().regions['us-east-1'].instances), 1200)
+
+    def test_stale_cursor_ignored(self):
+        '''
+            A cursor older than the resume window is dropped and all regions are scanned
+        '''
+        store = snapshot.FileSnapshotStore(self.path)
+        old = datetime.datetime.utcnow() - handler.RESUME_WINDOW
+        store.save_cursor(snapshot.Cursor(old, {'eu-west-1': None}, None))
+        factory = StubClientFactory({
+            'us-east-1': [ec2_instance('i-1', 'stopped', '00:00;NONE;UTC;Mon,Tue,Wed,Thu,Fri,Sat,Sun')],
+            'eu-west-1': [],
+        })
+
+        self.run_handler(factory, 60)
+        self.assertEqual(factory.actions(), [('us-east-1', 'start_instances', ['i-1'])])
+        self.assertIsNone(store.load_cursor())
+
+class RegionRetryTestCase(unittest.TestCase):
+    """
+    Regions that fail are retried on their own without holding back the others
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'snapshot.json')
+        schedule = '00:00;NONE;UTC;Mon,Tue,Wed,Thu,Fri,Sat,Sun'
+        self.factory = StubClientFactory({
+            'us-east-1': [ec2_instance('i-1', 'stopped', schedule)],
+            'eu-west-1': [ec2_instance('i-2', 'stopped', schedule)],
+        }, errors = {'eu-west-1': RuntimeError('UnauthorizedOperation')})
+
+        patches = [
+            unittest.mock.patch.object(handler, 'SNAPSHOT_PATH', self.path),
+            unittest.mock.patch.object(handler, 'METRICS', False),
+            unittest.mock.patch.object(handler, 'SKIP_IDLE_RUNS', True),
+            unittest.mock.patch.object(handler, '_transitions', None),
+            unittest.mock.patch.object(handler, '_retry', None),
+            unittest.mock.patch.object(clients, 'get_client', self.factory),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_calls(self):
+        '''Run the handler and return the regions of its describe_instances calls'''
+        self.factory.clients = []
+        handler.run({}, None)
+        return sorted(client.region_name for client in self.factory.clients for call in client.calls if call == 'describe_instances')
+
+    def retry_due(self):
+        handler._retry = handler._retry._replace(retry_at = datetime.datetime.utcnow())
+
+    def test_failed_region_retried(self):
+        '''
+            A failing region does not stop the full scan from arming the index and is retried alone with backoff
+        '''
+        self.assertEqual(self.run_calls(), ['eu-west-1', 'us-east-1'])
+        self.assertEqual(self.factory.actions(), [('us-east-1', 'start_instances', ['i-1'])])
+        self.assertIsNotNone(handler._transitions)
+        self.assertIsNone(snapshot.FileSnapshotStore(self.path).load_cursor())
+        self.assertEqual(handler._retry.regions, ['eu-west-1'])
+        first = handler._retry.retry_at
+
+        # Not due yet
+        self.assertEqual(self.run_calls(), [])
+
+        self.retry_due()
+        self.assertEqual(self.run_calls(), ['eu-west-1'])
+        self.assertEqual(handler._retry.attempts, 2)
+        self.assertGreater(handler._retry.retry_at - datetime.datetime.utcnow(), first - datetime.datetime.utcnow())
+
+        self.factory.errors.clear()
+        self.retry_due()
+        self.assertEqual(self.run_calls(), ['eu-west-1'])
+        self.assertEqual(self.factory.actions()[-1:], [('eu-west-1', 'start_instances', ['i-2'])])
+        self.assertIsNone(handler._retry)
+        self.assertIsNotNone(handler._transitions)
+
+    def test_transition_due_scans_all(self):
+        '''
+            A retry never replaces the full scan of a run with a transition due
+        '''
+        self.run_calls()
+        self.retry_due()
+        handler._transitions.add_transition(datetime.datetime.utcnow() - datetime.timedelta(minutes = 1))
+
+        self.assertEqual(self.run_calls(), ['eu-west-1', 'us-east-1'])
+
+    def test_retry_scheduled(self):
+        '''
+            The transition rule is moved to the retry of the failed regions, not to the next minute
+        '''
+        events = unittest.mock.Mock()
+        events.describe_rule.return_value = {'Description': 'Execute EC2 instance scheduler at the next transition', 'State': 'ENABLED'}
+        with unittest.mock.patch.object(handler, 'TRANSITION_RULE', 'scheduler-transition'), \
+                unittest.mock.patch.object(clients, 'get_client', lambda service, **kwargs: events if service == 'events' else self.factory(service, **kwargs)):
+            handler.run({}, None)
+        retry_at = handler._retry.retry_at
+        expression = 'cron({} {} {} {} ? {})'.format(retry_at.minute, retry_at.hour, retry_at.day, retry_at.month, retry_at.year)
+        self.assertEqual(events.put_rule.call_args[1]['ScheduleExpression'], expression)
+        self.assertEqual(events.put_rule.call_args[1]['Description'], 'Execute EC2 instance scheduler at the next transition')
+        self.assertEqual(events.put_rule.call_args[1]['State'], 'ENABLED')
+
+class RegionActivityTestCase(unittest.TestCase):
+    """
+    Runs that reuse the region list and skip regions without instances
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'snapshot.json')
+        self.factory = StubClientFactory({
+            'us-east-1': [ec2_instance('i-1', 'stopped', '00:00;NONE;UTC;Mon,Tue,Wed,Thu,Fri,Sat,Sun')],
+            'eu-west-1': [],
+            'ap-south-1': [],
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_handler(self, regions = None):
+        with unittest.mock.patch.object(handler, 'SNAPSHOT_PATH', self.path), \
+                unittest.mock.patch.object(handler, 'METRICS', False), \
+                unittest.mock.patch.object(handler, 'REGIONS', regions or []), \
+                unittest.mock.patch.object(clients, 'get_client', self.factory):
+            handler.run({}, None)
+
+    def run_calls(self, regions = None):
+        '''Run the handler and return the regions of its describe_regions and describe_instances calls'''
+        self.factory.clients = []
+        self.run_handler(regions)
+        calls = [(call, client.region_name) for client in self.factory.clients for call in client.calls]
+        return (sorted(region for call, region in calls if call == 'describe_regions'),
+                sorted(region for call, region in calls if call == 'describe_instances'))
+
+    def test_empty_regions_skipped(self):
+        '''
+            The region list is described once and empty regions are only scanned again once their scan is old
+        '''
+        self.assertEqual(self.run_calls(), ([None], ['ap-south-1', 'eu-west-1', 'us-east-1']))
+        self.assertEqual(self.run_calls(), ([], ['us-east-1']))
+
+        with unittest.mock.patch.object(handler, 'EMPTY_REGION_TTL', datetime.timedelta(0)):
+            self.assertEqual(self.run_calls(), ([], ['ap-south-1', 'eu-west-1', 'us-east-1']))
+
+    def test_stale_region_list(self):
+        '''
+            A region list older than its TTL is described again
+        '''
+        store = snapshot.FileSnapshotStore(self.path)
+        old = datetime.datetime.utcnow() - handler.REGION_LIST_TTL
+        store.save_region_list(snapshot.RegionList(old, [], ['us-east-1']))
+
+        self.assertEqual(self.run_calls()[0], [None])
+        self.assertEqual(store.load_region_list().regions, ['us-east-1', 'eu-west-1', 'ap-south-1'])
+
+    def test_allow_list(self):
+        '''
+            Pinned regions are scanned without describing the regions of the account
+        '''
+        self.assertEqual(self.run_calls(['us-east-1', 'eu-west-1']), ([], ['eu-west-1', 'us-east-1']))
+        self.assertIsNone(snapshot.FileSnapshotStore(self.path).load_region_list())
+
+class OnEventTestCase(unittest.TestCase):
+    """
+    Replay recorded events through handler.on_event
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'snapshot.json')
+        self.factory = StubClientFactory({'us-east-1': [ec2_instance('i-2', 'stopped', schedule = 'invalid')]})
+
+        # Instance i-1 is always scheduled to run
+        store = snapshot.FileSnapshotStore(self.path)
+        store.save(snapshot.Snapshot({'us-east-1': snapshot.RegionSnapshot(snapshot.NEVER_SCANNED, {
+            'i-1': snapshot.InstanceEntry(True, 0, (0, None, 'UTC', 127)),
+        })}))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def replay(self, name, **detail):
+        with open(os.path.join(EVENTS_DIR, name + '.json')) as f:
+            event = json.load(f)
+        event['detail'].update(detail)
+        with unittest.mock.patch.object(handler, 'SNAPSHOT_PATH', self.path), \
+                unittest.mock.patch.object(clients, 'get_client', self.factory):
+            handler.on_event(event, None)
+        return snapshot.FileSnapshotStore(self.path).load()
+
+    def test_stopped_instance_restarted(self):
+        '''
+            A scheduled instance stopped outside its schedule is started again
+        '''
+        loaded = self.replay('state_change_stopped')
+        self.assertEqual(loaded.get('us-east-1:i-1').running, False)
+        self.assertEqual(self.factory.actions(), [('us-east-1', 'start_instances', ['i-1'])])
+
+    def test_dry_run(self):
+        '''
+            A dry run plans the start without sending it or saving the snapshot
+        '''
+        with unittest.mock.patch.object(handler, 'DRY_RUN', True):
+            loaded = self.replay('state_change_stopped')
+        self.assertEqual(self.factory.actions(), [])
+        self.assertEqual(loaded.get('us-east-1:i-1').running, True)
+
+    def test_stopping_instance_not_acted_on(self):
+        '''
+            An instance that is still stopping is neither recorded nor acted on
+        '''
+        loaded = self.replay('state_change_stopped', state = 'stopping')
+        self.assertEqual(loaded.get('us-east-1:i-1').running, True)
+        self.assertEqual(self.factory.actions(), [])
+
+    def test_failed_action_logged(self):
+        '''
+            A failed start is logged and the snapshot is still saved
+        '''
+        self.factory.failing.add('i-1')
+        with self.assertLogs(level = 'ERROR'):
+            loaded = self.replay('state_change_stopped')
+        self.assertEqual(loaded.get('us-east-1:i-1').running, False)
+
+    def test_unchanged_snapshot_not_saved(self):
+        '''
+            An event that does not change the snapshot does not save it
+        '''
+        with unittest.mock.patch.object(snapshot.FileSnapshotStore, 'save') as save:
+            self.replay('state_change_stopped', **{'instance-id': 'i-3'})
+        save.assert_not_called()
+
+    def test_single_instance_read(self):
+        '''
+            An event reads and writes only the item of its instance in the snapshot table
+        '''
+        dynamodb = StubDynamoDB()
+        store = snapshot.DynamoDBSnapshotStore('snapshot', client_factory = lambda service, region_name = None: dynamodb)
+        store.save(snapshot.FileSnapshotStore(self.path).load())
+        with open(os.path.join(EVENTS_DIR, 'state_change_stopped.json')) as f:
+            event = json.load(f)
+
+        def factory(service, region_name = None, **kwargs):
+            return dynamodb if service == 'dynamodb' else self.factory(service, region_name, **kwargs)
+
+        with unittest.mock.patch.object(handler, 'SNAPSHOT_TABLE', 'snapshot'), \
+                unittest.mock.patch.object(clients, 'get_client', factory), \
+                unittest.mock.patch.object(dynamodb, 'get_paginator') as get_paginator:
+            handler.on_event(event, None)
+
+        get_paginator.assert_not_called()
+        self.assertEqual(store.load_instance('us-east-1', 'i-1').running, False)
+        self.assertEqual(dynamodb.items[('us-east-1', 'i-1')]['updated']['S'], '2018-04-23T12:00:00')
+        self.assertEqual(self.factory.actions(), [('us-east-1', 'start_instances', ['i-1'])])
+
+    def test_tag_change_recorded(self):
+        '''
+            A newly tagged instance is added to the snapshot
+        '''
+        loaded = self.replay('tag_change_schedule')
+        self.assertEqual(loaded.get('us-east-1:i-2').schedule, (480, 1080, 'UTC', 31))
+        self.assertIsNotNone(loaded.get('us-east-1:i-1'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,7 +6,7 @@ import logging
 import pytz
 import datetime
 
-from scheduler import Instance, Schedule, Day
+from scheduler import Instance, Schedule, Day, evaluate_instances
 
 DEFAULT_ID = 0
 
@@ -229,5 +229,65 @@ class InstanceTestCase(unittest.TestCase):
         inst.evaluate_schedule(timestamp)
         self.assertEqual(inst.running, True)
 
+    def test_evaluate_instances(self):
+        '''
+            Bulk evaluation changes the running state of each instance
+        '''
+        instances = [
+            Instance(1, False, DEFAULT_SCHEDULE),
+            Instance(2, True, NO_START_SCHEDULE),
+            Instance(3, True, None),
+        ]
+
+        timestamp = datetime.datetime(2018, 4, 23, 23, 0)
+        evaluate_instances(instances, timestamp)
+        self.assertEqual([inst.running for inst in instances], [False, False, True])
+
+        timestamp = datetime.datetime(2018, 4, 23, 12, 0)
+        evaluate_instances(instances, timestamp)
+        self.assertEqual([inst.running for inst in instances], [True, False, True])
+
+    def test_dry_run(self):
+        '''
+            A dry run plans the change without applying it
+        '''
+        inst = Instance(DEFAULT_ID, False, DEFAULT_SCHEDULE)
+
+        timestamp = datetime.datetime(2018, 4, 23, 12, 0)
+        entry = inst.evaluate_schedule(timestamp, dry_run = True)
+        self.assertEqual(inst.running, False)
+        self.assertEqual(entry.action, 'start')
+        self.assertEqual(entry.target, True)
+        self.assertEqual(entry.schedule, DEFAULT_SCHEDULE)
+
+        entry = inst.evaluate_schedule(timestamp)
+        self.assertEqual(inst.running, True)
+        self.assertEqual(entry.action, 'start')
+
+    def test_plan_reasons(self):
+        '''
+            Instances left unchanged are planned with the reason why
+        '''
+        instances = [
+            Instance(1, True, DEFAULT_SCHEDULE),
+            Instance(2, True, NO_START_SCHEDULE),
+        ]
+
+        timestamp = datetime.datetime(2018, 4, 23, 12, 0)
+        entries = evaluate_instances(instances, timestamp, dry_run = True)
+        self.assertEqual([(entry.id, entry.action, entry.reason) for entry in entries], [
+            (1, None, 'already running'),
+            (2, None, 'no start or stop time passed today'),
+        ])
+        self.assertEqual(Instance(3, True, None).evaluate_schedule(timestamp).reason, 'no schedule')
+
+    def test_slots(self):
+        '''
+            Instances do not carry a per-object dict
+        '''
+        inst = Instance(DEFAULT_ID, True, DEFAULT_SCHEDULE)
+        with self.assertRaises(AttributeError):
+            inst.other = None
+
 if __name__ == '__main__':
     unittest.main()
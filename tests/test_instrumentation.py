@@ -0,0 +1,74 @@
+import context
+import unittest
+import io
+import json
+
+from instrumentation import Metrics
+
+class MetricsTestCase(unittest.TestCase):
+    """
+    Unit tests for instrumentation.Metrics
+    """
+
+    def test_counters_and_timers(self):
+        '''
+            Totals and per region values are recorded
+        '''
+        metrics = Metrics()
+        metrics.increment('InstancesScanned', 3, 'us-east-1')
+        metrics.increment('InstancesScanned', 2, 'eu-west-1')
+        metrics.add_time('DescribeInstances', 0.5, 'us-east-1')
+        with metrics.timer('Run'):
+            pass
+
+        self.assertEqual(metrics.counters['InstancesScanned'], 5)
+        self.assertEqual(metrics.timers['DescribeInstances'], 0.5)
+        self.assertIn('Run', metrics.timers)
+        self.assertEqual(metrics.regions['us-east-1'], {'InstancesScanned': 3, 'DescribeInstancesTime': 500})
+
+    def test_emf_record(self):
+        '''
+            The record declares every metric in the embedded metric format
+        '''
+        metrics = Metrics()
+        metrics.increment('InstancesStarted', region = 'us-east-1')
+        metrics.add_time('Actions', 0.25)
+        record = metrics.to_emf(timestamp = 1524484800, properties = {'DryRun': False})
+
+        self.assertEqual(record['_aws'], {
+            'Timestamp': 1524484800000,
+            'CloudWatchMetrics': [{
+                'Namespace': Metrics.NAMESPACE,
+                'Dimensions': [[]],
+                'Metrics': [
+                    {'Name': 'ActionsTime', 'Unit': 'Milliseconds'},
+                    {'Name': 'InstancesStarted', 'Unit': 'Count'},
+                ],
+            }],
+        })
+        self.assertEqual(record['ActionsTime'], 250)
+        self.assertEqual(record['InstancesStarted'], 1)
+        self.assertEqual(record['Regions'], {'us-east-1': {'InstancesStarted': 1}})
+        self.assertEqual(record['DryRun'], False)
+
+        stream = io.StringIO()
+        metrics.emit(stream)
+        self.assertEqual(json.loads(stream.getvalue())['InstancesStarted'], 1)
+
+    def test_disabled(self):
+        '''
+            Disabled metrics record and emit nothing
+        '''
+        metrics = Metrics(enabled = False)
+        metrics.increment('InstancesScanned', region = 'us-east-1')
+        with metrics.timer('Run'):
+            pass
+        stream = io.StringIO()
+        metrics.emit(stream)
+
+        self.assertEqual(metrics.counters, {})
+        self.assertEqual(metrics.timers, {})
+        self.assertEqual(stream.getvalue(), '')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import context
+import unittest
+import io
+import json
+import random
+import datetime
+
+import plan
+import logs
+
+from scheduler import PlanEntry, Schedule
+
+SCHEDULE = Schedule.from_string('10:00;22:00;UTC;Mon,Tue,Wed,Thu,Fri')
+
+class PlanWriterTestCase(unittest.TestCase):
+    """
+    Unit tests for plan.PlanWriter
+    """
+
+    def test_json_lines(self):
+        '''
+            Each entry is written as a JSON object on its own line
+        '''
+        stream = io.StringIO()
+        writer = plan.PlanWriter(stream, datetime.datetime(2018, 4, 23, 12, 0), dry_run = True)
+        writer.write([
+            PlanEntry('us-east-1:i-1', False, True, SCHEDULE, 'start', 'start time passed'),
+            PlanEntry('us-east-1:i-2', True, True, SCHEDULE, None, 'already running'),
+        ])
+
+        lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(lines[0], {
+            'timestamp': '2018-04-23T12:00:00',
+            'dry_run': True,
+            'id': 'us-east-1:i-1',
+            'running': False,
+            'target': True,
+            'schedule': str(SCHEDULE),
+            'action': 'start',
+            'reason': 'start time passed',
+        })
+        self.assertEqual(writer.summary(), {'start': 1, 'stop': 0, 'unchanged': 1})
+
+class PlanSummaryTestCase(unittest.TestCase):
+    """
+    Unit tests for plan.PlanSummary
+    """
+
+    def test_counts_and_samples(self):
+        '''
+            Entries are counted by action and reason with a bounded sample
+        '''
+        summary = plan.PlanSummary(sample_size = 2, rng = random.Random(1))
+        summary.add(PlanEntry('i-{}'.format(i), True, True, SCHEDULE, None, 'already running') for i in range(100))
+        summary.add([PlanEntry('i-stop', True, False, SCHEDULE, 'stop', 'stop time passed')])
+
+        self.assertEqual(summary.counts[(None, 'already running')], 100)
+        self.assertEqual(len(summary.samples[(None, 'already running')]), 2)
+        self.assertEqual(summary.samples[('stop', 'stop time passed')], ['i-stop'])
+        self.assertTrue(str(summary).startswith('101 instances evaluated; none (already running): 100 e.g. '))
+        self.assertIn('stop (stop time passed): 1 e.g. i-stop', str(summary))
+
+class LazyMessageTestCase(unittest.TestCase):
+    """
+    Unit tests for logs.LazyMessage
+    """
+
+    def test_formatted_when_emitted(self):
+        '''
+            Arguments are only formatted when the message is emitted
+        '''
+        formatted = []
+        class Value:
+            def __format__(self, spec):
+                formatted.append(spec)
+                return 'value'
+
+        message = logs.lazy('Instance [{}]: {}', 'i-1', Value())
+        self.assertEqual(formatted, [])
+        self.assertEqual(str(message), 'Instance [i-1]: value')
+        self.assertEqual(len(formatted), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,11 +3,11 @@ import unittest
 
 import provider.aws
 
+from stubs import StubClientFactory
+
 class ProviderTestCase(unittest.TestCase):
     """
     Unit tests for provider.aws
-
-    TODO: Add additional tests using AWS API mocks
     """
 
     def test_create_provider(self):
@@ -18,5 +18,110 @@ class ProviderTestCase(unittest.TestCase):
         pro = provider.aws.EC2(id)
         self.assertTrue(pro)
 
+    def test_provider_queues_on_dispatcher(self):
+        '''
+            Start and stop are queued on the dispatcher, not sent
+        '''
+        factory = StubClientFactory({})
+        dispatcher = provider.aws.Dispatcher(client_factory = factory)
+        provider.aws.EC2('us-east-1:i-1', dispatcher).start()
+        provider.aws.EC2('us-east-1:i-2', dispatcher).stop()
+        self.assertEqual(factory.actions(), [])
+
+        results = dispatcher.flush()
+        self.assertEqual(results, {'us-east-1:i-1': True, 'us-east-1:i-2': True})
+
+class DispatcherTestCase(unittest.TestCase):
+    """
+    Unit tests for provider.aws.Dispatcher
+    """
+
+    def test_grouped_by_region_and_action(self):
+        '''
+            One call is made per region and action
+        '''
+        factory = StubClientFactory({})
+        dispatcher = provider.aws.Dispatcher(client_factory = factory)
+        dispatcher.add('us-east-1:i-1', provider.aws.Dispatcher.START)
+        dispatcher.add('us-east-1:i-2', provider.aws.Dispatcher.START)
+        dispatcher.add('us-east-1:i-3', provider.aws.Dispatcher.STOP)
+        dispatcher.add('eu-west-1:i-4', provider.aws.Dispatcher.START)
+        dispatcher.flush()
+
+        self.assertEqual(sorted(factory.actions()), [
+            ('eu-west-1', 'start_instances', ['i-4']),
+            ('us-east-1', 'start_instances', ['i-1', 'i-2']),
+            ('us-east-1', 'stop_instances', ['i-3']),
+        ])
+
+    def test_other_account(self):
+        '''
+            Instances of another account are sent with the clients of that account
+        '''
+        factory = StubClientFactory({}, accounts = {'111111111111': {}})
+        dispatcher = provider.aws.Dispatcher(client_factory = factory)
+        dispatcher.add('us-east-1:i-1', provider.aws.Dispatcher.START)
+        dispatcher.add('111111111111:us-east-1:i-2', provider.aws.Dispatcher.START)
+        results = dispatcher.flush()
+
+        self.assertEqual(sorted(factory.actions()), [
+            ('111111111111:us-east-1', 'start_instances', ['i-2']),
+            ('us-east-1', 'start_instances', ['i-1']),
+        ])
+        self.assertEqual(results, {'us-east-1:i-1': True, '111111111111:us-east-1:i-2': True})
+
+    def test_chunked_by_batch_size(self):
+        '''
+            Batches are split by batch size and only sent on flush
+        '''
+        factory = StubClientFactory({})
+        dispatcher = provider.aws.Dispatcher(batch_size = 2, client_factory = factory)
+        for i in range(5):
+            dispatcher.add('us-east-1:i-{}'.format(i), provider.aws.Dispatcher.STOP)
+        self.assertEqual(factory.actions(), [])
+
+        results = dispatcher.flush()
+        self.assertEqual(sorted(len(ids) for region, operation, ids in factory.actions()), [1, 2, 2])
+        self.assertEqual(len(results), 5)
+        self.assertEqual(len(dispatcher.reports), 5)
+
+    def test_plan(self):
+        '''
+            The plan lists one task per API call without sending anything
+        '''
+        factory = StubClientFactory({})
+        dispatcher = provider.aws.Dispatcher(batch_size = 2, client_factory = factory)
+        for i in range(3):
+            dispatcher.add('us-east-1:i-{}'.format(i), provider.aws.Dispatcher.START)
+        dispatcher.add('eu-west-1:i-3', provider.aws.Dispatcher.STOP)
+
+        self.assertEqual([tuple(task) for task in dispatcher.plan()], [
+            ('eu-west-1', 'stop', ['i-3']),
+            ('us-east-1', 'start', ['i-0', 'i-1']),
+            ('us-east-1', 'start', ['i-2']),
+        ])
+        self.assertEqual(factory.actions(), [])
+
+    def test_failed_instance_isolated(self):
+        '''
+            A failing instance is reported without failing the rest of its batch
+        '''
+        factory = StubClientFactory({}, failing = set(['i-2']))
+        dispatcher = provider.aws.Dispatcher(client_factory = factory)
+        for i in range(3):
+            dispatcher.add('us-east-1:i-{}'.format(i), provider.aws.Dispatcher.START)
+        results = dispatcher.flush()
+
+        self.assertIs(results['us-east-1:i-0'], True)
+        self.assertIs(results['us-east-1:i-1'], True)
+        self.assertIsNot(results['us-east-1:i-2'], True)
+
+    def test_invalid_batch_size(self):
+        '''
+            The batch size can not exceed the API limit
+        '''
+        with self.assertRaises(ValueError):
+            provider.aws.Dispatcher(batch_size = provider.aws.Dispatcher.MAX_BATCH_SIZE + 1)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,8 +1,23 @@
 import context
 import unittest
 import logging
+import time
+import os
+import json
+
+import botocore.session
+import botocore.stub
 
 import repository.aws
+import scheduler
+
+from stubs import StubClientFactory, ec2_instance
+
+EVENTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'events')
+
+def load_event(name):
+    with open(os.path.join(EVENTS_DIR, name + '.json')) as f:
+        return json.load(f)
 
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
@@ -11,8 +26,6 @@ logger.addHandler(logging.StreamHandler())
 class RepositoryTestCase(unittest.TestCase):
     """
     Unit tests for repository.aws
-
-    TODO: Add additional tests using AWS API mocks
     """
 
     def test_create(self):
@@ -22,5 +35,426 @@ class RepositoryTestCase(unittest.TestCase):
         repo = repository.aws.EC2()
         self.assertTrue(repo)
 
+    def test_get_scheduled_instances(self):
+        '''
+            Instances from every region are returned
+        '''
+        regions = {
+            'us-east-1': [ec2_instance('i-1'), ec2_instance('i-2', 'stopped')],
+            'eu-west-1': [ec2_instance('i-3')],
+            'ap-south-1': [],
+        }
+        repo = repository.aws.EC2(client_factory = StubClientFactory(regions))
+        instances = repo.get_scheduled_instances()
+
+        ids = sorted(instance.id for instance in instances)
+        self.assertEqual(ids, ['eu-west-1:i-3', 'us-east-1:i-1', 'us-east-1:i-2'])
+
+    def test_other_accounts(self):
+        '''
+            Instances of other accounts carry their account in their id and snapshot region
+        '''
+        factory = StubClientFactory({'us-east-1': [ec2_instance('i-1')]}, accounts = {
+            '111111111111': {'us-east-1': [ec2_instance('i-2')], 'eu-west-1': [ec2_instance('i-3')]},
+        })
+        repo = repository.aws.EC2(client_factory = factory, accounts = ['111111111111', '222222222222'])
+        instances = repo.get_scheduled_instances()
+
+        ids = sorted(instance.id for instance in instances)
+        self.assertEqual(ids, ['111111111111:eu-west-1:i-3', '111111111111:us-east-1:i-2', 'us-east-1:i-1'])
+        self.assertEqual(sorted(repo.snapshot.regions), ['111111111111:eu-west-1', '111111111111:us-east-1', 'us-east-1'])
+        self.assertIsNotNone(repo.snapshot.get('111111111111:us-east-1:i-2'))
+
+    def test_other_account_event(self):
+        '''
+            An event of another account updates the instance of that account
+        '''
+        factory = StubClientFactory({}, accounts = {'123456789012': {'us-east-1': [ec2_instance('i-2', 'stopped', schedule = 'invalid')]}})
+        repo = repository.aws.EC2(client_factory = factory, accounts = ['123456789012'])
+
+        region, instance = repo.apply_event(load_event('tag_change_schedule'))
+        self.assertEqual(region, '123456789012:us-east-1')
+        self.assertEqual(instance.id, '123456789012:us-east-1:i-2')
+        self.assertEqual(instance.running, False)
+
+    def test_regions_scanned_concurrently(self):
+        '''
+            Region latency is not summed across regions
+        '''
+        regions = dict(('region-{}'.format(i), [ec2_instance('i-{}'.format(i))]) for i in range(8))
+        latency = dict((region, 0.2) for region in regions)
+        repo = repository.aws.EC2(max_workers = 8, client_factory = StubClientFactory(regions, latency))
+
+        start = time.time()
+        instances = repo.get_scheduled_instances()
+        elapsed = time.time() - start
+
+        self.assertEqual(len(instances), 8)
+        self.assertLess(elapsed, 0.2 * 4)
+
+    def test_region_error_isolated(self):
+        '''
+            A failing region does not prevent other regions being returned
+        '''
+        regions = {
+            'us-east-1': [ec2_instance('i-1')],
+            'eu-west-1': [ec2_instance('i-2')],
+        }
+        errors = {'eu-west-1': RuntimeError('region unavailable')}
+        repo = repository.aws.EC2(client_factory = StubClientFactory(regions, errors = errors))
+        instances = repo.get_scheduled_instances()
+
+        self.assertEqual([instance.id for instance in instances], ['us-east-1:i-1'])
+
+    def test_region_timeout_isolated(self):
+        '''
+            A slow region is skipped once region_timeout expires
+        '''
+        regions = {
+            'us-east-1': [ec2_instance('i-1')],
+            'eu-west-1': [ec2_instance('i-2')],
+        }
+        latency = {'eu-west-1': 1.0}
+        repo = repository.aws.EC2(region_timeout = 0.2, client_factory = StubClientFactory(regions, latency))
+        instances = repo.get_scheduled_instances()
+
+        self.assertEqual([instance.id for instance in instances], ['us-east-1:i-1'])
+
+    def test_paginated_instances(self):
+        '''
+            Every page of a large region is returned
+        '''
+        regions = {
+            'us-east-1': [ec2_instance('i-{}'.format(i)) for i in range(23)],
+        }
+        factory = StubClientFactory(regions)
+        repo = repository.aws.EC2(page_size = 5, client_factory = factory)
+        instances = repo.get_scheduled_instances()
+
+        self.assertEqual(len(instances), 23)
+        self.assertEqual(len(set(instance.id for instance in instances)), 23)
+        region_client = [client for client in factory.clients if client.region_name == 'us-east-1'][0]
+        self.assertEqual(region_client.calls.count('describe_instances'), 5)
+
+    def test_instances_streamed(self):
+        '''
+            Instances of a fast region are yielded before a slow region finishes
+        '''
+        regions = {
+            'us-east-1': [ec2_instance('i-1')],
+            'eu-west-1': [ec2_instance('i-2')],
+        }
+        latency = {'eu-west-1': 0.5}
+        repo = repository.aws.EC2(client_factory = StubClientFactory(regions, latency))
+
+        start = time.time()
+        instances = repo.iter_scheduled_instances()
+        first = next(instances)
+        elapsed = time.time() - start
+
+        self.assertEqual(first.id, 'us-east-1:i-1')
+        self.assertLess(elapsed, 0.5)
+        self.assertEqual([instance.id for instance in instances], ['eu-west-1:i-2'])
+
+    def test_deadline_cursor(self):
+        '''
+            A scan stopped at its deadline is resumed from its cursor without repeating instances
+        '''
+        regions = {
+            'us-east-1': [ec2_instance('i-{}'.format(i)) for i in range(23)],
+            'eu-west-1': [ec2_instance('i-e')],
+        }
+        factory = StubClientFactory(regions, latency = {'us-east-1': 0.05})
+        repo = repository.aws.EC2(page_size = 5, client_factory = factory)
+        first = list(repo.iter_scheduled_instances(deadline = time.monotonic() + 0.12))
+
+        self.assertEqual(list(repo.cursor), ['us-east-1'])
+        self.assertIsNotNone(repo.cursor['us-east-1'])
+        self.assertEqual(sorted(repo.snapshot.regions), ['eu-west-1', 'us-east-1'])
+
+        resumed = repository.aws.EC2(page_size = 5, client_factory = factory, previous = repo.snapshot)
+        rest = list(resumed.iter_scheduled_instances(cursor = repo.cursor))
+
+        self.assertEqual(resumed.cursor, {})
+        ids = [instance.id for instance in first + rest]
+        self.assertEqual(len(ids), 24)
+        self.assertEqual(len(set(ids)), 24)
+        self.assertEqual(len(resumed.snapshot.regions['us-east-1'].instances), 23)
+
+    def test_resume_service_token(self):
+        '''
+            A resumed region sends its saved NextToken as the service returned it
+        '''
+        # EC2 tokens are base64 JSON, a paginator would decode them as its own StartingToken
+        token = 'eyJ2IjoiMSIsImMiOiJhYmMiLCJzIjoxfQ=='
+        ec2 = botocore.session.get_session().create_client('ec2', region_name = 'us-east-1',
+                                                           aws_access_key_id = 'testing', aws_secret_access_key = 'testing')
+        stubber = botocore.stub.Stubber(ec2)
+        stubber.add_response('describe_instances', {'Reservations': [{'Instances': [ec2_instance('i-1')]}]},
+                             {'Filters': botocore.stub.ANY, 'MaxResults': 5, 'NextToken': token})
+        repo = repository.aws.EC2(page_size = 5, client_factory = lambda service, region_name = None: ec2)
+
+        with stubber:
+            instances = list(repo.iter_scheduled_instances(cursor = {'us-east-1': token}))
+
+        stubber.assert_no_pending_responses()
+        self.assertEqual([instance.id for instance in instances], ['us-east-1:i-1'])
+        self.assertEqual(repo.failed_regions, [])
+
+    def test_deadline_passed(self):
+        '''
+            Nothing is yielded after the deadline, every region is left in the cursor
+        '''
+        regions = {
+            'us-east-1': [ec2_instance('i-1')],
+            'eu-west-1': [ec2_instance('i-2')],
+        }
+        repo = repository.aws.EC2(client_factory = StubClientFactory(regions))
+        instances = list(repo.iter_scheduled_instances(deadline = time.monotonic()))
+
+        self.assertEqual(instances, [])
+        self.assertEqual(repo.cursor, {'us-east-1': None, 'eu-west-1': None})
+
+    def test_state_filter(self):
+        '''
+            Terminated and shutting-down instances are filtered by the API
+        '''
+        regions = {
+            'us-east-1': [
+                ec2_instance('i-1', 'running'),
+                ec2_instance('i-2', 'terminated'),
+                ec2_instance('i-3', 'shutting-down'),
+                ec2_instance('i-4', 'stopped'),
+            ],
+        }
+        factory = StubClientFactory(regions)
+        repo = repository.aws.EC2(client_factory = factory)
+        instances = repo.get_scheduled_instances()
+
+        self.assertEqual(sorted(instance.id for instance in instances), ['us-east-1:i-1', 'us-east-1:i-4'])
+        region_client = [client for client in factory.clients if client.region_name == 'us-east-1'][0]
+        self.assertIn({'Name': 'instance-state-name', 'Values': repository.aws.EC2.SCHEDULABLE_STATES}, region_client.filters)
+
+    def test_auto_scaling_excluded(self):
+        '''
+            Auto Scaling group members are ignored
+        '''
+        regions = {
+            'us-east-1': [
+                ec2_instance('i-1'),
+                ec2_instance('i-2', tags = {'aws:autoscaling:groupName': 'web'}),
+            ],
+        }
+        repo = repository.aws.EC2(client_factory = StubClientFactory(regions))
+        instances = repo.get_scheduled_instances()
+        self.assertEqual([instance.id for instance in instances], ['us-east-1:i-1'])
+
+        repo = repository.aws.EC2(client_factory = StubClientFactory(regions), exclude_tags = ())
+        instances = repo.get_scheduled_instances()
+        self.assertEqual(len(instances), 2)
+
+    def test_snapshot_recorded(self):
+        '''
+            Completely scanned regions are recorded in the snapshot
+        '''
+        regions = {
+            'us-east-1': [ec2_instance('i-1'), ec2_instance('i-2', schedule = 'invalid')],
+            'eu-west-1': [ec2_instance('i-3')],
+        }
+        errors = {'eu-west-1': RuntimeError('region unavailable')}
+        repo = repository.aws.EC2(client_factory = StubClientFactory(regions, errors = errors))
+        repo.get_scheduled_instances()
+
+        self.assertEqual(sorted(repo.snapshot.regions), ['us-east-1'])
+        self.assertEqual(repo.snapshot.get('us-east-1:i-1').schedule, (600, 1320, 'UTC', 127))
+        self.assertIsNone(repo.snapshot.get('us-east-1:i-2').schedule)
+
+    def test_snapshot_reused(self):
+        '''
+            Schedules are not parsed again when the tag did not change
+        '''
+        regions = {
+            'us-east-1': [ec2_instance('i-1'), ec2_instance('i-2', schedule = '08:00;18:00;UTC;Mon')],
+        }
+        repo = repository.aws.EC2(client_factory = StubClientFactory(regions))
+        repo.get_scheduled_instances()
+
+        scheduler.schedule_cache.clear()
+        regions['us-east-1'][1] = ec2_instance('i-2', schedule = '09:00;18:00;UTC;Mon')
+        repo = repository.aws.EC2(client_factory = StubClientFactory(regions), previous = repo.snapshot)
+        instances = repo.get_scheduled_instances()
+
+        self.assertEqual(scheduler.schedule_cache.misses, 1)
+        self.assertEqual([str(instance.schedule) for instance in instances], [
+            '10:00;22:00;UTC;Mon,Tue,Wed,Thu,Fri,Sat,Sun',
+            '09:00;18:00;UTC;Mon',
+        ])
+
+    def _scanned_repository(self, regions):
+        repo = repository.aws.EC2(client_factory = StubClientFactory(regions))
+        repo.get_scheduled_instances()
+        return repository.aws.EC2(client_factory = StubClientFactory(regions), previous = repo.snapshot)
+
+    def test_state_change_event(self):
+        '''
+            A state change updates the running state of a known instance
+        '''
+        regions = {'us-east-1': [ec2_instance('i-1')]}
+        repo = self._scanned_repository(regions)
+
+        region, instance = repo.apply_event(load_event('state_change_stopped'))
+        self.assertEqual(region, 'us-east-1')
+        self.assertEqual(instance.id, 'us-east-1:i-1')
+        self.assertEqual(instance.running, False)
+        self.assertEqual(repo.previous.get('us-east-1:i-1').running, False)
+
+        region, instance = repo.apply_event(load_event('state_change_terminated'))
+        self.assertIsNone(instance)
+        self.assertIsNone(repo.previous.get('us-east-1:i-1'))
+
+    def test_state_change_unknown_instance(self):
+        '''
+            A state change of an instance that is not scheduled is ignored
+        '''
+        repo = self._scanned_repository({'us-east-1': []})
+        region, instance = repo.apply_event(load_event('state_change_stopped'))
+        self.assertIsNone(instance)
+        self.assertIsNone(repo.previous.get('us-east-1:i-1'))
+
+    def test_tag_change_event(self):
+        '''
+            A tag change adds, updates and removes a scheduled instance
+        '''
+        regions = {'us-east-1': [ec2_instance('i-2', 'stopped', schedule = 'invalid')]}
+        repo = repository.aws.EC2(client_factory = StubClientFactory(regions))
+
+        region, instance = repo.apply_event(load_event('tag_change_schedule'))
+        self.assertEqual(instance.id, 'us-east-1:i-2')
+        self.assertEqual(instance.running, False)
+        self.assertEqual(str(instance.schedule), '08:00;18:00;UTC;Mon,Tue,Wed,Thu,Fri')
+        self.assertEqual(repo.previous.get('us-east-1:i-2').schedule, instance.schedule.to_compact())
+
+        region, instance = repo.apply_event(load_event('tag_change_removed'))
+        self.assertIsNone(instance)
+        self.assertIsNone(repo.previous.get('us-east-1:i-2'))
+
+    def test_unsupported_event(self):
+        '''
+            Other events are ignored
+        '''
+        repo = repository.aws.EC2(client_factory = StubClientFactory({}))
+        self.assertEqual(repo.apply_event({'detail-type': 'Scheduled Event'}), (None, None))
+
+class TaggedRepositoryTestCase(unittest.TestCase):
+    """
+    Unit tests for repository.aws.TaggedEC2
+    """
+
+    def test_get_scheduled_instances(self):
+        '''
+            Tagged instances that can be scheduled are returned with the instances of EC2
+        '''
+        regions = {
+            'us-east-1': [
+                ec2_instance('i-1'),
+                ec2_instance('i-2', 'stopped'),
+                ec2_instance('i-3', 'terminated'),
+                ec2_instance('i-4', tags = {'aws:autoscaling:groupName': 'web'}),
+            ],
+            'eu-west-1': [ec2_instance('i-5')],
+            'ap-south-1': [],
+        }
+        expected = sorted(instance.id for instance in repository.aws.EC2(client_factory = StubClientFactory(regions)).get_scheduled_instances())
+
+        repo = repository.aws.TaggedEC2(client_factory = StubClientFactory(regions))
+        instances = repo.get_scheduled_instances()
+
+        self.assertEqual(sorted(instance.id for instance in instances), expected)
+        self.assertEqual(expected, ['eu-west-1:i-5', 'us-east-1:i-1', 'us-east-1:i-2'])
+        self.assertEqual(repo.snapshot.get('us-east-1:i-2').running, False)
+
+    def test_state_batches(self):
+        '''
+            The state of each page of tagged instances is described in a single call
+        '''
+        regions = {'us-east-1': [ec2_instance('i-{}'.format(i)) for i in range(250)]}
+        factory = StubClientFactory(regions)
+        repo = repository.aws.TaggedEC2(client_factory = factory)
+
+        self.assertEqual(len(repo.get_scheduled_instances()), 250)
+        calls = [call for client in factory.clients if client.region_name == 'us-east-1' for call in client.calls]
+        self.assertEqual(calls.count('get_resources'), 3)
+        self.assertEqual(calls.count('describe_instance_status'), 3)
+        self.assertNotIn('describe_instances', calls)
+
+    def test_terminated_tags(self):
+        '''
+            Tagged instances that no longer exist are dropped from the state call
+        '''
+        factory = StubClientFactory({'us-east-1': [ec2_instance('i-1')]}, orphans = {'us-east-1': ['i-0ff']})
+        repo = repository.aws.TaggedEC2(client_factory = factory)
+
+        self.assertEqual([instance.id for instance in repo.get_scheduled_instances()], ['us-east-1:i-1'])
+        self.assertEqual(sorted(repo.snapshot.regions['us-east-1'].instances), ['i-1'])
+
+    def test_deadline_cursor(self):
+        '''
+            A scan stopped at its deadline is resumed from its GetResources token
+        '''
+        regions = {'us-east-1': [ec2_instance('i-{}'.format(i)) for i in range(23)]}
+        factory = StubClientFactory(regions, latency = {'us-east-1': 0.03})
+        repo = repository.aws.TaggedEC2(page_size = 5, client_factory = factory)
+        first = list(repo.iter_scheduled_instances(deadline = time.monotonic() + 0.15))
+
+        self.assertEqual(list(repo.cursor), ['us-east-1'])
+
+        resumed = repository.aws.TaggedEC2(page_size = 5, client_factory = factory, previous = repo.snapshot)
+        rest = list(resumed.iter_scheduled_instances(cursor = repo.cursor))
+
+        ids = [instance.id for instance in first + rest]
+        self.assertEqual(len(ids), 23)
+        self.assertEqual(len(set(ids)), 23)
+
+    def test_resume_service_token(self):
+        '''
+            A resumed region sends its saved PaginationToken as the service returned it
+        '''
+        token = 'eyJ2IjoiMSIsImMiOiJhYmMiLCJzIjoxfQ=='
+        session = botocore.session.get_session()
+        credentials = {'region_name': 'us-east-1', 'aws_access_key_id': 'testing', 'aws_secret_access_key': 'testing'}
+        tagging = session.create_client('resourcegroupstaggingapi', **credentials)
+        ec2 = session.create_client('ec2', **credentials)
+        tagging_stubber = botocore.stub.Stubber(tagging)
+        tagging_stubber.add_response('get_resources', {'ResourceTagMappingList': [{
+            'ResourceARN': 'arn:aws:ec2:us-east-1:123456789012:instance/i-1',
+            'Tags': [{'Key': 'Schedule', 'Value': '10:00;22:00;UTC;Mon'}],
+        }], 'PaginationToken': ''}, {
+            'TagFilters': botocore.stub.ANY, 'ResourceTypeFilters': botocore.stub.ANY, 'ResourcesPerPage': 5, 'PaginationToken': token,
+        })
+        ec2_stubber = botocore.stub.Stubber(ec2)
+        ec2_stubber.add_response('describe_instance_status', {'InstanceStatuses': [{'InstanceId': 'i-1', 'InstanceState': {'Name': 'running'}}]})
+        clients = {'resourcegroupstaggingapi': tagging, 'ec2': ec2}
+        repo = repository.aws.TaggedEC2(page_size = 5, client_factory = lambda service, region_name = None: clients[service])
+
+        with tagging_stubber, ec2_stubber:
+            instances = list(repo.iter_scheduled_instances(cursor = {'us-east-1': token}))
+
+        tagging_stubber.assert_no_pending_responses()
+        self.assertEqual([instance.id for instance in instances], ['us-east-1:i-1'])
+        self.assertEqual(repo.failed_regions, [])
+
+    def test_hash_shard(self):
+        '''
+            Only the instances of the shard are described
+        '''
+        regions = {'us-east-1': [ec2_instance('i-{}'.format(i)) for i in range(40)]}
+        ids = set()
+        for index in range(2):
+            repo = repository.aws.TaggedEC2(client_factory = StubClientFactory(regions), shard = (index, 2))
+            shard_ids = set(instance.id for instance in repo.get_scheduled_instances())
+            self.assertFalse(ids & shard_ids)
+            ids |= shard_ids
+        self.assertEqual(len(ids), 40)
+
 if __name__ == '__main__':
     unittest.main()
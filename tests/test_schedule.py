@@ -2,11 +2,12 @@ import context
 import unittest
 
 import logging
+import random
 
 import pytz
 import datetime
 
-from scheduler import Day, Schedule
+from scheduler import Day, Schedule, ScheduleCache, EvaluationContext, TransitionIndex, evaluate_schedules
 
 DEFAULT_START = datetime.time(hour=10,minute=0)
 DEFAULT_STOP = datetime.time(hour=22,minute=0)
@@ -24,7 +25,7 @@ DEFAULT_SCHEDULE_STRING = '10:00;22:00;UTC;Mon,Tue,Wed,Thu,Fri,Sat,Sun'
 
 logger = logging.getLogger()
 logger.setLevel(logging.WARN)
-logger.addHandler(logging.StreamHandler)
+logger.addHandler(logging.StreamHandler())
 
 class ScheduleTestCase(unittest.TestCase):
     '''
@@ -146,9 +147,88 @@ class ScheduleTestCase(unittest.TestCase):
         self.assertTrue(sch)
         self.assertEqual(sch.start_time, DEFAULT_START)
         self.assertEqual(sch.stop_time, DEFAULT_STOP)
-        self.assertEqual(sch.time_zone, DEFAULT_ZONE)
+        self.assertEqual(str(sch.time_zone), str(DEFAULT_ZONE))
         self.assertEqual(sch.days, DEFAULT_DAYS)
 
+    def test_time_formats(self):
+        '''
+            Hours and minutes of one or two digits are accepted, out of range times are not
+        '''
+        sch = Schedule.from_string('8:5;22:00;UTC;Mon')
+        self.assertEqual(sch.start_time, datetime.time(8, 5))
+        for time_string in ['24:00', '10:60', '10', '10:00:00', 'ab:cd', '100:00']:
+            with self.assertRaises(ValueError):
+                Schedule.from_string('{};NONE;UTC;Mon'.format(time_string))
+
+    def test_immutable(self):
+        '''
+
+        '''
+        sch = Schedule(DEFAULT_START, DEFAULT_STOP, DEFAULT_ZONE, DEFAULT_DAYS)
+        with self.assertRaises(AttributeError):
+            sch.start_time = DEFAULT_STOP
+        with self.assertRaises(AttributeError):
+            sch.other = None
+
+    def test_hashable(self):
+        '''
+
+        '''
+        first = Schedule(DEFAULT_START, DEFAULT_STOP, DEFAULT_ZONE, DEFAULT_DAYS)
+        second = Schedule.from_string(DEFAULT_SCHEDULE_STRING)
+        other = Schedule(DEFAULT_START, None, DEFAULT_ZONE, DEFAULT_DAYS)
+
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, other)
+        self.assertEqual(len(set([first, second, other])), 2)
+
+    def test_compact_fields(self):
+        '''
+
+        '''
+        sch = Schedule(DEFAULT_START, None, DEFAULT_ZONE, set([Day.Mon, Day.Sun]))
+        self.assertEqual(sch.start_minutes, 600)
+        self.assertEqual(sch.stop_minutes, None)
+        self.assertEqual(sch.day_mask, 0b1000001)
+        self.assertEqual(str(sch), '10:00;NONE;UTC;Mon,Sun')
+
+    def test_midnight_start(self):
+        '''
+
+        '''
+        timestamp = datetime.datetime(2018, 4, 23, 0, 30)
+
+        sch = Schedule(datetime.time(0, 0), None, DEFAULT_ZONE, DEFAULT_DAYS)
+        target = sch.evaluate(timestamp)
+        self.assertEqual(target, True)
+
+    def test_weekend_days(self):
+        '''
+
+        '''
+        saturday = datetime.datetime(2018, 4, 28, 12, 0)
+        sunday = datetime.datetime(2018, 4, 29, 12, 0)
+
+        sch = Schedule.from_string('10:00;22:00;UTC;Sat')
+        self.assertEqual(sch.evaluate(saturday), True)
+        self.assertEqual(sch.evaluate(sunday), None)
+
+        sch = Schedule.from_string('10:00;22:00;UTC;Sun')
+        self.assertEqual(sch.evaluate(saturday), None)
+        self.assertEqual(sch.evaluate(sunday), True)
+
+    def test_evaluate_time_zone(self):
+        '''
+
+        '''
+        sch = Schedule.from_string('10:00;22:00;America/New_York;Mon')
+
+        # 08:00 and 11:00 EDT
+        self.assertEqual(sch.evaluate(datetime.datetime(2018, 4, 23, 12, 0)), None)
+        self.assertEqual(sch.evaluate(datetime.datetime(2018, 4, 23, 15, 0)), True)
+        # 23:00 EDT Monday, Tuesday in UTC
+        self.assertEqual(sch.evaluate(datetime.datetime(2018, 4, 24, 3, 0)), False)
+
     ######################################################################
     # Test Failure
     ######################################################################
@@ -218,5 +298,400 @@ class ScheduleTestCase(unittest.TestCase):
             sch = Schedule(DEFAULT_START, DEFAULT_STOP, DEFAULT_ZONE, days)
         self.assertRegex(cm.exception.args[0], 'days must be a set of scheduler.Day')
 
+WEEK = datetime.datetime(2018, 4, 23)
+
+def reference_target(windows, timestamp):
+    '''
+    Target of windows at a timestamp of the week of WEEK, from the windows
+    open and the stops passed that day
+    '''
+    minutes = (timestamp - WEEK).total_seconds() / 60
+    day = int(minutes // (24 * 60))
+    intervals = []
+    for window_day, day_windows in windows.items():
+        for start, stop in day_windows:
+            start = window_day * 24 * 60 + start.hour * 60 + start.minute
+            stop = window_day * 24 * 60 + stop.hour * 60 + stop.minute
+            if stop <= start:
+                stop += 24 * 60
+            for offset in (-7 * 24 * 60, 0):
+                intervals.append((start + offset, stop + offset))
+    if any(start < minutes <= stop for start, stop in intervals):
+        return True
+    if any(day * 24 * 60 <= stop < minutes for start, stop in intervals):
+        return False
+    return None
+
+class WindowsTestCase(unittest.TestCase):
+    '''
+        Unit tests for schedules with several windows per day
+    '''
+
+    def assertTargets(self, sch, targets):
+        for timestamp, target in targets:
+            self.assertEqual(sch.evaluate(timestamp), target, timestamp)
+
+    def test_multiple_windows(self):
+        '''
+            Each window starts and stops, the day ends stopped
+        '''
+        sch = Schedule.from_string('08:00-12:00,13:00-18:00;UTC;Mon')
+        self.assertTargets(sch, [
+            (datetime.datetime(2018, 4, 23, 7, 0), None),
+            (datetime.datetime(2018, 4, 23, 9, 0), True),
+            (datetime.datetime(2018, 4, 23, 12, 30), False),
+            (datetime.datetime(2018, 4, 23, 14, 0), True),
+            (datetime.datetime(2018, 4, 23, 20, 0), False),
+            (datetime.datetime(2018, 4, 24, 9, 0), None),
+        ])
+        self.assertEqual(sch.windows, {Day.Mon: ((480, 720), (780, 1080))})
+
+    def test_overnight(self):
+        '''
+            A window that stops before it starts runs through midnight
+        '''
+        sch = Schedule.from_string('22:00-06:00;UTC;Fri')
+        self.assertTargets(sch, [
+            (datetime.datetime(2018, 4, 27, 21, 0), None),
+            (datetime.datetime(2018, 4, 27, 23, 0), True),
+            (datetime.datetime(2018, 4, 28, 0, 0), True),
+            (datetime.datetime(2018, 4, 28, 3, 0), True),
+            (datetime.datetime(2018, 4, 28, 7, 0), False),
+            (datetime.datetime(2018, 4, 29, 1, 0), None),
+        ])
+        self.assertEqual(sch.next_transition(datetime.datetime(2018, 4, 27, 23, 0)), datetime.datetime(2018, 4, 28, 6, 0))
+
+    def test_week_wraps(self):
+        '''
+            A Sunday overnight window runs into Monday
+        '''
+        sch = Schedule.from_string('20:00-02:00;UTC;Sun')
+        self.assertEqual(sch.evaluate(datetime.datetime(2018, 4, 23, 1, 0)), True)
+        self.assertEqual(sch.evaluate(datetime.datetime(2018, 4, 23, 3, 0)), False)
+
+    def test_overrides(self):
+        '''
+            Overrides replace the windows of their days
+        '''
+        sch = Schedule.from_string('08:00-18:00;UTC;Mon,Tue,Wed,Thu,Fri;Fri=08:00-16:00;Wed=NONE;Sat,Sun=10:00-14:00')
+        self.assertEqual(sch.days, set(Day) - {Day.Wed})
+        self.assertTargets(sch, [
+            (datetime.datetime(2018, 4, 23, 17, 0), True),
+            (datetime.datetime(2018, 4, 25, 12, 0), None),
+            (datetime.datetime(2018, 4, 27, 17, 0), False),
+            (datetime.datetime(2018, 4, 28, 11, 0), True),
+        ])
+        self.assertEqual(str(sch), '08:00-18:00;UTC;Mon,Tue,Thu;Fri=08:00-16:00;Sat,Sun=10:00-14:00')
+        self.assertEqual(Schedule.from_string(str(sch)), sch)
+
+    def test_original_format(self):
+        '''
+            A single window that does not cross midnight is the original format
+        '''
+        sch = Schedule.from_string('08:00-18:00;UTC;Mon,Fri')
+        self.assertEqual(sch, Schedule.from_string('08:00;18:00;UTC;Mon,Fri'))
+        self.assertEqual(str(sch), '08:00;18:00;UTC;Mon,Fri')
+        self.assertEqual(sch.to_compact(), (480, 1080, 'UTC', 0b10001))
+
+    def test_compact(self):
+        '''
+            Extended schedules survive to_compact, also as a decoded JSON list
+        '''
+        sch = Schedule.from_string('22:00-06:00,12:00-13:00;Europe/London;Mon;Sun=09:00-10:00')
+        compact = sch.to_compact()
+        self.assertEqual(compact[:4], (None, None, 'Europe/London', 0b1000001))
+        self.assertEqual(Schedule.from_compact(compact), sch)
+        self.assertEqual(Schedule.from_compact(tuple(list(compact))), sch)
+        self.assertIsNone(sch.start_time)
+
+    def test_always_running(self):
+        '''
+            Windows covering the whole week never stop
+        '''
+        sch = Schedule.from_string('20:00-09:00,08:00-21:00;UTC;Mon,Tue,Wed,Thu,Fri,Sat,Sun')
+        self.assertEqual(sch.evaluate(datetime.datetime(2018, 4, 23, 0, 0)), True)
+        self.assertIsNone(sch.next_transition(datetime.datetime(2018, 4, 23, 0, 0)))
+
+    def test_matches_reference(self):
+        '''
+            The interval table agrees with the windows they were compiled from
+        '''
+        rand = random.Random(7)
+        for i in range(50):
+            windows = {}
+            for day in rand.sample(list(Day), rand.randint(1, 7)):
+                windows[day] = []
+                for j in range(rand.randint(1, 3)):
+                    start = rand.randrange(0, 24 * 60, 30)
+                    stop = (start + rand.randrange(30, 20 * 60, 30)) % (24 * 60)
+                    windows[day].append((datetime.time(start // 60, start % 60), datetime.time(stop // 60, stop % 60)))
+            sch = Schedule.from_windows(windows, DEFAULT_ZONE)
+            for j in range(50):
+                timestamp = WEEK + datetime.timedelta(minutes = rand.randrange(0, 7 * 24 * 60, 15), seconds = rand.choice([0, 1]))
+                self.assertEqual(sch.evaluate(timestamp), reference_target(windows, timestamp), (str(sch), timestamp))
+
+    def test_transitions_change_target(self):
+        '''
+            No new target appears before the next transition, across a DST change
+        '''
+        rand = random.Random(42)
+        sch = Schedule.from_string('22:00-01:30,09:30-12:00;Europe/London;Sat,Sun;Mon=06:00-07:00')
+        for i in range(50):
+            after = datetime.datetime(2018, 3, 20) + datetime.timedelta(minutes = rand.randint(0, 60 * 24 * 14))
+            transition = sch.next_transition(after)
+            current = sch.evaluate(after)
+            timestamp = after
+            while timestamp < transition:
+                self.assertIn(sch.evaluate(timestamp), (None, current))
+                timestamp += datetime.timedelta(minutes = 15)
+            self.assertNotEqual(sch.evaluate(transition + datetime.timedelta(seconds = 1)), sch.evaluate(transition - datetime.timedelta(seconds = 1)))
+
+    def test_invalid_windows(self):
+        '''
+            Malformed windows and overrides are rejected, the original format still needs stop after start
+        '''
+        for schedule_string in ['08:00-08:00;UTC;Mon', '8-9;UTC;Mon', '08:00-25:00;UTC;Mon', '08:00-18:00;UTC',
+                                '08:00-18:00;UTC;Mon;Sat', '08:00-18:00;UTC;Mon;Sat=9-10', '08:00-18:00;UTC;Mon;Any=NONE',
+                                '08:00-18:00;UTC;Mon;Mon=NONE', '22:00;06:00;UTC;Mon']:
+            with self.assertRaises(ValueError):
+                Schedule.from_string(schedule_string)
+
+class EvaluateSchedulesTestCase(unittest.TestCase):
+    '''
+        Unit tests for evaluate_schedules
+    '''
+
+    ZONES = ['UTC', 'Europe/London', 'America/New_York', 'Australia/Sydney', 'Asia/Kolkata']
+
+    # UTC instants of DST transitions in the zones above
+    TRANSITIONS = [
+        datetime.datetime(2018, 3, 11, 7, 0),
+        datetime.datetime(2018, 11, 4, 6, 0),
+        datetime.datetime(2018, 3, 25, 1, 0),
+        datetime.datetime(2018, 10, 28, 1, 0),
+        datetime.datetime(2018, 3, 31, 16, 0),
+        datetime.datetime(2018, 10, 6, 16, 0),
+    ]
+
+    def _random_schedule(self, rand):
+        start = stop = None
+        while start is None and stop is None:
+            times = sorted(rand.sample(range(24 * 60), 2))
+            if rand.random() < 0.8:
+                start = datetime.time(times[0] // 60, times[0] % 60)
+            if rand.random() < 0.8:
+                stop = datetime.time(times[1] // 60, times[1] % 60)
+        days = set(day for day in Day if rand.random() < 0.6)
+        return Schedule(start, stop, pytz.timezone(rand.choice(self.ZONES)), days)
+
+    def _random_timestamp(self, rand):
+        if rand.random() < 0.5:
+            base = rand.choice(self.TRANSITIONS)
+            return base + datetime.timedelta(minutes = rand.randint(-26 * 60, 26 * 60), seconds = rand.choice([0, 0, 30]))
+        return datetime.datetime(2018, 1, 1) + datetime.timedelta(seconds = rand.randint(0, 365 * 86400))
+
+    def _reference_evaluate(self, schedule, timestamp):
+        '''Straightforward evaluation localizing now, start and stop separately'''
+        zone = schedule.time_zone
+        now = pytz.utc.localize(timestamp).astimezone(zone)
+        target = None
+        if now.weekday() in schedule.days:
+            if schedule.start_time is not None and now > zone.localize(datetime.datetime.combine(now.date(), schedule.start_time)):
+                target = True
+            if schedule.stop_time is not None and now > zone.localize(datetime.datetime.combine(now.date(), schedule.stop_time)):
+                target = False
+        return target
+
+    def test_matches_evaluate(self):
+        '''
+            Bulk and cached evaluation match a straightforward evaluation for
+            random schedules and timestamps
+        '''
+        rand = random.Random(20180423)
+        schedules = [self._random_schedule(rand) for i in range(100)]
+        for i in range(150):
+            timestamp = self._random_timestamp(rand)
+            expected = [self._reference_evaluate(schedule, timestamp) for schedule in schedules]
+            self.assertEqual([schedule.evaluate(timestamp) for schedule in schedules], expected, timestamp)
+            context = EvaluationContext(timestamp)
+            self.assertEqual([schedule.evaluate(timestamp, context) for schedule in schedules], expected, timestamp)
+            self.assertEqual(evaluate_schedules(schedules, timestamp), expected, timestamp)
+
+    def test_boundary(self):
+        '''
+            A timestamp exactly on the start time is not after it
+        '''
+        sch = Schedule(DEFAULT_START, DEFAULT_STOP, DEFAULT_ZONE, DEFAULT_DAYS)
+        timestamp = datetime.datetime(2018, 4, 23, 10, 0)
+        self.assertEqual(evaluate_schedules([sch], timestamp), [None])
+        self.assertEqual(evaluate_schedules([sch], timestamp + datetime.timedelta(microseconds = 1)), [True])
+
+    def test_none_schedule(self):
+        '''
+            Missing schedules evaluate to None
+        '''
+        sch = Schedule(DEFAULT_START, DEFAULT_STOP, DEFAULT_ZONE, DEFAULT_DAYS)
+        timestamp = datetime.datetime(2018, 4, 23, 12, 0)
+        self.assertEqual(evaluate_schedules([None, sch, sch], timestamp), [None, True, True])
+
+    def test_aware_timestamp(self):
+        '''
+
+        '''
+        with self.assertRaises(ValueError):
+            evaluate_schedules([], datetime.datetime(2018, 4, 23, tzinfo = pytz.utc))
+
+class TransitionTestCase(unittest.TestCase):
+    '''
+        Unit tests for Schedule.next_transition and TransitionIndex
+    '''
+
+    def test_next_transition(self):
+        '''
+            Transitions follow the start and stop times of scheduled days
+        '''
+        sch = Schedule.from_string('08:00;18:00;America/New_York;Mon,Fri')
+        # Friday 19:00 EDT
+        after = datetime.datetime(2018, 4, 27, 23, 0)
+        expected = [
+            datetime.datetime(2018, 4, 30, 12, 0),
+            datetime.datetime(2018, 4, 30, 22, 0),
+            datetime.datetime(2018, 5, 4, 12, 0),
+        ]
+        for transition in expected:
+            after = sch.next_transition(after)
+            self.assertEqual(after, transition)
+
+    def test_next_transition_changes_target(self):
+        '''
+            No new start or stop target appears before the next transition
+        '''
+        rand = random.Random(42)
+        sch = Schedule.from_string('09:30;17:15;Europe/London;Mon,Tue,Sat')
+        for i in range(50):
+            after = datetime.datetime(2018, 3, 20) + datetime.timedelta(minutes = rand.randint(0, 60 * 24 * 14))
+            transition = sch.next_transition(after)
+            current = sch.evaluate(after)
+            timestamp = after
+            while timestamp < transition:
+                self.assertIn(sch.evaluate(timestamp), (None, current))
+                timestamp += datetime.timedelta(minutes = 15)
+            target = sch.evaluate(transition + datetime.timedelta(seconds = 1))
+            self.assertIsNotNone(target)
+            self.assertNotEqual(target, sch.evaluate(transition - datetime.timedelta(seconds = 1)))
+
+    def test_transition_index(self):
+        '''
+            The index holds the next transition of each distinct schedule
+        '''
+        timestamp = datetime.datetime(2018, 4, 23, 12, 0)
+        index = TransitionIndex(timestamp)
+        index.add(Schedule.from_string('10:00;22:00;UTC;Mon'))
+        index.add(Schedule.from_string('10:00;22:00;UTC;Mon'))
+        index.add(Schedule.from_string('NONE;13:30;UTC;Mon'))
+        index.add(None)
+
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.next_transition, datetime.datetime(2018, 4, 23, 13, 30))
+        self.assertEqual(index.count_between(timestamp, datetime.datetime(2018, 4, 23, 23, 0)), 2)
+        self.assertEqual(index.count_between(timestamp, datetime.datetime(2018, 4, 23, 13, 0)), 0)
+
+class EvaluationContextTestCase(unittest.TestCase):
+    '''
+        Unit tests for EvaluationContext
+    '''
+
+    def test_clock_shared(self):
+        '''
+            A zone is localized once per context
+        '''
+        context = EvaluationContext(datetime.datetime(2018, 4, 23, 12, 0))
+        zone = pytz.timezone('Europe/London')
+        self.assertIs(context.clock(zone), context.clock(zone))
+        self.assertEqual(context.clock(zone).now.hour, 13)
+
+    def test_different_timestamp(self):
+        '''
+            A context can not be used for another timestamp
+        '''
+        context = EvaluationContext(datetime.datetime(2018, 4, 23, 12, 0))
+        sch = Schedule(DEFAULT_START, DEFAULT_STOP, DEFAULT_ZONE, DEFAULT_DAYS)
+        with self.assertRaises(ValueError):
+            sch.evaluate(datetime.datetime(2018, 4, 23, 13, 0), context)
+
+    def test_dst_gap(self):
+        '''
+            A start time inside the spring forward gap resolves to standard time
+        '''
+        sch = Schedule.from_string('02:30;NONE;America/New_York;Sun')
+        # 03:15 and 03:45 EDT, 02:30 EST is 03:30 EDT
+        before = datetime.datetime(2018, 3, 11, 7, 15)
+        after = datetime.datetime(2018, 3, 11, 7, 45)
+        self.assertEqual(sch.evaluate(before, EvaluationContext(before)), None)
+        self.assertEqual(sch.evaluate(after, EvaluationContext(after)), True)
+
+class ScheduleCacheTestCase(unittest.TestCase):
+    '''
+        Unit tests for ScheduleCache object
+    '''
+
+    def test_shared_schedule(self):
+        '''
+            Equivalent schedule strings share one Schedule object
+        '''
+        cache = ScheduleCache()
+        first = cache.get(DEFAULT_SCHEDULE_STRING)
+        second = cache.get(' 10:00; 22:00; UTC; Mon,Tue,Wed,Thu,Fri,Sat,Sun ')
+
+        self.assertIs(first, second)
+        self.assertEqual(first.start_time, DEFAULT_START)
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(cache.hits, 1)
+
+    def test_lru_eviction(self):
+        '''
+            The least recently used schedule is evicted
+        '''
+        cache = ScheduleCache(max_size = 2)
+        first = cache.get('10:00;22:00;UTC;Mon')
+        cache.get('10:00;22:00;UTC;Tue')
+        cache.get('10:00;22:00;UTC;Mon')
+        cache.get('10:00;22:00;UTC;Wed')
+
+        self.assertEqual(len(cache), 2)
+        self.assertIs(cache.get('10:00;22:00;UTC;Mon'), first)
+        cache.get('10:00;22:00;UTC;Tue')
+        self.assertEqual(cache.misses, 4)
+
+    def test_error_cached(self):
+        '''
+            An invalid schedule string is parsed once
+        '''
+        cache = ScheduleCache()
+        for i in range(3):
+            with self.assertRaises(ValueError) as cm:
+                cache.get('10:00;22:00;Nowhere/Special;Mon')
+            self.assertRegex(cm.exception.args[0], 'invalid timezone')
+
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(cache.hits, 2)
+
+    def test_invalid_type(self):
+        '''
+            A missing schedule string is invalid
+        '''
+        with self.assertRaises(ValueError):
+            ScheduleCache().get(None)
+
+    def test_clear(self):
+        '''
+            Clearing the cache removes entries and counters
+        '''
+        cache = ScheduleCache()
+        cache.get(DEFAULT_SCHEDULE_STRING)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.misses, 0)
+
 if __name__ == '__main__':
     unittest.main()
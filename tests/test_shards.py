@@ -0,0 +1,223 @@
+import context
+import unittest
+import io
+import os
+import json
+import shutil
+import tempfile
+import datetime
+import unittest.mock
+
+import clients
+import handler
+import shards
+import snapshot
+
+from stubs import StubClientFactory, ec2_instance
+
+ALWAYS_ON = '00:00;NONE;UTC;Mon,Tue,Wed,Thu,Fri,Sat,Sun'
+
+def fleet(sizes):
+    '''Return a stub fleet of stopped instances, sizes is a dict of region name to instance count'''
+    return dict((region, [ec2_instance('i-{}-{}'.format(region, i), 'stopped', ALWAYS_ON) for i in range(size)])
+                for region, size in sizes.items())
+
+class PlanShardsTestCase(unittest.TestCase):
+    """
+    Unit tests for shards.plan_shards
+    """
+
+    def test_region_balanced(self):
+        '''
+            Regions are balanced by their previous instance count
+        '''
+        scanned = datetime.datetime(2018, 4, 23, 12, 0)
+        previous = snapshot.Snapshot(dict(
+            (region, snapshot.RegionSnapshot(scanned, dict(('i-{}'.format(i), snapshot.InstanceEntry(True, 0, None)) for i in range(size))))
+            for region, size in [('us-east-1', 100), ('eu-west-1', 60), ('eu-west-2', 50), ('ap-south-1', 10)]))
+
+        plan = shards.plan_shards(['us-east-1', 'eu-west-1', 'eu-west-2', 'ap-south-1'], 2, shards.REGION, previous)
+
+        self.assertEqual(plan, [
+            shards.Shard(0, ['ap-south-1', 'us-east-1'], 1),
+            shards.Shard(1, ['eu-west-1', 'eu-west-2'], 1),
+        ])
+
+    def test_region_no_empty_shards(self):
+        '''
+            There are never more region shards than regions
+        '''
+        plan = shards.plan_shards(['us-east-1', 'eu-west-1'], 5)
+
+        self.assertEqual(sorted(region for shard in plan for region in shard.regions), ['eu-west-1', 'us-east-1'])
+        self.assertEqual(len(plan), 2)
+
+    def test_hash(self):
+        '''
+            Hash shards scan every region and split its instances between them
+        '''
+        plan = shards.plan_shards(['us-east-1', 'eu-west-1'], 3, shards.HASH)
+
+        self.assertEqual(plan, [shards.Shard(index, ['eu-west-1', 'us-east-1'], 3) for index in range(3)])
+        ids = ['i-{:017x}'.format(i) for i in range(300)]
+        owners = [[index for index in range(3) if shards.in_shard(id, index, 3)] for id in ids]
+        self.assertTrue(all(len(owner) == 1 for owner in owners))
+        self.assertEqual(set(owner[0] for owner in owners), set(range(3)))
+
+    def test_invalid(self):
+        '''
+            An unknown strategy or no shard is rejected
+        '''
+        self.assertRaises(ValueError, shards.plan_shards, ['us-east-1'], 2, 'account')
+        self.assertRaises(ValueError, shards.plan_shards, ['us-east-1'], 0)
+
+class MergeTestCase(unittest.TestCase):
+    """
+    Unit tests for shards.Merge
+    """
+
+    def report(self, shard, instances, next_transition = None, complete = True):
+        scanned = datetime.datetime(2018, 4, 23, 12, 0)
+        region_snapshots = dict((region, snapshot.RegionSnapshot(scanned, dict((id, snapshot.InstanceEntry(True, 0, None)) for id in ids)))
+                                for region, ids in instances.items())
+        return shards.make_report(shard, region_snapshots, next_transition, len(instances), 0, 0, 0, complete)
+
+    def test_hash_shares(self):
+        '''
+            A region is merged only when every hash shard scanned it
+        '''
+        plan = shards.plan_shards(['us-east-1', 'eu-west-1'], 2, shards.HASH)
+        reports = [
+            self.report(plan[0], {'us-east-1': ['i-1'], 'eu-west-1': ['i-3']}, datetime.datetime(2018, 4, 23, 18, 0)),
+            self.report(plan[1], {'us-east-1': ['i-2']}, datetime.datetime(2018, 4, 23, 14, 0), complete = False),
+        ]
+
+        merge = shards.Merge(plan, reports)
+
+        self.assertEqual(list(merge.snapshot.regions), ['us-east-1'])
+        self.assertEqual(sorted(merge.snapshot.regions['us-east-1'].instances), ['i-1', 'i-2'])
+        self.assertEqual(merge.next_transition, datetime.datetime(2018, 4, 23, 14, 0))
+        self.assertFalse(merge.complete)
+
+    def test_failed_shard(self):
+        '''
+            A failed worker leaves its regions out and the run incomplete
+        '''
+        plan = shards.plan_shards(['us-east-1', 'eu-west-1'], 2)
+
+        merge = shards.Merge(plan, [self.report(plan[0], {'eu-west-1': ['i-1']}), None])
+
+        self.assertEqual(list(merge.snapshot.regions), ['eu-west-1'])
+        self.assertEqual(merge.failed_shards, [1])
+        self.assertFalse(merge.complete)
+
+class StubLambdaClient:
+    '''
+    Stand-in for a boto3 Lambda client running handler.run in process
+    '''
+    def __init__(self):
+        self.invocations = []
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        event = json.loads(Payload.decode('utf-8'))
+        self.invocations.append((FunctionName, InvocationType, event))
+        report = handler.run(event, None)
+        return {'StatusCode': 200, 'Payload': io.BytesIO(json.dumps(report).encode('utf-8'))}
+
+class CoordinatorContext:
+    '''
+    Stand-in for the Lambda context of the coordinator, without a deadline
+    '''
+    invoked_function_arn = 'arn:aws:lambda:us-east-1:123456789012:function:scheduler'
+
+class CoordinatorTestCase(unittest.TestCase):
+    """
+    Coordinated runs through handler with stubbed clients
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'snapshot.json')
+        self.factory = StubClientFactory(fleet({'us-east-1': 40, 'eu-west-1': 25, 'ap-south-1': 5}))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def coordinate(self, strategy, mode = 'process', context = None, factory = None, dry_run = False):
+        timestamp = datetime.datetime.utcnow()
+        with unittest.mock.patch.object(handler, 'SNAPSHOT_PATH', self.path), \
+                unittest.mock.patch.object(handler, 'METRICS', False), \
+                unittest.mock.patch.object(handler, 'SHARD_COUNT', 3), \
+                unittest.mock.patch.object(handler, 'SHARD_STRATEGY', strategy), \
+                unittest.mock.patch.object(handler, 'SHARD_MODE', mode), \
+                unittest.mock.patch.object(clients, 'get_client', factory or self.factory):
+            metrics = handler.instrumentation.Metrics()
+            summary = handler._coordinate(timestamp, dry_run, None, context, metrics, factory or self.factory)
+        return summary if dry_run else metrics
+
+    def assertScanned(self, metrics):
+        instances = snapshot.FileSnapshotStore(self.path).load()
+        self.assertEqual(dict((region, len(region_snapshot.instances)) for region, region_snapshot in instances.regions.items()),
+                         {'us-east-1': 40, 'eu-west-1': 25, 'ap-south-1': 5})
+        self.assertEqual(metrics.counters['ShardsFailed'], 0)
+        self.assertNotIn('RunsIncomplete', metrics.counters)
+
+    def test_process_by_region(self):
+        '''
+            Process workers each scan their regions, the coordinator saves all of them
+        '''
+        self.assertScanned(self.coordinate(shards.REGION))
+
+    def test_process_by_hash(self):
+        '''
+            Process workers each scan a hash share of every region
+        '''
+        self.assertScanned(self.coordinate(shards.HASH))
+
+    def test_process_dry_run(self):
+        '''
+            A dry run adds up the plans of the workers and saves nothing
+        '''
+        with unittest.mock.patch.object(handler, 'PLAN_PATH', os.path.join(self.directory, 'plan.jsonl')):
+            summary = self.coordinate(shards.HASH, dry_run = True)
+
+        self.assertEqual(summary, {'start': 70, 'stop': 0, 'unchanged': 0})
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_failed_region_retried(self):
+        '''
+            A region that fails in a worker is reported to the coordinator and retried on its own
+        '''
+        self.factory.errors['ap-south-1'] = RuntimeError('unavailable')
+        with unittest.mock.patch.object(handler, '_retry', None):
+            metrics = self.coordinate(shards.REGION)
+            self.assertEqual(handler._retry.regions, ['ap-south-1'])
+
+        self.assertEqual(metrics.counters['ShardsFailed'], 0)
+        self.assertEqual(metrics.counters['RegionsFailed'], 1)
+        self.assertNotIn('RunsIncomplete', metrics.counters)
+
+    def test_lambda(self):
+        '''
+            Lambda workers are invoked synchronously with their shard and start their instances once
+        '''
+        lambda_client = StubLambdaClient()
+        ec2 = self.factory
+
+        def factory(service, region_name = None, **kwargs):
+            if service == 'lambda':
+                return lambda_client
+            return ec2(service, region_name)
+
+        metrics = self.coordinate(shards.HASH, 'lambda', CoordinatorContext(), factory)
+
+        self.assertScanned(metrics)
+        self.assertEqual(len(lambda_client.invocations), 3)
+        self.assertEqual(set(invocation[0] for invocation in lambda_client.invocations), {CoordinatorContext.invoked_function_arn})
+        self.assertEqual(sorted(event['shard']['index'] for name, kind, event in lambda_client.invocations), [0, 1, 2])
+        started = [id for region, operation, ids in ec2.actions() for id in ids]
+        self.assertEqual(len(started), 70)
+        self.assertEqual(len(set(started)), 70)
+
+if __name__ == '__main__':
+    unittest.main()
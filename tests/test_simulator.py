@@ -0,0 +1,117 @@
+import context
+import unittest
+import time
+import random
+import datetime
+
+import scheduler
+import snapshot
+
+from simulator import Simulator
+
+SCHEDULES = [
+    '08:00;18:00;UTC;Mon,Tue,Wed,Thu,Fri',
+    '02:30;03:15;America/New_York;Mon,Tue,Wed,Thu,Fri,Sat,Sun',
+    '01:30;NONE;America/New_York;Sun',
+    'NONE;01:15;Europe/London;Sat,Sun',
+    '22:00;23:30;Australia/Sydney;Mon,Wed,Sat',
+]
+
+def simulate_minutes(schedules, running, start, end):
+    '''Reference simulation evaluating the schedules every 15 minutes, all of their times are multiples of 15 minutes'''
+    states = [running] * len(schedules)
+    minutes = [0] * len(schedules)
+    timestamp = start
+    while timestamp < end:
+        targets = scheduler.evaluate_schedules(schedules, timestamp + datetime.timedelta(seconds = 30))
+        for i, target in enumerate(targets):
+            if target is not None:
+                states[i] = target
+            minutes[i] += 15 * states[i]
+        timestamp += datetime.timedelta(minutes = 15)
+    return minutes
+
+class SimulatorTestCase(unittest.TestCase):
+    """
+    Unit tests for simulator
+    """
+
+    def test_matches_reference(self):
+        '''
+            Intervals match a per minute simulation across DST changes
+        '''
+        # Ranges around the 2018 DST changes in New York, London and Sydney
+        starts = [datetime.datetime(2018, month, day) for month, day in [(3, 10), (3, 24), (3, 31), (10, 6), (10, 27), (11, 3)]]
+        for start in starts:
+            end = start + datetime.timedelta(days = 2)
+            simulator = Simulator(start, end)
+            schedules = [scheduler.Schedule.from_string(schedule_string) for schedule_string in SCHEDULES]
+            for running in (False, True):
+                expected = simulate_minutes(schedules, running, start, end)
+                for schedule, minutes in zip(schedules, expected):
+                    seconds = sum((stop - begin).total_seconds() for begin, stop in simulator.intervals(schedule, running))
+                    self.assertEqual(seconds / 60, minutes, '{} {} {}'.format(schedule, running, start))
+
+    def test_running_hours(self):
+        '''
+            Hours are totalled per schedule and multiplied by instance count
+        '''
+        start = datetime.datetime(2018, 4, 23)
+        simulator = Simulator(start, start + datetime.timedelta(days = 7))
+        schedule = scheduler.Schedule.from_string(SCHEDULES[0])
+        simulator.add(schedule, False, count = 3)
+        simulator.add(None, True)
+
+        self.assertEqual(simulator.running_hours(), {SCHEDULES[0]: 3 * 5 * 10.0, None: 7 * 24.0})
+
+    def test_time_series(self):
+        '''
+            The series holds the average running count of each step
+        '''
+        start = datetime.datetime(2018, 4, 23)
+        simulator = Simulator(start, start + datetime.timedelta(days = 1))
+        simulator.add(scheduler.Schedule.from_string('08:30;18:00;UTC;Mon'), False, count = 2)
+
+        series = simulator.time_series(datetime.timedelta(hours = 1))
+        self.assertEqual(len(series), 24)
+        self.assertEqual(series[7], (start + datetime.timedelta(hours = 7), 0.0))
+        self.assertEqual(series[8], (start + datetime.timedelta(hours = 8), 1.0))
+        self.assertEqual(series[12][1], 2.0)
+        self.assertEqual(series[18][1], 0.0)
+
+    def test_from_snapshot(self):
+        '''
+            A snapshot fleet is simulated from its recorded running states
+        '''
+        schedule = scheduler.Schedule.from_string(SCHEDULES[0])
+        fleet = snapshot.Snapshot({'us-east-1': snapshot.RegionSnapshot(snapshot.NEVER_SCANNED, {
+            'i-1': snapshot.InstanceEntry(False, 0, schedule.to_compact()),
+            'i-2': snapshot.InstanceEntry(True, 0, None),
+        })})
+        start = datetime.datetime(2018, 4, 23)
+        simulator = Simulator.from_snapshot(fleet, start, start + datetime.timedelta(days = 1))
+
+        self.assertEqual(simulator.running_hours(), {SCHEDULES[0]: 10.0, None: 24.0})
+
+    def test_scale(self):
+        '''
+            100k instances are simulated over a year in seconds
+        '''
+        random.seed(1)
+        schedules = [scheduler.Schedule.from_string(schedule_string) for schedule_string in SCHEDULES]
+        start = datetime.datetime(2018, 1, 1)
+        simulator = Simulator(start, start + datetime.timedelta(days = 365))
+        for i in range(100000):
+            simulator.add(random.choice(schedules), random.random() < 0.5)
+
+        begin = time.time()
+        hours = simulator.running_hours()
+        series = simulator.time_series()
+        elapsed = time.time() - begin
+
+        self.assertEqual(len(series), 365 * 24)
+        self.assertAlmostEqual(sum(count for timestamp, count in series), sum(hours.values()), places = 3)
+        self.assertLess(elapsed, 10)
+
+if __name__ == '__main__':
+    unittest.main()
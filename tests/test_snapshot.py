@@ -0,0 +1,208 @@
+import context
+import unittest
+import os
+import shutil
+import tempfile
+import datetime
+import random
+import unittest.mock
+
+import snapshot
+
+from snapshot import Snapshot, RegionSnapshot, InstanceEntry
+from stubs import StubDynamoDB
+
+SCANNED = datetime.datetime(2018, 4, 23, 12, 0)
+
+def build_snapshot():
+    return Snapshot({
+        'us-east-1': RegionSnapshot(SCANNED, {
+            'i-1': InstanceEntry(True, snapshot.tag_hash('10:00;22:00;UTC;Mon'), (600, 1320, 'UTC', 1)),
+            'i-2': InstanceEntry(False, snapshot.tag_hash('invalid'), None),
+        }),
+        'eu-west-1': RegionSnapshot(SCANNED),
+    })
+
+class SnapshotTestCase(unittest.TestCase):
+    """
+    Unit tests for snapshot
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assertSnapshotEqual(self, loaded, expected):
+        self.assertEqual(sorted(loaded.regions), sorted(expected.regions))
+        for region, region_snapshot in expected.regions.items():
+            self.assertEqual(loaded.regions[region].scanned, region_snapshot.scanned)
+            self.assertEqual(loaded.regions[region].instances, region_snapshot.instances)
+
+    def test_encode_decode(self):
+        '''
+            A region survives encoding
+        '''
+        expected = build_snapshot()
+        region_snapshot = Snapshot.decode_region(Snapshot.encode_region(expected.regions['us-east-1']))
+        self.assertEqual(region_snapshot.instances, expected.regions['us-east-1'].instances)
+
+    def test_version_ignored(self):
+        '''
+            A region encoded with another version is ignored
+        '''
+        self.assertIsNone(Snapshot.decode_region(b'{"v":0,"s":"2018-04-23T12:00:00","i":{}}'))
+
+    def test_get(self):
+        '''
+            Entries are found by <REGION>:<INSTANCE_ID>
+        '''
+        expected = build_snapshot()
+        self.assertEqual(expected.get('us-east-1:i-1').running, True)
+        self.assertIsNone(expected.get('us-east-1:i-3'))
+        self.assertIsNone(expected.get('ap-south-1:i-1'))
+
+    def test_file_store(self):
+        '''
+            Save and load a snapshot file
+        '''
+        store = snapshot.FileSnapshotStore(os.path.join(self.directory, 'snapshot.json'))
+        self.assertEqual(store.load().regions, {})
+
+        store.save(build_snapshot())
+        self.assertSnapshotEqual(store.load(), build_snapshot())
+
+    def test_sqlite_store(self):
+        '''
+            Save and load a snapshot database
+        '''
+        store = snapshot.SQLiteSnapshotStore(os.path.join(self.directory, 'snapshot.db'))
+        store.save(build_snapshot())
+        store.save(Snapshot({'ap-south-1': RegionSnapshot(SCANNED)}))
+
+        loaded = store.load()
+        self.assertEqual(sorted(loaded.regions), ['ap-south-1', 'eu-west-1', 'us-east-1'])
+        self.assertSnapshotEqual(snapshot.SQLiteSnapshotStore(os.path.join(self.directory, 'snapshot.db')).load(), loaded)
+
+    def test_dynamodb_store(self):
+        '''
+            Save and load a snapshot table
+        '''
+        dynamodb = StubDynamoDB()
+        store = snapshot.DynamoDBSnapshotStore('snapshot', client_factory = lambda service, region_name = None: dynamodb)
+        store.save(build_snapshot())
+
+        self.assertEqual(sorted(dynamodb.items), [('eu-west-1', '#'), ('us-east-1', '#'), ('us-east-1', 'i-1'), ('us-east-1', 'i-2')])
+        self.assertSnapshotEqual(store.load(), build_snapshot())
+
+    def test_dynamodb_large_region(self):
+        '''
+            A large region is saved one item per instance and only the instances that changed are written again
+        '''
+        rng = random.Random(1)
+        schedules = [(minutes, None, 'UTC', 127) for minutes in range(0, 1440, 30)]
+        large = Snapshot({'us-east-1': RegionSnapshot(SCANNED, dict(
+            ('i-{:017x}'.format(rng.getrandbits(68)), InstanceEntry(rng.random() < 0.5, rng.getrandbits(31), rng.choice(schedules)))
+            for i in range(30000)))})
+        dynamodb = StubDynamoDB()
+        factory = lambda service, region_name = None: dynamodb
+
+        snapshot.DynamoDBSnapshotStore('snapshot', client_factory = factory).save(large)
+        self.assertEqual(len(dynamodb.items), 30001)
+        self.assertSnapshotEqual(snapshot.DynamoDBSnapshotStore('snapshot', client_factory = factory).load(), large)
+
+        store = snapshot.DynamoDBSnapshotStore('snapshot', client_factory = factory)
+        loaded = store.load(['us-east-1'])
+        self.assertSnapshotEqual(loaded, large)
+        instance_id = sorted(loaded.regions['us-east-1'].instances)[0]
+        del loaded.regions['us-east-1'].instances[instance_id]
+        with unittest.mock.patch.object(dynamodb, 'put_item', wraps = dynamodb.put_item) as put_item, \
+                unittest.mock.patch.object(dynamodb, 'delete_item', wraps = dynamodb.delete_item) as delete_item:
+            store.save(loaded)
+        self.assertEqual(put_item.call_count, 1)
+        self.assertEqual(delete_item.call_count, 1)
+        self.assertEqual(len(dynamodb.items), 30000)
+
+    def test_dynamodb_newer_instance_kept(self):
+        '''
+            A save does not replace or delete an instance saved since it was observed
+        '''
+        dynamodb = StubDynamoDB()
+        factory = lambda service, region_name = None: dynamodb
+        store = snapshot.DynamoDBSnapshotStore('snapshot', client_factory = factory)
+        store.save(build_snapshot())
+        run = snapshot.DynamoDBSnapshotStore('snapshot', client_factory = factory)
+        scanned = run.load()
+
+        # Events after the scan
+        later = SCANNED + datetime.timedelta(minutes = 5)
+        self.assertTrue(store.save_instance('us-east-1', 'i-1', InstanceEntry(False, 1, None), later))
+        self.assertTrue(store.save_instance('us-east-1', 'i-3', InstanceEntry(True, 3, None), later))
+        self.assertFalse(store.save_instance('us-east-1', 'i-3', None, SCANNED))
+
+        scanned.regions['us-east-1'].instances['i-1'] = InstanceEntry(True, 2, None)
+        scanned.regions['us-east-1'].instances['i-3'] = InstanceEntry(False, 3, None)
+        run.save(scanned)
+
+        self.assertEqual(store.load_instance('us-east-1', 'i-1'), InstanceEntry(False, 1, None))
+        self.assertEqual(store.load_instance('us-east-1', 'i-3'), InstanceEntry(True, 3, None))
+
+    def test_cursor(self):
+        '''
+            Every store saves, loads and removes a cursor apart from the regions
+        '''
+        cursor = snapshot.Cursor(SCANNED, {'us-east-1': 'token', 'eu-west-1': None}, datetime.datetime(2018, 4, 23, 18, 0))
+        dynamodb = StubDynamoDB()
+        stores = [
+            snapshot.FileSnapshotStore(os.path.join(self.directory, 'snapshot.json')),
+            snapshot.SQLiteSnapshotStore(':memory:'),
+            snapshot.DynamoDBSnapshotStore('snapshot', client_factory = lambda service, region_name = None: dynamodb),
+        ]
+        for store in stores:
+            self.assertIsNone(store.load_cursor())
+            store.save(build_snapshot())
+            store.save_cursor(cursor)
+
+            self.assertEqual(store.load_cursor(), cursor)
+            self.assertSnapshotEqual(store.load(), build_snapshot())
+
+            store.save_cursor(None)
+            self.assertIsNone(store.load_cursor())
+
+    def test_region_list(self):
+        '''
+            Every store saves and loads the region list apart from the regions
+        '''
+        region_list = snapshot.RegionList(SCANNED, ['210987654321'], ['us-east-1', 'eu-west-1', '210987654321:us-east-1'])
+        dynamodb = StubDynamoDB()
+        stores = [
+            snapshot.FileSnapshotStore(os.path.join(self.directory, 'snapshot.json')),
+            snapshot.SQLiteSnapshotStore(':memory:'),
+            snapshot.DynamoDBSnapshotStore('snapshot', client_factory = lambda service, region_name = None: dynamodb),
+        ]
+        for store in stores:
+            self.assertIsNone(store.load_region_list())
+            store.save(build_snapshot())
+            store.save_region_list(region_list)
+
+            self.assertEqual(store.load_region_list(), region_list)
+            self.assertSnapshotEqual(store.load(), build_snapshot())
+
+    def test_regions_to_scan(self):
+        '''
+            Regions that were empty are skipped until their scan is old enough
+        '''
+        previous = Snapshot({
+            'us-east-1': RegionSnapshot(SCANNED, {'i-1': InstanceEntry(True, 0, None)}),
+            'eu-west-1': RegionSnapshot(SCANNED),
+            'eu-west-2': RegionSnapshot(SCANNED - datetime.timedelta(hours = 7)),
+        })
+        regions = ['us-east-1', 'eu-west-1', 'eu-west-2', 'ap-south-1']
+        empty_ttl = datetime.timedelta(hours = 6)
+
+        self.assertEqual(previous.regions_to_scan(regions, SCANNED, empty_ttl), ['us-east-1', 'eu-west-2', 'ap-south-1'])
+        self.assertEqual(previous.regions_to_scan(regions, SCANNED, datetime.timedelta(0)), regions)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import context
+import unittest
+import datetime
+
+import pytz
+
+import zones
+
+class ZonesTestCase(unittest.TestCase):
+    """
+    Unit tests for zones
+    """
+
+    ZONES = ['UTC', 'Europe/London', 'America/New_York', 'Australia/Sydney', 'Asia/Kolkata', 'America/Sao_Paulo']
+
+    def test_get_zone(self):
+        '''
+            Zones are looked up by name, unknown names are rejected
+        '''
+        self.assertEqual(str(zones.get_zone('Europe/London')), 'Europe/London')
+        self.assertEqual(str(zones.get_zone('utc')), 'UTC')
+        self.assertRaises(ValueError, zones.get_zone, 'Mars/Olympus')
+
+    def test_localize_matches_pytz(self):
+        '''
+            Local times of 2018 localize to the pytz instant, every quarter hour of DST transition days
+        '''
+        for name in self.ZONES:
+            zone = zones.get_zone(name)
+            reference = pytz.timezone(name)
+            date = datetime.date(2018, 1, 1)
+            while date.year == 2018:
+                midnight = datetime.datetime.combine(date, datetime.time.min)
+                transition = reference.localize(midnight).utcoffset() != reference.localize(midnight + datetime.timedelta(days = 1)).utcoffset()
+                for minutes in range(0, 24 * 60, 15) if transition else [12 * 60]:
+                    local = midnight + datetime.timedelta(minutes = minutes)
+                    expected = reference.localize(local).astimezone(pytz.utc).replace(tzinfo = None)
+                    self.assertEqual(zones.to_utc(zones.localize(zone, local)), expected, '{} {}'.format(name, local))
+                date += datetime.timedelta(days = 1)
+
+    def test_to_local(self):
+        '''
+            A naive UTC timestamp converts to the local time of a zone
+        '''
+        local = zones.to_local(datetime.datetime(2018, 7, 1, 12, 0), zones.get_zone('Europe/London'))
+        self.assertEqual(local.replace(tzinfo = None), datetime.datetime(2018, 7, 1, 13, 0))
+        self.assertEqual(local.utcoffset(), datetime.timedelta(hours = 1))
+
+if __name__ == '__main__':
+    unittest.main()